@@ -0,0 +1,193 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime
+
+from prezzi import prezzo_netto
+
+CARTELLA_ARCHIVIO = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".archivio")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS preventivi (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    creato TEXT NOT NULL,
+    cliente TEXT NOT NULL,
+    cliente_norm TEXT NOT NULL,
+    referente TEXT,
+    sconti_base TEXT,
+    sconti_atg TEXT,
+    espositori TEXT,
+    note TEXT,
+    pagamento TEXT,
+    trasporto TEXT,
+    validita TEXT,
+    totale REAL,
+    righe INTEGER,
+    pdf TEXT
+);
+CREATE TABLE IF NOT EXISTS righe (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    preventivo_id INTEGER NOT NULL REFERENCES preventivi(id) ON DELETE CASCADE,
+    posizione INTEGER NOT NULL,
+    articolo TEXT NOT NULL,
+    articolo_norm TEXT NOT NULL,
+    taglia TEXT,
+    quantita INTEGER,
+    netto REAL,
+    listino REAL,
+    manuale REAL,
+    immagine TEXT,
+    normativa TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_preventivi_cliente ON preventivi(cliente_norm, creato);
+CREATE INDEX IF NOT EXISTS idx_preventivi_creato ON preventivi(creato);
+CREATE INDEX IF NOT EXISTS idx_righe_preventivo ON righe(preventivo_id, posizione);
+CREATE INDEX IF NOT EXISTS idx_righe_articolo ON righe(articolo_norm, preventivo_id);
+"""
+
+
+def _norm(testo):
+    return str(testo or "").strip().upper()
+
+
+class Archivio:
+    """Storico dei preventivi su SQLite, con i PDF salvati accanto al database.
+
+    Ogni operazione apre la sua connessione: si può usare da più sessioni e thread insieme.
+    """
+
+    def __init__(self, cartella=CARTELLA_ARCHIVIO):
+        self.cartella = cartella
+        self.percorso = os.path.join(cartella, "preventivi.sqlite3")
+        self.cartella_pdf = os.path.join(cartella, "pdf")
+        os.makedirs(self.cartella_pdf, exist_ok=True)
+        self._lock = threading.Lock()
+        with closing(self._connetti()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            # Archivi creati prima della colonna `manuale`: la aggiungo, le righe vecchie restano calcolate
+            colonne = {r["name"] for r in conn.execute("PRAGMA table_info(righe)")}
+            if "manuale" not in colonne:
+                conn.execute("ALTER TABLE righe ADD COLUMN manuale REAL")
+
+    def _connetti(self):
+        conn = sqlite3.connect(self.percorso, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    # --- SCRITTURA ---
+    def salva(self, preventivo, sconti_base, sconti_atg, pdf_bytes=None, catalogo=None):
+        """Salva il preventivo e restituisce il suo id.
+
+        Con `catalogo` si memorizza anche il prezzo di listino di ogni riga, per lo storico.
+        Il netto forzato a mano ("Netto Manuale" della riga) va nella colonna `manuale`.
+        """
+        righe = preventivo["righe"]
+        with self._lock, closing(self._connetti()) as conn, conn:
+            cursore = conn.execute(
+                """INSERT INTO preventivi (creato, cliente, cliente_norm, referente, sconti_base, sconti_atg,
+                   espositori, note, pagamento, trasporto, validita, totale, righe)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (datetime.now().isoformat(timespec="seconds"), preventivo.get("cliente", ""),
+                 _norm(preventivo.get("cliente")), preventivo.get("referente", ""),
+                 json.dumps(list(sconti_base)), json.dumps(list(sconti_atg)),
+                 json.dumps(list(preventivo.get("espositori") or [])), preventivo.get("note", ""),
+                 preventivo.get("pagamento", ""), preventivo.get("trasporto", ""), preventivo.get("validita", ""),
+                 sum(r["Totale Riga"] for r in righe), len(righe)))
+            id_preventivo = cursore.lastrowid
+
+            valori = []
+            for pos, r in enumerate(righe):
+                listino = None
+                if catalogo is not None:
+                    trovato = catalogo.trova(r["Articolo"])
+                    if trovato is not None:
+                        listino = float(trovato[1]['LISTINO'])
+                valori.append((id_preventivo, pos, r["Articolo"], _norm(r["Articolo"]), str(r["Taglia"]),
+                               int(r["Quantità"]), float(r["Netto U."]), listino, r.get("Netto Manuale"),
+                               r.get("Immagine", ""), r.get("Normativa", "")))
+            conn.executemany(
+                """INSERT INTO righe (preventivo_id, posizione, articolo, articolo_norm, taglia, quantita,
+                   netto, listino, manuale, immagine, normativa) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", valori)
+
+            if pdf_bytes is not None:
+                percorso_pdf = os.path.join(self.cartella_pdf, f"{id_preventivo}.pdf")
+                with open(percorso_pdf, "wb") as f:
+                    f.write(pdf_bytes)
+                conn.execute("UPDATE preventivi SET pdf = ? WHERE id = ?", (percorso_pdf, id_preventivo))
+        return id_preventivo
+
+    # --- LETTURA ---
+    def cerca(self, cliente="", articolo="", dal=None, al=None, limite=50):
+        """Preventivi più recenti che corrispondono ai filtri (cliente e articolo per prefisso)."""
+        condizioni, parametri = [], []
+        if cliente.strip():
+            # Prefisso: usa l'indice su cliente_norm
+            condizioni.append("p.cliente_norm >= ? AND p.cliente_norm < ?")
+            prefisso = _norm(cliente)
+            parametri += [prefisso, prefisso + "\uffff"]
+        if articolo.strip():
+            condizioni.append("p.id IN (SELECT preventivo_id FROM righe WHERE articolo_norm >= ? AND articolo_norm < ?)")
+            prefisso = _norm(articolo)
+            parametri += [prefisso, prefisso + "\uffff"]
+        if dal:
+            condizioni.append("p.creato >= ?")
+            parametri.append(str(dal))
+        if al:
+            condizioni.append("p.creato < ?")
+            parametri.append(str(al))
+        dove = f"WHERE {' AND '.join(condizioni)}" if condizioni else ""
+        with closing(self._connetti()) as conn:
+            return [dict(r) for r in conn.execute(
+                f"""SELECT p.id, p.creato, p.cliente, p.referente, p.totale, p.righe, p.pdf
+                    FROM preventivi p {dove} ORDER BY p.creato DESC, p.id DESC LIMIT ?""",
+                (*parametri, limite))]
+
+    def carica(self, id_preventivo):
+        """Il preventivo salvato, con sconti e righe, oppure None."""
+        with closing(self._connetti()) as conn:
+            testa = conn.execute("SELECT * FROM preventivi WHERE id = ?", (id_preventivo,)).fetchone()
+            if testa is None:
+                return None
+            righe = [dict(r) for r in conn.execute(
+                "SELECT * FROM righe WHERE preventivo_id = ? ORDER BY posizione", (id_preventivo,))]
+        dati = dict(testa)
+        for campo in ("sconti_base", "sconti_atg", "espositori"):
+            dati[campo] = json.loads(dati[campo] or "[]")
+        dati["righe"] = righe
+        return dati
+
+
+def riprezza(salvato, catalogo, sconti_base=None, sconti_atg=None):
+    """Righe del preventivo salvato ricalcolate sul listino attuale.
+
+    Restituisce (righe, mancanti): righe come argomenti per Carrello.aggiungi,
+    mancanti = articoli che non esistono più nei listini. Le righe salvate con il netto
+    forzato a mano lo mantengono, tutte le altre prendono il listino attuale.
+    """
+    sconti_base = tuple(sconti_base or salvato["sconti_base"])
+    sconti_atg = tuple(sconti_atg or salvato["sconti_atg"])
+    righe, mancanti = [], []
+    for r in salvato["righe"]:
+        trovato = catalogo.trova(r["articolo"])
+        if trovato is None:
+            mancanti.append(r["articolo"])
+            continue
+        nome_catalogo, d = trovato
+        base = nome_catalogo == "Listino Base"
+        manuale = r.get("manuale")
+        netto = prezzo_netto(d['LISTINO'], sconti_base if base else sconti_atg, manuale)
+        taglia = r["taglia"]
+        righe.append({
+            "articolo": d['ARTICOLO'],
+            "taglia": int(taglia) if taglia.isdigit() else taglia,
+            "quantita": r["quantita"],
+            "netto": netto,
+            "immagine": str(d.get('IMMAGINE', '')).strip(),
+            "normativa": str(d.get('NORMATIVA', '')).strip() if base else "",
+            "manuale": manuale,
+        })
+    return righe, mancanti
@@ -0,0 +1,320 @@
+"""Benchmark dei passaggi lenti del generatore, senza browser e senza rete.
+
+Uso:
+    python benchmark.py [--uscita bench.json] [--confronta bench_vecchio.json] [--scale 1,10,100] [--solo-avvio]
+
+Misura caricamento listini (Excel e snapshot), ricerca, calcolo sconti, raggruppamento del
+carrello e impaginazione del PDF con carrelli da 1, 50 e 500 righe. Le foto arrivano da un
+piccolo server HTTP locale. Misura anche l'avvio a freddo della pagina: primo rerun in un
+interprete nuovo, come in un container appena partito. I risultati (secondi, minimo e
+mediana) finiscono in un JSON da confrontare tra un commit e l'altro.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import pandas as pd
+from PIL import Image
+
+import catalogo
+import immagini
+import strumentazione
+from carrello import Carrello
+from prezzi import SCONTI_DEFAULT_BASE, prezzo_netto
+from preventivo_pdf import MotorePreventivi
+from ricerca import IndiceRicerca
+
+CARTELLA = os.path.dirname(os.path.abspath(__file__))
+
+QUERY_RICERCA = ["S", "B17", "LONDON", "MAXIFLEX", "LONDN", "42-874"]
+
+
+# --- SERVER DI IMMAGINI FINTO ---
+def _foto_finta():
+    immagine = Image.new("RGB", (1200, 900), (200, 30, 30))
+    uscita = BytesIO()
+    immagine.save(uscita, format="JPEG", quality=95)
+    return uscita.getvalue()
+
+
+class _GestoreFoto(BaseHTTPRequestHandler):
+    foto = _foto_finta()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(self.foto)))
+        self.end_headers()
+        self.wfile.write(self.foto)
+
+    def log_message(self, *args):
+        pass
+
+
+def avvia_server_foto():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _GestoreFoto)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+# --- MISURE ---
+def misura(funzione, ripetizioni=5):
+    tempi = []
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        funzione()
+        tempi.append(time.perf_counter() - inizio)
+    return {"min": min(tempi), "mediana": statistics.median(tempi), "ripetizioni": ripetizioni}
+
+
+def listino_scalato(df, scala):
+    """Listino sintetico: le righe vere ripetute `scala` volte con codici articolo distinti."""
+    if scala == 1:
+        return df
+    copie = []
+    for i in range(scala):
+        copia = df.copy()
+        copia['ARTICOLO'] = copia['ARTICOLO'].astype(str) + f" #{i}"
+        copie.append(copia)
+    return pd.concat(copie, ignore_index=True)
+
+
+def carrello_sintetico(df, righe, url_foto):
+    """Carrello di `righe` taglie distribuite su modelli diversi, 8 taglie per modello."""
+    carrello = Carrello()
+    modelli = df.head(max(1, righe // 8 + 1)).to_dict("records")
+    for i in range(righe):
+        d = modelli[(i // 8) % len(modelli)]
+        netto = prezzo_netto(d['LISTINO'], SCONTI_DEFAULT_BASE)
+        carrello.aggiungi(d['ARTICOLO'], 35 + i % 8, 1 + i % 3, netto,
+                          immagine=f"{url_foto}/{i // 8}.jpg", normativa=d.get('NORMATIVA', ""))
+    return carrello
+
+
+def memoria_carrello(df, righe, url_foto):
+    """Byte per riga di un carrello: com'è in sessione e dopo che la pagina ne ha letto tabella e righe."""
+    tracemalloc.start()
+    try:
+        prima = tracemalloc.get_traced_memory()[0]
+        carrello = carrello_sintetico(df, righe, url_foto)
+        compatto = tracemalloc.get_traced_memory()[0] - prima
+        carrello.tabella()
+        carrello.righe_preventivo()
+        letto = tracemalloc.get_traced_memory()[0] - prima
+    finally:
+        tracemalloc.stop()
+    return round(compatto / righe), round(letto / righe)
+
+
+def isola_processo(cartella_lavoro):
+    """Cache delle foto e metriche nella cartella temporanea: il benchmark non tocca quelle dell'app.
+
+    Va chiamata anche nei processi del pool (initializer), che partono da un interprete nuovo.
+    """
+    immagini.imposta_cache_predefinita(immagini.CacheImmagini(cartella=os.path.join(cartella_lavoro, "immagini")))
+    strumentazione.CARTELLA_METRICHE = os.path.join(cartella_lavoro, "metriche")
+    strumentazione.FILE_METRICHE = os.path.join(strumentazione.CARTELLA_METRICHE, "metriche.jsonl")
+
+
+def esegui(scale, cartella_lavoro):
+    risultati = {}
+    server, url_foto = avvia_server_foto()
+    isola_processo(cartella_lavoro)
+    catalogo.CARTELLA_SNAPSHOT = os.path.join(cartella_lavoro, "listini")
+
+    try:
+        base = catalogo.leggi_excel(os.path.join(CARTELLA, 'Listino_agente.xlsx'), "base")
+        atg = catalogo.leggi_excel(os.path.join(CARTELLA, 'Listino_ATG.xlsx'), "atg")
+
+        for scala in scale:
+            df_base = listino_scalato(base, scala)
+            df_atg = listino_scalato(atg, scala)
+            path = os.path.join(cartella_lavoro, f"listino_x{scala}.xlsx")
+            df_base.to_excel(path, index=False)
+            ripetizioni = 3 if scala < 100 else 1
+
+            risultati[f"carica_dati/excel/x{scala}"] = misura(lambda: catalogo.leggi_excel(path, "base"), ripetizioni)
+            catalogo.costruisci_snapshot(path, "base")
+            risultati[f"carica_dati/snapshot/x{scala}"] = misura(lambda: catalogo.carica_listino(path, "base"))
+
+            cataloghi = [("Listino Base", df_base), ("Listino ATG", df_atg)]
+            risultati[f"ricerca/indice/x{scala}"] = misura(lambda: IndiceRicerca(cataloghi), ripetizioni)
+            indice = IndiceRicerca(cataloghi)
+            risultati[f"ricerca/query/x{scala}"] = misura(
+                lambda: [indice.cerca(q, campi_extra=True) for q in QUERY_RICERCA], 20)
+
+            listini = df_base['LISTINO'].tolist()
+            risultati[f"sconti/x{scala}"] = misura(lambda: [prezzo_netto(p, SCONTI_DEFAULT_BASE) for p in listini])
+
+        # Memoria per riga: deve restare piatta al crescere dell'ordine
+        for righe in (50, 500, 5000):
+            compatto, letto = memoria_carrello(base, righe, url_foto)
+            risultati[f"memoria/carrello/{righe}"] = compatto
+            risultati[f"memoria/carrello_letto/{righe}"] = letto
+
+        motore = MotorePreventivi()
+        for righe in (1, 50, 500):
+            risultati[f"carrello/raggruppo/{righe}"] = misura(
+                lambda: carrello_sintetico(base, righe, url_foto).raggruppo(), 10)
+            carrello = carrello_sintetico(base, righe, url_foto)
+            preventivo = {
+                "cliente": "Cliente Benchmark", "referente": "Mario Rossi",
+                "righe": carrello.righe_preventivo(), "espositori": ["ATG banco.jpg", "BASE terra.jpg"],
+                "note": "Note di prova", "pagamento": "Ri.Ba. 60 giorni",
+                "trasporto": "P.to Franco", "validita": "30.06.2026",
+            }
+            # Primo giro a cache vuota (download dal server locale), poi a cache calda
+            shutil.rmtree(os.path.join(cartella_lavoro, "immagini"), ignore_errors=True)
+            immagini.imposta_cache_predefinita(immagini.CacheImmagini(cartella=os.path.join(cartella_lavoro, "immagini")))
+            risultati[f"pdf/freddo/{righe}"] = misura(lambda: motore.genera(preventivo), 1)
+            risultati[f"pdf/caldo/{righe}"] = misura(lambda: motore.genera(preventivo), 3)
+            risultati[f"pdf/byte/{righe}"] = len(motore.genera(preventivo))
+
+        # Preventivo lungo con tutti i blocchi da preparare: un processo contro un pool di os.cpu_count().
+        # Il confronto ha senso solo tra macchine con gli stessi core (campo "core" del rapporto):
+        # con un core solo i due tempi coincidono
+        carrello = carrello_sintetico(base, 2000, url_foto)
+        preventivo = dict(preventivo, righe=carrello.righe_preventivo())
+        risultati["pdf/blocchi_nuovi/2000"] = misura(lambda: MotorePreventivi().genera(preventivo), 2)
+        with ProcessPoolExecutor(os.cpu_count(), mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=isola_processo, initargs=(cartella_lavoro,)) as pool:
+            pool.submit(str).result()
+            risultati["pdf/parallelo/2000"] = misura(lambda: MotorePreventivi().genera(preventivo, esecutore=pool), 2)
+    finally:
+        server.shutdown()
+    return risultati
+
+
+# --- AVVIO A FREDDO ---
+# Gira in un interprete nuovo: nessun modulo già importato, nessuna cache_resource pronta
+PROGRAMMA_AVVIO = r"""
+import json, sys, time
+inizio = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+pronto = time.perf_counter()
+app = AppTest.from_file(sys.argv[1], default_timeout=120)
+app.run()
+fine = time.perf_counter()
+print(json.dumps({
+    "streamlit": pronto - inizio, "primo_rerun": fine - pronto, "errori": len(app.exception),
+    "moduli_pesanti": [m for m in ("fpdf", "requests", "openpyxl", "PIL") if m in sys.modules],
+}))
+"""
+
+
+def misura_avvio(cartella_lavoro, ripetizioni=3):
+    """Tempo del primo rerun della pagina (dai listini già convertiti, come dopo il passo di build)."""
+    for nome_file, tipo in catalogo.LISTINI.items():
+        path = os.path.join(CARTELLA, nome_file)
+        if os.path.exists(path):
+            catalogo.costruisci_snapshot(path, tipo)
+
+    misure = []
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        uscita = subprocess.run([sys.executable, "-c", PROGRAMMA_AVVIO, os.path.join(CARTELLA, "generatore.py")],
+                                cwd=CARTELLA, capture_output=True, text=True, check=True,
+                                env=dict(os.environ, PREVENTIVI_METRICHE=os.path.join(cartella_lavoro, "metriche")))
+        dati = json.loads(uscita.stdout.strip().splitlines()[-1])
+        if dati["errori"]:
+            raise RuntimeError("La pagina va in errore al primo rerun")
+        dati["processo"] = time.perf_counter() - inizio
+        misure.append(dati)
+
+    def riassunto(chiave):
+        tempi = [m[chiave] for m in misure]
+        return {"min": min(tempi), "mediana": statistics.median(tempi), "ripetizioni": ripetizioni}
+
+    return {
+        "avvio/processo": riassunto("processo"),
+        "avvio/import_streamlit": riassunto("streamlit"),
+        "avvio/primo_rerun": riassunto("primo_rerun"),
+        "avvio/moduli_pesanti": ",".join(misure[-1]["moduli_pesanti"]) or "nessuno",
+    }
+
+
+def _commit_corrente():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=CARTELLA,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def confronta(attuali, vecchi):
+    for nome, valore in attuali.items():
+        prima = vecchi.get(nome)
+        if prima is None:
+            continue
+        if isinstance(valore, str):
+            if valore != prima:
+                print(f"{nome:32s} {prima} -> {valore}")
+            continue
+        if isinstance(valore, dict):
+            valore, prima = valore["mediana"], prima["mediana"]
+        rapporto = valore / prima if prima else float("inf")
+        segnale = "  PEGGIO" if rapporto > 1.2 else ("  meglio" if rapporto < 0.8 else "")
+        print(f"{nome:32s} {prima:12.4f} -> {valore:12.4f}  x{rapporto:.2f}{segnale}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del generatore di preventivi.")
+    parser.add_argument("--uscita", default="bench.json", help="file JSON dei risultati")
+    parser.add_argument("--confronta", help="JSON di un'esecuzione precedente da confrontare")
+    parser.add_argument("--scale", default="1,10,100", help="fattori di ingrandimento dei listini sintetici")
+    parser.add_argument("--solo-avvio", action="store_true", help="misura solo l'avvio a freddo della pagina")
+    args = parser.parse_args(argv)
+
+    scale = [int(s) for s in args.scale.split(",") if s.strip()]
+    cartella_lavoro = tempfile.mkdtemp(prefix="bench_preventivi_")
+    try:
+        # L'avvio si misura per primo, prima che esegui() sposti gli snapshot in una cartella temporanea
+        risultati = misura_avvio(cartella_lavoro)
+        if not args.solo_avvio:
+            risultati.update(esegui(scale, cartella_lavoro))
+    finally:
+        shutil.rmtree(cartella_lavoro, ignore_errors=True)
+
+    rapporto = {
+        "commit": _commit_corrente(),
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "piattaforma": platform.platform(),
+        "core": os.cpu_count(),
+        "risultati": risultati,
+    }
+    with open(args.uscita, "w", encoding="utf-8") as f:
+        json.dump(rapporto, f, indent=2)
+
+    for nome, valore in risultati.items():
+        if isinstance(valore, dict):
+            print(f"{nome:32s} mediana {valore['mediana'] * 1000:10.2f} ms   min {valore['min'] * 1000:10.2f} ms")
+        elif isinstance(valore, str):
+            print(f"{nome:32s} {valore}")
+        else:
+            print(f"{nome:32s} {valore} byte")
+
+    if args.confronta:
+        with open(args.confronta, "r", encoding="utf-8") as f:
+            vecchi = json.load(f)["risultati"]
+        print(f"\nConfronto con {args.confronta}:")
+        confronta(risultati, vecchi)
+    print(f"\nRisultati salvati in {args.uscita}")
+
+
+if __name__ == "__main__":
+    main()
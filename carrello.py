@@ -0,0 +1,205 @@
+import sys
+import threading
+import weakref
+
+
+class InfoArticolo:
+    """Dati di un modello che non cambiano da una taglia all'altra (foto, normativa).
+
+    Uno solo per processo a parità di dati: tutte le righe e tutte le sessioni che hanno
+    in carrello lo stesso modello puntano allo stesso oggetto invece di copiarne i testi.
+    """
+
+    __slots__ = ("articolo", "immagine", "normativa", "__weakref__")
+
+    def __init__(self, articolo, immagine, normativa):
+        self.articolo = articolo
+        self.immagine = immagine
+        self.normativa = normativa
+
+
+# Sparisce da sola quando nessun carrello usa più il modello
+_info_articoli = weakref.WeakValueDictionary()
+_lock_info = threading.Lock()
+
+
+def info_articolo(articolo, immagine="", normativa=""):
+    chiave = (str(articolo), str(immagine or ""), str(normativa or ""))
+    with _lock_info:
+        info = _info_articoli.get(chiave)
+        if info is None:
+            info = InfoArticolo(*(sys.intern(t) for t in chiave))
+            _info_articoli[chiave] = info
+        return info
+
+
+class RigaCarrello:
+    """Una taglia (o un modello senza taglie) nel preventivo: modello condiviso, taglia, quantità e prezzo.
+
+    `manuale` è il netto scritto a mano dall'agente (None se calcolato dagli sconti): le righe
+    con il prezzo forzato non seguono i cambi di sconto, le altre sì.
+    """
+
+    __slots__ = ("info", "taglia", "quantita", "netto", "manuale")
+
+    def __init__(self, articolo, taglia, quantita, netto, immagine="", normativa="", manuale=None):
+        self.info = info_articolo(articolo, immagine, normativa)
+        self.taglia = sys.intern(taglia) if isinstance(taglia, str) else taglia
+        self.quantita = int(quantita)
+        self.netto = float(netto)
+        self.manuale = float(manuale) if manuale is not None and manuale > 0 else None
+
+    @property
+    def articolo(self):
+        return self.info.articolo
+
+    @property
+    def immagine(self):
+        return self.info.immagine
+
+    @property
+    def normativa(self):
+        return self.info.normativa
+
+    @property
+    def totale(self):
+        return self.netto * self.quantita
+
+    def come_dizionario(self):
+        """Formato "riga" del preventivo usato dal motore PDF."""
+        return {
+            "Articolo": self.articolo, "Taglia": self.taglia, "Quantità": self.quantita,
+            "Netto U.": self.netto, "Totale Riga": self.totale,
+            "Immagine": self.immagine, "Normativa": self.normativa, "Netto Manuale": self.manuale,
+        }
+
+
+class Carrello:
+    """Righe del preventivo con totale e raggruppamento per modello tenuti aggiornati a ogni modifica.
+
+    A ogni rerun la pagina legge valori già pronti invece di ricostruire DataFrame e raggruppi.
+    Tabella e righe in formato dizionario sono solo copie di comodo: libera() le butta
+    (sessione inattiva) e alla prima lettura si ricostruiscono.
+    """
+
+    def __init__(self):
+        self.righe = []
+        self.totale = 0.0
+        self._modelli = {}
+        self._raggruppo = {}
+        self._tabella = None
+        self._dizionari = None
+
+    def __len__(self):
+        return len(self.righe)
+
+    def __bool__(self):
+        return bool(self.righe)
+
+    def __iter__(self):
+        return iter(self.righe)
+
+    def _modificato(self, articolo):
+        # Si rifà solo il gruppo del modello toccato, gli altri restano come sono
+        righe = self._modelli.get(articolo)
+        if righe:
+            prima = righe[0]
+            self._raggruppo[articolo] = {
+                "T": [f"Q.tà: {r.quantita}pz" if r.taglia == "-" else f"Tg{r.taglia}: {r.quantita}pz"
+                      for r in righe if r.quantita > 0],
+                "Tot": sum(r.totale for r in righe),
+                "Img": prima.immagine,
+                "Netto": prima.netto,
+                "Normativa": prima.normativa,
+            }
+        else:
+            self._raggruppo.pop(articolo, None)
+        self.libera()
+
+    def libera(self):
+        self._tabella = None
+        self._dizionari = None
+
+    # --- MODIFICHE ---
+    def aggiungi(self, articolo, taglia, quantita, netto, immagine="", normativa="", manuale=None):
+        riga = RigaCarrello(articolo, taglia, quantita, netto, immagine, normativa, manuale)
+        self.righe.append(riga)
+        self.totale += riga.totale
+        self._modelli.setdefault(riga.articolo, []).append(riga)
+        self._modificato(riga.articolo)
+        return riga
+
+    def rimuovi(self, indice):
+        riga = self.righe.pop(indice)
+        self.totale -= riga.totale
+        gruppo = self._modelli[riga.articolo]
+        gruppo.remove(riga)
+        if not gruppo:
+            del self._modelli[riga.articolo]
+        if not self.righe:
+            self.totale = 0.0
+        self._modificato(riga.articolo)
+
+    def modifica_quantita(self, indice, quantita):
+        riga = self.righe[indice]
+        self.totale -= riga.totale
+        riga.quantita = int(quantita)
+        self.totale += riga.totale
+        self._modificato(riga.articolo)
+
+    def svuota(self):
+        self.__init__()
+
+    # --- LETTURA ---
+    def raggruppo(self):
+        """Stesso formato di preventivo_pdf.raggruppa_righe, già pronto: non va modificato da chi lo legge."""
+        return self._raggruppo
+
+    def righe_preventivo(self):
+        if self._dizionari is None:
+            self._dizionari = [r.come_dizionario() for r in self.righe]
+        return self._dizionari
+
+    def tabella(self):
+        """DataFrame del riepilogo, ricostruito solo quando il carrello cambia."""
+        if self._tabella is None:
+            import pandas as pd
+
+            self._tabella = pd.DataFrame({
+                "Articolo": [r.articolo for r in self.righe],
+                "Taglia": [r.taglia for r in self.righe],
+                "Quantità": [r.quantita for r in self.righe],
+                "Netto U.": [f"{r.netto:.2f} €" for r in self.righe],
+                "Totale Riga": [r.totale for r in self.righe],
+            })
+        return self._tabella
+
+    def byte(self):
+        """Memoria stimata della sessione per questo carrello: righe e copie di comodo.
+
+        I dati dei modelli (InfoArticolo) sono condivisi tra le sessioni e non si contano.
+        """
+        totale = sys.getsizeof(self.righe) + sum(
+            sys.getsizeof(r) + sys.getsizeof(r.netto) + sys.getsizeof(r.quantita) for r in self.righe)
+        totale += sum(sys.getsizeof(g) for g in self._modelli.values()) + sys.getsizeof(self._modelli)
+        totale += sys.getsizeof(self._raggruppo) + sum(
+            sys.getsizeof(g) + sys.getsizeof(g["T"]) + sum(sys.getsizeof(t) for t in g["T"]) for g in self._raggruppo.values())
+        if self._dizionari is not None:
+            totale += sys.getsizeof(self._dizionari) + sum(sys.getsizeof(d) for d in self._dizionari)
+        if self._tabella is not None:
+            totale += int(self._tabella.memory_usage(deep=True).sum())
+        return totale
+
+    def colonne(self):
+        """Articoli, quantità e netti delle righe come array, per i calcoli su tutto il carrello."""
+        import numpy as np
+
+        return ([r.articolo for r in self.righe],
+                np.array([r.quantita for r in self.righe], dtype=float),
+                np.array([r.netto for r in self.righe], dtype=float))
+
+    def manuali(self):
+        """Netto forzato a mano di ogni riga come array, NaN dove il netto è calcolato dagli sconti."""
+        import numpy as np
+
+        return np.array([np.nan if r.manuale is None else r.manuale for r in self.righe], dtype=float)
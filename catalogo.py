@@ -0,0 +1,279 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from ricerca import IndiceRicerca
+from strumentazione import cronometro
+
+CARTELLA = os.path.dirname(os.path.abspath(__file__))
+CARTELLA_SNAPSHOT = os.path.join(CARTELLA, ".cache_listini")
+
+LISTINI = {
+    'Listino_agente.xlsx': "base",
+    'Listino_ATG.xlsx': "atg",
+}
+
+
+# --- LETTURA DELL'EXCEL ---
+def leggi_excel(path, tipo="base"):
+    """Legge il listino Excel e normalizza i nomi delle colonne come li usa l'app."""
+    data = pd.read_excel(path)
+    if tipo == "atg":
+        data = data.iloc[:, :6]
+        data.columns = ['ARTICOLO', 'RIVESTIMENTO', 'QTA_BOX', 'RANGE_TAGLIE', 'LISTINO', 'IMMAGINE']
+    else:
+        nomi_colonne = [str(c).strip().upper() for c in data.columns]
+        if len(nomi_colonne) > 5:
+            nomi_colonne[5] = 'NORMATIVA'
+        data.columns = nomi_colonne
+
+    # Colonne di testo sempre stringhe pulite: niente NaN/None che diventano "nan" a video
+    data['ARTICOLO'] = data['ARTICOLO'].astype(str).str.strip()
+    for colonna in ('IMMAGINE', 'NORMATIVA'):
+        if colonna in data.columns:
+            data[colonna] = data[colonna].fillna("").astype(str).str.strip()
+    data['LISTINO'] = pd.to_numeric(data['LISTINO'], errors="coerce")
+    return data
+
+
+# --- SNAPSHOT BINARIO ---
+def _firma_file(path, vecchia=None):
+    """mtime e dimensione; l'hash si ricalcola solo se questi sono cambiati."""
+    info = os.stat(path)
+    firma = {"mtime": info.st_mtime, "dimensione": info.st_size}
+    if vecchia and vecchia.get("mtime") == firma["mtime"] and vecchia.get("dimensione") == firma["dimensione"]:
+        firma["sha256"] = vecchia.get("sha256")
+        return firma
+    with open(path, "rb") as f:
+        firma["sha256"] = hashlib.sha256(f.read()).hexdigest()
+    return firma
+
+
+def _percorsi_snapshot(path, tipo):
+    base = os.path.join(CARTELLA_SNAPSHOT, f"{os.path.basename(path)}.{tipo}")
+    return f"{base}.parquet", f"{base}.json"
+
+
+def costruisci_snapshot(path, tipo="base", forza=False):
+    """Converte il listino in Parquet se l'Excel è cambiato. Restituisce il percorso dello snapshot."""
+    os.makedirs(CARTELLA_SNAPSHOT, exist_ok=True)
+    percorso_dati, percorso_firma = _percorsi_snapshot(path, tipo)
+
+    vecchia = None
+    if os.path.exists(percorso_firma) and os.path.exists(percorso_dati):
+        try:
+            with open(percorso_firma, "r", encoding="utf-8") as f:
+                vecchia = json.load(f)
+        except (OSError, ValueError):
+            vecchia = None
+
+    firma = _firma_file(path, vecchia)
+    if not forza and vecchia and vecchia.get("sha256") == firma["sha256"]:
+        if vecchia != firma:
+            # Excel solo "toccato" (stesso contenuto): aggiorno la firma, niente riconversione
+            _scrivi_json(percorso_firma, firma)
+        return percorso_dati
+
+    data = leggi_excel(path, tipo)
+    tmp = f"{percorso_dati}.{os.getpid()}.tmp"
+    data.to_parquet(tmp, index=False)
+    os.replace(tmp, percorso_dati)
+    _scrivi_json(percorso_firma, firma)
+    return percorso_dati
+
+
+def _scrivi_json(percorso, contenuto):
+    tmp = f"{percorso}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(contenuto, f)
+    os.replace(tmp, percorso)
+
+
+def carica_listino(path, tipo="base"):
+    """Listino pronto all'uso: dallo snapshot Parquet, ricostruito solo se l'Excel è cambiato."""
+    return pd.read_parquet(costruisci_snapshot(path, tipo))
+
+
+# --- RICARICA A CALDO ---
+class Catalogo:
+    """Fotografia dei listini in un certo momento: DataFrame e indice di ricerca.
+
+    Non viene mai modificata; quando l'Excel cambia se ne costruisce una nuova e si sostituisce.
+    """
+
+    def __init__(self, df_base, df_atg, firme, errori=None):
+        self.df_base = df_base
+        self.df_atg = df_atg
+        self.firme = firme
+        self.errori = errori or {}
+        self.caricato = time.time()
+        self.indice = IndiceRicerca([("Listino Base", df_base), ("Listino ATG", df_atg)])
+        # Nome articolo -> (catalogo, riga); a parità di nome vince il listino Base come nella ricerca
+        self._per_nome = {}
+        for articolo, catalogo, riga in self.indice.voci:
+            self._per_nome.setdefault(articolo.strip().upper(), (catalogo, riga))
+        self._prezzi = None
+        self._schede = None
+        self._ricerche = OrderedDict()
+        self._lock_ricerche = threading.Lock()
+
+    def cerca(self, query, campi_extra=False, limite=50, memoria=256):
+        """Come IndiceRicerca.cerca, ma le ultime `memoria` ricerche restano pronte.
+
+        Il catalogo non cambia mai, quindi un risultato vale finché c'è lui: i rerun della pagina
+        (quantità, prezzi, sconti) e gli altri agenti che cercano lo stesso modello non rifanno la ricerca.
+        """
+        chiave = (query.strip().upper(), bool(campi_extra), limite)
+        with self._lock_ricerche:
+            if chiave in self._ricerche:
+                self._ricerche.move_to_end(chiave)
+                return self._ricerche[chiave]
+        risultati = self.indice.cerca(query, campi_extra=campi_extra, limite=limite)
+        with self._lock_ricerche:
+            self._ricerche[chiave] = risultati
+            while len(self._ricerche) > memoria:
+                self._ricerche.popitem(last=False)
+        return risultati
+
+    def trova(self, articolo):
+        """(nome catalogo, riga del listino) dell'articolo, oppure None se non c'è più."""
+        trovato = self._per_nome.get(str(articolo).strip().upper())
+        if trovato is None:
+            return None
+        catalogo, riga = trovato
+        df = self.df_base if catalogo == "Listino Base" else self.df_atg
+        return catalogo, df.iloc[riga]
+
+    def prezzi_listino(self, articoli):
+        """Prezzo di listino (NaN se l'articolo non c'è più) e listino Base sì/no di più articoli insieme."""
+        if self._prezzi is None:
+            parti = [
+                pd.DataFrame({"ARTICOLO": df['ARTICOLO'].str.strip().str.upper(),
+                              "LISTINO": df['LISTINO'], "BASE": nome == "Listino Base"})
+                for nome, df in (("Listino Base", self.df_base), ("Listino ATG", self.df_atg)) if df is not None
+            ]
+            prezzi = pd.concat(parti, ignore_index=True) if parti else pd.DataFrame(columns=["ARTICOLO", "LISTINO", "BASE"])
+            self._prezzi = prezzi.drop_duplicates("ARTICOLO").set_index("ARTICOLO")
+        chiavi = pd.Index([str(a) for a in articoli]).str.strip().str.upper()
+        trovati = self._prezzi.reindex(chiavi)
+        return trovati['LISTINO'].to_numpy(dtype=float), trovati['BASE'].fillna(False).to_numpy(dtype=bool)
+
+    def schede(self):
+        """Tutti gli articoli dei due listini in un'unica tabella per la galleria, Base prima di ATG."""
+        if self._schede is None:
+            parti = []
+            for nome, df, dettagli, taglie in (("Base", self.df_base, 'NORMATIVA', 'RANGE TAGLIE'),
+                                                ("ATG", self.df_atg, 'RIVESTIMENTO', 'RANGE_TAGLIE')):
+                if df is None:
+                    continue
+                parti.append(pd.DataFrame({
+                    "Listino": nome,
+                    "Articolo": df['ARTICOLO'],
+                    "Dettagli": df[dettagli].fillna("").astype(str) if dettagli in df.columns else "",
+                    "Taglie": df[taglie].fillna("").astype(str) if taglie in df.columns else "",
+                    "Prezzo Listino": df['LISTINO'],
+                    "Immagine": df['IMMAGINE'].fillna("").astype(str).str.strip() if 'IMMAGINE' in df.columns else "",
+                }))
+            colonne = ["Listino", "Articolo", "Dettagli", "Taglie", "Prezzo Listino", "Immagine"]
+            self._schede = pd.concat(parti, ignore_index=True) if parti else pd.DataFrame(columns=colonne)
+        return self._schede
+
+    def schede_trovate(self, filtro):
+        """Le schede che corrispondono a `filtro`, in ordine di pertinenza.
+
+        Stessa ricerca del campo in alto (indice di n-grammi, anche in normativa e rivestimento).
+        """
+        schede = self.schede()
+        righe_base = len(self.df_base) if self.df_base is not None else 0
+        posizioni = [r.riga if r.catalogo == "Listino Base" else righe_base + r.riga
+                     for r in self.cerca(filtro, campi_extra=True, limite=len(schede))]
+        return schede.iloc[posizioni]
+
+
+class GestoreCatalogo:
+    """Tiene d'occhio i file Excel e, se cambiano, ricostruisce il catalogo in background.
+
+    Le sessioni leggono sempre `corrente()`: il cambio è un solo assegnamento, quindi
+    chi è a metà rerun continua con i prezzi vecchi e al rerun successivo vede quelli nuovi.
+    """
+
+    def __init__(self, listini=None, intervallo=5):
+        self.listini = listini or {os.path.join(CARTELLA, nome): tipo for nome, tipo in LISTINI.items()}
+        self.intervallo = intervallo
+        self._lock = threading.Lock()
+        self._thread = None
+        self._corrente = self._costruisci(self._firme())
+
+    @staticmethod
+    def _firma(path):
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        return (info.st_mtime, info.st_size)
+
+    def _firme(self):
+        return {path: self._firma(path) for path in self.listini}
+
+    def _costruisci(self, firme):
+        dati, errori = {}, {}
+        for path, tipo in self.listini.items():
+            dati[tipo] = None
+            if firme[path] is None:
+                continue
+            try:
+                with cronometro("carica_dati", file=os.path.basename(path)):
+                    dati[tipo] = carica_listino(path, tipo)
+            except Exception as e:
+                errori[path] = str(e)
+        return Catalogo(dati.get("base"), dati.get("atg"), firme, errori)
+
+    def corrente(self):
+        return self._corrente
+
+    def controlla(self):
+        """Ricostruisce il catalogo se un Excel è cambiato. Restituisce True se c'è stato il cambio."""
+        with self._lock:
+            firme = self._firme()
+            vecchio = self._corrente
+            if firme == vecchio.firme:
+                return False
+            nuovo = self._costruisci(firme)
+            # Excel salvato a metà o illeggibile: tengo i dati vecchi di quel listino
+            # (la firma nuova evita di riprovare finché il file non cambia di nuovo)
+            if nuovo.errori:
+                df_base = nuovo.df_base if nuovo.df_base is not None else vecchio.df_base
+                df_atg = nuovo.df_atg if nuovo.df_atg is not None else vecchio.df_atg
+                nuovo = Catalogo(df_base, df_atg, firme, nuovo.errori)
+            self._corrente = nuovo
+            return True
+
+    def _sorveglia(self):
+        while True:
+            time.sleep(self.intervallo)
+            try:
+                self.controlla()
+            except Exception:
+                pass
+
+    def avvia(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sorveglia, name="sorveglia-listini", daemon=True)
+            self._thread.start()
+        return self
+
+
+if __name__ == "__main__":
+    # Passo di build: python catalogo.py [--forza]
+    forza = "--forza" in sys.argv[1:]
+    for nome_file, tipo in LISTINI.items():
+        if os.path.exists(nome_file):
+            print(f"{nome_file} -> {costruisci_snapshot(nome_file, tipo, forza=forza)}")
+        else:
+            print(f"{nome_file} non trovato, salto.")
@@ -0,0 +1,231 @@
+"""Controllo delle foto dei listini, da lanciare fuori orario (es. ogni notte da cron).
+
+Uso:
+    python controllo_immagini.py [--report .cache_immagini/controllo.csv] [--per-sito 2] [--intervallo 0.5]
+
+Interroga tutti gli URL della colonna IMMAGINE dei due listini, pochi alla volta per sito,
+e per ognuno annota stato, latenza, tipo e dimensione. Le foto buone finiscono nella cache
+locale insieme alla loro miniatura per la galleria del catalogo, quelle morte (404, pagine HTML
+al posto della foto, siti che non rispondono) vengono ricordate: durante il preventivo l'app
+le salta subito invece di aspettare il timeout.
+"""
+import argparse
+import csv
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import requests
+
+from catalogo import CARTELLA, LISTINI, carica_listino
+from immagini import CARTELLA_CACHE, cache_predefinita, crea_sessione
+
+FILE_REPORT = os.path.join(CARTELLA_CACHE, "controllo.csv")
+COLONNE_REPORT = ["url", "sito", "esito", "stato", "latenza_ms", "tipo", "byte", "errore", "articoli"]
+
+# Dopo tanti errori di rete di fila un sito si considera giù: i suoi URL restanti non si provano
+# (e non si segnano come morti in cache: restano come li ha lasciati il controllo precedente)
+MAX_ERRORI_SITO = 3
+# Un 429 o un 5xx vuol dire sito sovraccarico: prima della richiesta successiva si aspetta
+# PAUSA_SITO secondi, il doppio a ogni risposta così di fila
+PAUSA_SITO = 5.0
+
+
+def url_dei_listini(listini=None):
+    """{url: [articoli che la usano]} di tutti i listini presenti."""
+    listini = listini or {os.path.join(CARTELLA, nome): tipo for nome, tipo in LISTINI.items()}
+    articoli_per_url = {}
+    for path, tipo in listini.items():
+        if not os.path.exists(path):
+            continue
+        df = carica_listino(path, tipo)
+        if 'IMMAGINE' not in df.columns:
+            continue
+        for articolo, url in zip(df['ARTICOLO'], df['IMMAGINE'].fillna("").astype(str).str.strip()):
+            if url.startswith("http"):
+                articoli_per_url.setdefault(url, []).append(articolo)
+    return articoli_per_url
+
+
+def _esito(contenuto, stato):
+    if contenuto is not None:
+        return "ok"
+    if isinstance(stato, str):
+        # Con verifica, ottieni dà un testo al posto dello stato solo per le pagine che non sono foto
+        return "non immagine"
+    if stato in (403, 404, 410):
+        return "assente"
+    return "errore"
+
+
+def _sovraccarico(stato):
+    return isinstance(stato, int) and (stato == 429 or stato >= 500)
+
+
+def controlla_immagini(urls, cache=None, per_sito=2, intervallo=0.5, max_thread=16, timeout=10, avanzamento=None):
+    """Verifica gli URL e restituisce una riga di report per ciascuno.
+
+    Al massimo `per_sito` richieste insieme sullo stesso sito e almeno `intervallo` secondi
+    tra l'inizio di una richiesta e la successiva: i siti che limitano gli accessi non ci bloccano.
+    """
+    cache = cache or cache_predefinita()
+    avanzamento = avanzamento or (lambda fatti, totale, url: None)
+    distinti = list(dict.fromkeys(urls))
+    code = {}
+    for u in distinti:
+        code.setdefault(urlsplit(u).netloc, deque()).append(u)
+    attivi = {sito: 0 for sito in code}
+    prossimo_via = {sito: 0.0 for sito in code}
+    errori_di_fila = Counter()
+    report = []
+    lock = threading.Lock()
+    sessione = crea_sessione(max_thread)
+
+    def prossima():
+        # (sito, url) pronto a partire, (None, None) a lavoro finito, (None, attesa) se tutti i siti sono al limite
+        with lock:
+            adesso = time.monotonic()
+            attesa = None
+            for sito, coda in code.items():
+                if coda and errori_di_fila[sito] >= MAX_ERRORI_SITO:
+                    # Sito già dato per giù: l'URL si segna senza richiesta, niente attesa
+                    attivi[sito] += 1
+                    return sito, coda.popleft()
+                if not coda or attivi[sito] >= per_sito:
+                    continue
+                if prossimo_via[sito] > adesso:
+                    attesa = min(attesa or intervallo, prossimo_via[sito] - adesso)
+                    continue
+                attivi[sito] += 1
+                prossimo_via[sito] = adesso + intervallo
+                return sito, coda.popleft()
+            if any(code.values()):
+                return None, attesa or 0.05
+            return None, None
+
+    def aggiungi(riga):
+        with lock:
+            report.append(riga)
+            fatti = len(report)
+        avanzamento(fatti, len(distinti), riga["url"])
+
+    def controlla():
+        while True:
+            sito, url = prossima()
+            if sito is None:
+                if url is None:
+                    return
+                time.sleep(url)
+                continue
+            riga = {"url": url, "sito": sito, "stato": None, "latenza_ms": None, "tipo": None, "byte": None, "errore": None}
+            try:
+                if errori_di_fila[sito] >= MAX_ERRORI_SITO:
+                    riga["errore"] = "sito irraggiungibile"
+                    riga["esito"] = "non provato"
+                    continue
+                inizio = time.perf_counter()
+                try:
+                    contenuto, stato = cache.ottieni(url, timeout=timeout, sessione=sessione, verifica=True)
+                except requests.RequestException as e:
+                    riga["latenza_ms"] = round((time.perf_counter() - inizio) * 1000)
+                    riga["errore"] = "timeout" if isinstance(e, requests.Timeout) else type(e).__name__
+                    if not cache.segna_irraggiungibile(url, riga["errore"]):
+                        riga["errore"] += " (in cache resta la foto dell'ultimo controllo)"
+                    riga["esito"] = "irraggiungibile"
+                    with lock:
+                        errori_di_fila[sito] += 1
+                    continue
+                riga["latenza_ms"] = round((time.perf_counter() - inizio) * 1000)
+                with lock:
+                    if _sovraccarico(stato):
+                        errori_di_fila[sito] += 1
+                        pausa = PAUSA_SITO * 2 ** (errori_di_fila[sito] - 1)
+                        prossimo_via[sito] = max(prossimo_via[sito], time.monotonic() + pausa)
+                    else:
+                        errori_di_fila[sito] = 0
+                riga["esito"] = _esito(contenuto, stato)
+                if contenuto is not None:
+                    cache.miniatura(url)
+                    meta = cache.meta(url) or {}
+                    riga.update(stato=200, tipo=meta.get("tipo"), byte=len(contenuto))
+                elif isinstance(stato, str):
+                    # Pagina al posto della foto: la risposta appena ricevuta è quella in cache
+                    meta = cache.meta(url) or {}
+                    riga.update(stato=meta.get("stato"), tipo=meta.get("tipo"), byte=meta.get("byte"), errore=stato)
+                else:
+                    riga.update(stato=stato, errore=f"HTTP {stato}")
+                    meta = cache.meta(url) or {}
+                    if meta.get("stato") == 200 and not meta.get("errore"):
+                        riga["errore"] += " (in cache resta la foto dell'ultimo controllo)"
+            except Exception as e:
+                riga.update(esito="errore", errore=str(e))
+            finally:
+                with lock:
+                    attivi[sito] -= 1
+                aggiungi(riga)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_thread, thread_name_prefix="controllo-foto") as esecutore:
+            for _ in range(min(max_thread, len(distinti))):
+                esecutore.submit(controlla)
+    finally:
+        sessione.close()
+    return sorted(report, key=lambda r: (r["esito"] != "ok", r["sito"], r["url"]))
+
+
+def scrivi_report(report, articoli_per_url, percorso=FILE_REPORT):
+    os.makedirs(os.path.dirname(os.path.abspath(percorso)), exist_ok=True)
+    tmp = f"{percorso}.{os.getpid()}.tmp"
+    with open(tmp, "w", newline="", encoding="utf-8") as f:
+        scrittore = csv.DictWriter(f, fieldnames=COLONNE_REPORT)
+        scrittore.writeheader()
+        for riga in report:
+            scrittore.writerow({**riga, "articoli": "; ".join(articoli_per_url.get(riga["url"], []))})
+    os.replace(tmp, percorso)
+    return percorso
+
+
+def leggi_report(percorso=FILE_REPORT):
+    """(data dell'ultimo controllo, righe del report), oppure (None, []) se non è mai stato fatto."""
+    try:
+        with open(percorso, newline="", encoding="utf-8") as f:
+            righe = list(csv.DictReader(f))
+        return datetime.fromtimestamp(os.path.getmtime(percorso)), righe
+    except OSError:
+        return None, []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Controlla le foto dei listini e riempie la cache locale.")
+    parser.add_argument("--report", default=FILE_REPORT, help="file CSV del report")
+    parser.add_argument("--per-sito", type=int, default=2, help="richieste contemporanee per sito")
+    parser.add_argument("--intervallo", type=float, default=0.5, help="secondi minimi tra due richieste allo stesso sito")
+    parser.add_argument("--timeout", type=float, default=10, help="timeout di ogni richiesta in secondi")
+    args = parser.parse_args(argv)
+
+    articoli_per_url = url_dei_listini()
+    inizio = time.perf_counter()
+
+    def avanzamento(fatti, totale, url):
+        if fatti % 50 == 0 or fatti == totale:
+            print(f"{fatti}/{totale} controllate")
+
+    report = controlla_immagini(articoli_per_url, per_sito=args.per_sito, intervallo=args.intervallo,
+                                timeout=args.timeout, avanzamento=avanzamento)
+    percorso = scrivi_report(report, articoli_per_url, args.report)
+
+    conteggi = Counter(r["esito"] for r in report)
+    print(", ".join(f"{esito}: {n}" for esito, n in conteggi.most_common()) or "nessuna foto nei listini")
+    for sito, n in Counter(r["sito"] for r in report if r["esito"] != "ok").most_common(10):
+        print(f"  {sito}: {n} foto non disponibili")
+    print(f"Controllo finito in {time.perf_counter() - inizio:.1f}s. Report: {percorso}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
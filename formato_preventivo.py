@@ -0,0 +1,67 @@
+import hashlib
+import json
+from datetime import datetime
+
+# Parte leggera del preventivo (formato, nomi, impronta): la usa la pagina a ogni rerun
+# senza dover caricare fpdf, che serve solo quando si impagina davvero.
+
+NOMI_ESPOSITORI = {
+    "ATG banco.jpg": "Espositore ATG girevole da Banco",
+    "ATG terra.jpg": "Espositore ATG in Metallo da Terra",
+    "Base banco.jpg": "Espositore BASE da Banco 1 Modello",
+    "BASE terra.jpg": "Espositore BASE da terra 7 modelli"
+}
+
+# Un preventivo è un dizionario semplice:
+#   cliente, referente, note, pagamento, trasporto, validita: testo
+#   espositori: lista dei file jpg degli espositori in omaggio
+#   righe: righe del carrello ("Articolo", "Taglia", "Quantità", "Netto U.", "Totale Riga", "Immagine", "Normativa"),
+#          con "Netto U." e "Totale Riga" numerici
+
+
+def raggruppa_righe(righe):
+    """Una voce per modello con le taglie, il subtotale, la foto e il prezzo netto."""
+    raggruppo = {}
+    for r in righe:
+        art = r["Articolo"]
+        if art not in raggruppo:
+            raggruppo[art] = {
+                "T": [], 
+                "Tot": 0, 
+                "Img": r["Immagine"], 
+                "Netto": r["Netto U."],
+                "Normativa": r.get("Normativa", "")
+            }
+        
+        if r["Quantità"] > 0:
+            if r["Taglia"] == "-":
+                raggruppo[art]["T"].append(f"Q.tà: {r['Quantità']}pz")
+            else:
+                raggruppo[art]["T"].append(f"Tg{r['Taglia']}: {r['Quantità']}pz")
+        
+        raggruppo[art]["Tot"] += r["Totale Riga"]
+    return raggruppo
+
+
+def _nome_sicuro(testo):
+    return "".join(x for x in testo if x.isalnum() or x in " -_").strip().replace(" ", "_")
+
+
+def nome_file_pdf(cliente, data=None, suffisso=""):
+    """Nome del PDF: cliente e data, più `suffisso` (es. il numero d'ordine) se dato."""
+    data_oggi = (data or datetime.now()).strftime("%d.%m.%Y")
+    nome_sicuro = _nome_sicuro(cliente) or "Cliente"
+    suffisso = _nome_sicuro(suffisso)
+    if suffisso:
+        return f"{nome_sicuro}_{data_oggi}_{suffisso}.pdf"
+    return f"{nome_sicuro}_{data_oggi}.pdf"
+
+
+def impronta_preventivo(preventivo, data=None):
+    """Hash del contenuto del preventivo: stesso carrello, cliente, espositori e note = stesso PDF.
+
+    Entra anche la data, che è stampata nell'intestazione.
+    """
+    dati = dict(preventivo, data=(data or datetime.now()).strftime("%Y-%m-%d"))
+    testo = json.dumps(dati, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(testo.encode("utf-8")).hexdigest()
@@ -1,12 +1,20 @@
 import streamlit as st
-import pandas as pd
-import requests
-import base64
+import importlib
 import os
-import tempfile
-from fpdf import FPDF
-from datetime import datetime
 from io import BytesIO
+from pathlib import Path
+import uuid
+# Solo moduli leggeri qui: pandas arriva con il catalogo (dopo la sidebar),
+# fpdf al primo PDF, requests alla prima anteprima foto
+from carrello import Carrello
+from sessioni import CacheSessione, RegistroSessioni
+from archivio import Archivio, riprezza
+from prezzi import SCONTI_DEFAULT_ATG, SCONTI_DEFAULT_BASE, confronta_sconti, netti_fermi, prezzo_netto
+from risorse import data_uri
+from strumentazione import collega_sessione, cronometro, nuovo_registro, riepilogo_fasi, riepilogo_host
+from lavori import CodaPiena, Smistatore, avvia_lavoro_listino, avvia_lavoro_pacchetto, avvia_lavoro_pdf
+from formato_preventivo import NOMI_ESPOSITORI, impronta_preventivo, nome_file_pdf
+from lista_clienti import CARTELLA_PACCHETTI, clienti_da_tabella, leggi_clienti, pulisci_pacchetti
 
 # Configurazione della pagina
 st.set_page_config(page_title="Generatore Preventivi", layout="wide", page_icon="📄")
@@ -35,65 +43,150 @@ button[kind="primary"]:hover {
 
 # --- INIZIALIZZAZIONE DELLA MEMORIA ---
 if 'carrello' not in st.session_state:
-    st.session_state['carrello'] = []
+    st.session_state['carrello'] = Carrello()
 
 if 'espositori_selezionati' not in st.session_state:
     st.session_state['espositori_selezionati'] = []
 
-# --- CARICAMENTO DATI ---
-@st.cache_data
-def carica_dati(path, tipo="base"):
-    if not os.path.exists(path):
-        return None
-    try:
-        data = pd.read_excel(path)
-        if tipo == "atg":
-            data = data.iloc[:, :6]
-            data.columns = ['ARTICOLO', 'RIVESTIMENTO', 'QTA_BOX', 'RANGE_TAGLIE', 'LISTINO', 'IMMAGINE']
-        else:
-            nomi_colonne = [str(c).strip().upper() for c in data.columns]
-            if len(nomi_colonne) > 5:
-                nomi_colonne[5] = 'NORMATIVA' 
-            data.columns = nomi_colonne
-        return data
-    except Exception as e:
-        st.error(f"Errore nel caricamento del file {path}: {e}")
-        return None
-
-df_base = carica_dati('Listino_agente.xlsx', "base")
-df_atg = carica_dati('Listino_ATG.xlsx', "atg")
-
-# --- HEADERS PER INGANNARE I SITI DI HOSTING ---
-miei_headers = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36',
-    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
-    'Referer': 'https://postimg.cc/'
+# Valori iniziali dei campi della sidebar (in session_state così la ricarica dall'archivio può riempirli)
+VALORI_INIZIALI = {
+    "nome_cliente": "", "nome_referente": "",
+    "sc_base1": SCONTI_DEFAULT_BASE[0], "sc_base2": SCONTI_DEFAULT_BASE[1], "sc_base3": SCONTI_DEFAULT_BASE[2],
+    "sc_atg1": SCONTI_DEFAULT_ATG[0], "sc_atg2": SCONTI_DEFAULT_ATG[1], "sc_atg3": SCONTI_DEFAULT_ATG[2],
+    "campo_pagamento": "Ri.Ba. 60 giorni", "campo_trasporto": "P.to Franco", "campo_validita": "30.06.2026",
+    "note_preventivo": "",
 }
+for chiave_campo, valore_campo in VALORI_INIZIALI.items():
+    if chiave_campo not in st.session_state:
+        st.session_state[chiave_campo] = valore_campo
+
+# Risultati ricostruibili della sessione (PDF pronti per impronta, listino, anteprima foto):
+# il registro delle sessioni li butta se la scheda resta ferma o il server è a corto di memoria
+if 'cache' not in st.session_state:
+    st.session_state['cache'] = CacheSessione()
+cache_sessione = st.session_state['cache']
+
+if 'lavoro_pdf' not in st.session_state:
+    st.session_state['lavoro_pdf'] = None
+
+# Tempi delle fasi lente di questa sessione (pannello admin nella sidebar)
+if 'metriche' not in st.session_state:
+    st.session_state['metriche'] = nuovo_registro()
+collega_sessione(st.session_state['metriche'])
+
+PDF_PRONTI_MAX = 5
+
+def salva_pdf_pronto(chiave, pdf_bytes):
+    pronti = cache_sessione.setdefault('pdf_pronti', {})
+    pronti[chiave] = pdf_bytes
+    while len(pronti) > PDF_PRONTI_MAX:
+        pronti.pop(next(iter(pronti)))
+
+# Identificativo della sessione per dividere equamente il lavoro tra gli utenti
+if 'id_sessione' not in st.session_state:
+    st.session_state['id_sessione'] = uuid.uuid4().hex
+
+# Memoria delle sessioni del processo: chi è fermo da PREVENTIVI_TTL_SESSIONE secondi (30 minuti)
+# perde i risultati ricostruibili, e oltre PREVENTIVI_MAX_MB in totale si parte dai meno recenti
+@st.cache_resource
+def registro_sessioni():
+    return RegistroSessioni(ttl=int(os.environ.get("PREVENTIVI_TTL_SESSIONE", "1800")),
+                            max_byte=int(os.environ.get("PREVENTIVI_MAX_MB", "256")) * 1024 * 1024)
+
+registro_sessioni().tocca(st.session_state['id_sessione'], cache_sessione, st.session_state['carrello'])
+
+# Lavori pesanti (PDF, listini) su un pool condiviso da tutte le sessioni, con coda e turni.
+# Con più agenti sullo stesso server: PREVENTIVI_PROCESSI=n impagina in n processi separati
+# (uno per core), PREVENTIVI_THREAD fissa quanti lavori possono essere in corso insieme.
+@st.cache_resource
+def smistatore():
+    processi = int(os.environ.get("PREVENTIVI_PROCESSI", "0") or 0)
+    max_thread = int(os.environ.get("PREVENTIVI_THREAD", "0") or 0) or max(4, processi)
+    return Smistatore(max_thread=max_thread, processi=processi)
+
+def _precarica_fpdf():
+    # Come in avvia_lavoro_pdf: sotto Streamlit la cartella dello script può essere nel percorso
+    # di import solo durante il rerun, quindi preventivo_pdf (e fpdf) si importa qui, nel thread
+    # della pagina, prima di mandare al pool un lavoro che lo usa
+    importlib.import_module("preventivo_pdf")
+
+# Barra di un lavoro in background: si aggiorna da sola e a lavoro finito ridisegna la pagina
+@st.fragment(run_every=0.5)
+def mostra_avanzamento(lavoro, titolo, unita):
+    if lavoro.finito:
+        st.rerun()
+    if lavoro.in_coda:
+        st.progress(0.0, text="⏳ In coda: il server sta finendo altri documenti...")
+    else:
+        st.progress(lavoro.percentuale, text=f"⏳ {titolo}: {lavoro.fatti}/{lavoro.totale} {unita} - {lavoro.messaggio}")
+
+# --- CARICAMENTO DATI ---
+# Un solo gestore per processo, condiviso da tutte le sessioni: se un Excel cambia
+# lo ricarica in background e al rerun successivo tutti vedono i prezzi nuovi.
+# Si legge più sotto, dopo sidebar e intestazione: la pagina compare prima di pandas e listini.
+@st.cache_resource
+def gestore_catalogo():
+    from catalogo import GestoreCatalogo
+
+    return GestoreCatalogo().avvia()
+
+MAX_RISULTATI = 50
+
+# --- ARCHIVIO PREVENTIVI ---
+@st.cache_resource
+def archivio_preventivi():
+    return Archivio()
+
+def ricarica_preventivo(id_preventivo):
+    # Callback del bottone: gira prima dei widget, quindi può riempire i campi della sidebar
+    salvato = archivio_preventivi().carica(id_preventivo)
+    if salvato is None:
+        return
+    righe, mancanti = riprezza(salvato, gestore_catalogo().corrente())
+    carrello = Carrello()
+    for r in righe:
+        carrello.aggiungi(**r)
+    st.session_state['carrello'] = carrello
+    st.session_state['espositori_selezionati'] = list(salvato["espositori"])
+    st.session_state["nome_cliente"] = salvato["cliente"]
+    st.session_state["nome_referente"] = salvato["referente"] or ""
+    for i, valore in enumerate(salvato["sconti_base"], start=1):
+        st.session_state[f"sc_base{i}"] = float(valore)
+    for i, valore in enumerate(salvato["sconti_atg"], start=1):
+        st.session_state[f"sc_atg{i}"] = float(valore)
+    st.session_state["campo_pagamento"] = salvato["pagamento"] or ""
+    st.session_state["campo_trasporto"] = salvato["trasporto"] or ""
+    st.session_state["campo_validita"] = salvato["validita"] or ""
+    st.session_state["note_preventivo"] = salvato["note"] or ""
+    messaggio = f"Preventivo n. {id_preventivo} ricaricato e ricalcolato sul listino attuale."
+    if mancanti:
+        messaggio += f" Articoli non più a listino: {', '.join(sorted(set(mancanti)))}"
+    st.session_state['avviso_archivio'] = messaggio
 
 # =========================================================
 # --- SIDEBAR: DATI CLIENTE, SCONTI, NOTE E ESPOSITORI ---
 # =========================================================
 st.sidebar.header("📋 Dati Documento")
-nome_cliente = st.sidebar.text_input("Nome del Cliente:", placeholder="Ragione Sociale...")
-nome_referente = st.sidebar.text_input("Nome Referente:", placeholder="Mario Rossi...")
+nome_cliente = st.sidebar.text_input("Nome del Cliente:", placeholder="Ragione Sociale...", key="nome_cliente")
+nome_referente = st.sidebar.text_input("Nome Referente:", placeholder="Mario Rossi...", key="nome_referente")
 
 st.sidebar.divider()
 
 # Sconti Base
 st.sidebar.header("💰 Sconto Base")
 col_sc1, col_sc2, col_sc3 = st.sidebar.columns(3)
-sc1 = col_sc1.number_input("Sc. 1 %", 0.0, 100.0, 40.0, key="sc_base1")
-sc2 = col_sc2.number_input("Sc. 2 %", 0.0, 100.0, 10.0, key="sc_base2")
-sc3 = col_sc3.number_input("Sc. 3 %", 0.0, 100.0, 0.0, key="sc_base3")
+sc1 = col_sc1.number_input("Sc. 1 %", 0.0, 100.0, key="sc_base1")
+sc2 = col_sc2.number_input("Sc. 2 %", 0.0, 100.0, key="sc_base2")
+sc3 = col_sc3.number_input("Sc. 3 %", 0.0, 100.0, key="sc_base3")
 
 st.sidebar.divider()
 
 # Sconti ATG
 st.sidebar.header("🧤 Sconto ATG")
 col_atg1, col_atg2, col_atg3 = st.sidebar.columns(3)
-sc_atg1 = col_atg1.number_input("Sc. ATG 1 %", 0.0, 100.0, 40.0, key="sc_atg1")
-sc_atg2 = col_atg2.number_input("Sc. ATG 2 %", 0.0, 100.0, 10.0, key="sc_atg2")
-sc_atg3 = col_atg3.number_input("Sc. ATG 3 %", 0.0, 100.0, 0.0, key="sc_atg3")
+sc_atg1 = col_atg1.number_input("Sc. ATG 1 %", 0.0, 100.0, key="sc_atg1")
+sc_atg2 = col_atg2.number_input("Sc. ATG 2 %", 0.0, 100.0, key="sc_atg2")
+sc_atg3 = col_atg3.number_input("Sc. ATG 3 %", 0.0, 100.0, key="sc_atg3")
 
 st.sidebar.divider()
 
@@ -127,15 +220,8 @@ with col_esp4:
 if st.session_state['espositori_selezionati']:
     st.sidebar.markdown("**Espositori inclusi nel preventivo:**")
     
-    nomi_belli = {
-        "ATG banco.jpg": "Espositore ATG girevole da Banco",
-        "ATG terra.jpg": "Espositore ATG in Metallo da Terra",
-        "Base banco.jpg": "Espositore BASE da Banco 1 Modello",
-        "BASE terra.jpg": "Espositore BASE da terra 7 modelli"
-    }
-    
     for esp in st.session_state['espositori_selezionati']:
-        st.sidebar.success(f"✅ {nomi_belli.get(esp, esp)}")
+        st.sidebar.success(f"✅ {NOMI_ESPOSITORI.get(esp, esp)}")
         
     if st.sidebar.button("❌ Rimuovi Tutti gli Espositori"):
         st.session_state['espositori_selezionati'] = []
@@ -145,13 +231,52 @@ st.sidebar.divider()
 
 # --- CAMPI: CONDIZIONI COMMERCIALI CON VALORI DI DEFAULT ---
 st.sidebar.header("⚖️ Condizioni Commerciali")
-campo_pagamento = st.sidebar.text_input("Pagamento:", value="Ri.Ba. 60 giorni")
-campo_trasporto = st.sidebar.text_input("Trasporto:", value="P.to Franco")
-campo_validita = st.sidebar.text_input("Validità Offerta:", value="30.06.2026")
+campo_pagamento = st.sidebar.text_input("Pagamento:", key="campo_pagamento")
+campo_trasporto = st.sidebar.text_input("Trasporto:", key="campo_trasporto")
+campo_validita = st.sidebar.text_input("Validità Offerta:", key="campo_validita")
 
 st.sidebar.divider()
 
-note_preventivo = st.sidebar.text_area("📝 Note Aggiuntive (verranno inserite a fine PDF):", height=200, placeholder="Scrivi qui le tue note...")
+note_preventivo = st.sidebar.text_area("📝 Note Aggiuntive (verranno inserite a fine PDF):", height=200, placeholder="Scrivi qui le tue note...", key="note_preventivo")
+
+# --- PANNELLO TEMPI (solo admin: ?admin=1 nell'indirizzo o PREVENTIVI_ADMIN=1) ---
+if st.query_params.get("admin") == "1" or os.environ.get("PREVENTIVI_ADMIN") == "1":
+    def tabella_tempi(righe, etichetta, quante=8):
+        return [
+            {etichetta: r["chiave"], "Volte": r["conteggio"], "Totale s": round(r["totale"], 3),
+             "Media ms": round(r["media"] * 1000, 1), "Max ms": round(r["massimo"] * 1000, 1)}
+            for r in righe[:quante]
+        ]
+
+    with st.sidebar.expander("⏱️ Tempi (admin)"):
+        st.markdown("**Questa sessione - fasi**")
+        st.dataframe(tabella_tempi(riepilogo_fasi(st.session_state['metriche']), "Fase"), hide_index=True)
+        st.markdown("**Questa sessione - siti foto**")
+        st.dataframe(tabella_tempi(riepilogo_host(st.session_state['metriche']), "Sito"), hide_index=True)
+        st.markdown("**Tutte le sessioni - fasi**")
+        st.dataframe(tabella_tempi(riepilogo_fasi(), "Fase"), hide_index=True)
+        st.markdown("**Tutte le sessioni - siti foto**")
+        st.dataframe(tabella_tempi(riepilogo_host(), "Sito"), hide_index=True)
+        st.markdown("**Lavori condivisi**")
+        st.json(smistatore().stato())
+        st.markdown("**Memoria delle sessioni**")
+        st.dataframe(registro_sessioni().stato(), hide_index=True)
+
+        # Esito dell'ultimo controllo notturno delle foto: gli URL morti l'app li salta senza aspettare
+        from controllo_immagini import leggi_report
+
+        st.markdown("**Foto dei listini**")
+        data_controllo, report_foto = leggi_report()
+        if data_controllo is None:
+            st.caption("Mai controllate: lanciare `python controllo_immagini.py`.")
+        else:
+            esiti = {}
+            for r in report_foto:
+                esiti[r["esito"]] = esiti.get(r["esito"], 0) + 1
+            st.caption(f"Controllo del {data_controllo:%d.%m.%Y %H:%M} - "
+                       + ", ".join(f"{esito}: {n}" for esito, n in esiti.items()))
+            st.dataframe([{"Articoli": r["articoli"], "Esito": r["esito"], "Errore": r["errore"] or r["stato"], "URL": r["url"]}
+                          for r in report_foto if r["esito"] != "ok"], hide_index=True)
 
 # =========================================================
 # --- PAGINA PRINCIPALE: RICERCA UNIFICATA ---
@@ -161,11 +286,12 @@ note_preventivo = st.sidebar.text_area("📝 Note Aggiuntive (verranno inserite
 michelone_logo = "michelone.jpg"
 logo_html = ""
 
-if os.path.exists(michelone_logo):
-    with open(michelone_logo, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode()
+# Rimpicciolito una volta per processo a 200px (il doppio della larghezza a video, nitido anche su schermi retina):
+# qualche KB per rerun invece dei ~700 KB del file originale codificato
+michelone_src = data_uri(michelone_logo, larghezza_px=200)
+if michelone_src:
     # margin-left a 100px per staccarlo dal testo del titolo, width a 100px per la grandezza
-    logo_html = f'<img src="data:image/jpeg;base64,{encoded_string}" style="width: 100px; border-radius: 8px; margin-left: 100px; box-shadow: 0 2px 4px rgba(0,0,0,0.2);">'
+    logo_html = f'<img src="{michelone_src}" style="width: 100px; border-radius: 8px; margin-left: 100px; box-shadow: 0 2px 4px rgba(0,0,0,0.2);">'
 else:
     logo_html = '<span style="color:red; margin-left: 100px;">⚠️ Michelone assente</span>'
 
@@ -180,33 +306,271 @@ st.markdown(
 )
 
 
+with st.expander("📚 Archivio Preventivi"):
+    col_arch1, col_arch2 = st.columns(2)
+    filtro_cliente = col_arch1.text_input("Cliente inizia per:", key="arch_cliente")
+    filtro_articolo = col_arch2.text_input("Contiene l'articolo (inizio del codice):", key="arch_articolo")
+    storico = archivio_preventivi().cerca(filtro_cliente, filtro_articolo, limite=20)
+    if storico:
+        etichette = {
+            p["id"]: f"n. {p['id']} - {p['creato'][:10]} - {p['cliente'] or 'Cliente'} - {p['righe']} righe - {p['totale']:.2f} €"
+            for p in storico
+        }
+        scelta_arch = st.selectbox("Preventivi salvati:", list(etichette), format_func=etichette.get, key="arch_scelta")
+        st.button("↩️ Ricarica nel carrello (prezzi aggiornati)", on_click=ricarica_preventivo, args=(scelta_arch,))
+    else:
+        st.caption("Nessun preventivo salvato con questi filtri.")
+
+catalogo_attuale = gestore_catalogo().corrente()
+df_base = catalogo_attuale.df_base
+df_atg = catalogo_attuale.df_atg
+
+for path_errore, errore in catalogo_attuale.errori.items():
+    st.error(f"Errore nel caricamento del file {os.path.basename(path_errore)}: {errore}")
+
+# --- LISTINO SCONTATO DA CONSEGNARE AL CLIENTE ---
+def prezzi_manuali_carrello():
+    """{articolo: netto} dei modelli nel carrello con il prezzo forzato a mano."""
+    carrello = st.session_state['carrello']
+    return {r.articolo: r.manuale for r in carrello if r.manuale is not None}
+
+if df_base is not None or df_atg is not None:
+    from listino_cliente import FORMATI, esporta_listino, listino_per_cliente
+
+    with st.expander("💶 Listino Scontato per il Cliente"):
+        st.caption("Tutto il catalogo con gli sconti della sidebar applicati.")
+        col_lst1, col_lst2 = st.columns(2)
+        formato_listino = col_lst1.radio("Formato:", list(FORMATI), horizontal=True, key="formato_listino")
+        con_manuali = col_lst2.checkbox("Usa i prezzi forzati a mano nel carrello", value=True, key="listino_manuali")
+        manuali = prezzi_manuali_carrello() if con_manuali else {}
+        chiave_listino = (formato_listino, (sc1, sc2, sc3), (sc_atg1, sc_atg2, sc_atg3), tuple(sorted(manuali.items())),
+                          catalogo_attuale.caricato, nome_cliente, nome_referente)
+        lavoro_listino = st.session_state.get('lavoro_listino')
+        if st.button("Prepara il listino", key="prepara_listino"):
+            if lavoro_listino is None or lavoro_listino.chiave != chiave_listino:
+                if lavoro_listino is not None:
+                    lavoro_listino.futuro.cancel()
+                with cronometro("listino_cliente", formato=formato_listino):
+                    tabella_listino = listino_per_cliente(catalogo_attuale, (sc1, sc2, sc3), (sc_atg1, sc_atg2, sc_atg3), manuali)
+                if formato_listino == "PDF":
+                    _precarica_fpdf()
+                try:
+                    lavoro_listino = avvia_lavoro_listino(
+                        smistatore(), st.session_state['id_sessione'], chiave_listino, esporta_listino,
+                        (tabella_listino, formato_listino, nome_cliente, nome_referente), len(tabella_listino))
+                except CodaPiena as e:
+                    lavoro_listino = None
+                    st.warning(f"⏳ {e}")
+                st.session_state['lavoro_listino'] = lavoro_listino
+
+        # Il listino si prepara in background: la pagina resta libera e la barra avanza da sola
+        if lavoro_listino is not None and lavoro_listino.chiave == chiave_listino:
+            if lavoro_listino.finito:
+                try:
+                    cache_sessione['listino_pronto'] = (chiave_listino, lavoro_listino.risultato())
+                except Exception as e:
+                    st.error(f"Errore nella preparazione del listino: {e}")
+                st.session_state['lavoro_listino'] = None
+            else:
+                mostra_avanzamento(lavoro_listino, "Preparo il listino", "righe")
+        pronto = cache_sessione.get('listino_pronto')
+        if pronto is not None and pronto[0] == chiave_listino:
+            estensione, tipo_mime = FORMATI[formato_listino]
+            nome_listino = nome_file_pdf(nome_cliente).replace(".pdf", f"_listino.{estensione}")
+            st.download_button(f"⬇️ Scarica '{nome_listino}'", data=pronto[1], file_name=nome_listino,
+                               mime=tipo_mime, key="scarica_listino")
+
+# --- GALLERIA DEL CATALOGO (solo foto già in cache locale, niente rete) ---
+FOTO_PER_PAGINA = 24
+
+def apri_dalla_galleria(articolo):
+    # Callback: porta l'articolo nella ricerca qui sotto, dove si inseriscono le taglie
+    st.session_state['ricerca'] = articolo
+    st.session_state['galleria_apri'] = True
+
+@st.fragment
+def galleria(catalogo, sconti_base, sconti_atg):
+    # Sfogliare e filtrare riesegue solo la galleria; "Apri" ridisegna la pagina con l'articolo scelto
+    if st.session_state.pop('galleria_apri', False):
+        st.rerun()
+    from immagini import cache_predefinita
+    from prezzi import moltiplicatore_sconto
+
+    col_g1, col_g2, col_g3 = st.columns([1, 2, 1])
+    quale = col_g1.radio("Listino:", ["Tutti", "Base", "ATG"], horizontal=True, key="galleria_listino")
+    filtro = col_g2.text_input("Filtra per nome, normativa o rivestimento:", key="galleria_filtro").strip().upper()
+    # Il filtro passa dall'indice di ricerca del catalogo (e dalla sua memoria delle ricerche recenti)
+    schede = catalogo.schede_trovate(filtro) if filtro else catalogo.schede()
+    if quale != "Tutti":
+        schede = schede[schede['Listino'] == quale]
+    pagine = max(1, -(-len(schede) // FOTO_PER_PAGINA))
+    if st.session_state.get('galleria_pagina', 1) > pagine:
+        st.session_state['galleria_pagina'] = 1
+    pagina = col_g3.number_input(f"Pagina (di {pagine}):", min_value=1, max_value=pagine, step=1, key="galleria_pagina")
+    st.caption(f"{len(schede)} articoli")
+
+    # Solo le miniature della pagina a video, lette dal disco
+    cache = cache_predefinita()
+    moltiplicatori = {"Base": moltiplicatore_sconto(*sconti_base), "ATG": moltiplicatore_sconto(*sconti_atg)}
+    inizio = (pagina - 1) * FOTO_PER_PAGINA
+    voci = schede.iloc[inizio:inizio + FOTO_PER_PAGINA].to_dict("records")
+    for i in range(0, len(voci), 4):
+        for j, (colonna, voce) in enumerate(zip(st.columns(4), voci[i:i + 4])):
+            with colonna:
+                miniatura = cache.miniatura(voce['Immagine']) if voce['Immagine'].startswith("http") else None
+                if miniatura is not None:
+                    st.image(BytesIO(miniatura), use_container_width=True)
+                else:
+                    st.caption("📷 Foto non ancora in archivio")
+                st.markdown(f"**{voce['Articolo']}**")
+                st.caption(" | ".join(t for t in (voce['Dettagli'], voce['Taglie']) if t.strip()) or voce['Listino'])
+                listino = voce['Prezzo Listino']
+                if listino == listino:
+                    st.caption(f"Listino {listino:.2f} € - Netto **{listino * moltiplicatori[voce['Listino']]:.2f} €**")
+                st.button("Apri", key=f"galleria_{inizio + i + j}", on_click=apri_dalla_galleria,
+                          args=(voce['Articolo'],), use_container_width=True)
+
+if df_base is not None or df_atg is not None:
+    if st.toggle("🖼️ Sfoglia il catalogo con le foto", key="galleria_aperta"):
+        with st.container(border=True):
+            galleria(catalogo_attuale, (sc1, sc2, sc3), (sc_atg1, sc_atg2, sc_atg3))
+
+            # Catalogo illustrato in PDF: stesse miniature, prezzi con gli sconti della sidebar
+            chiave_catalogo = ((sc1, sc2, sc3), (sc_atg1, sc_atg2, sc_atg3), catalogo_attuale.caricato, nome_cliente, nome_referente)
+            lavoro_catalogo = st.session_state.get('lavoro_catalogo')
+            if st.button("📘 Prepara il catalogo illustrato (PDF)", key="prepara_catalogo"):
+                if lavoro_catalogo is None or lavoro_catalogo.chiave != chiave_catalogo:
+                    from listino_cliente import catalogo_illustrato
+                    _precarica_fpdf()
+
+                    if lavoro_catalogo is not None:
+                        lavoro_catalogo.futuro.cancel()
+                    schede = catalogo_attuale.schede()
+                    try:
+                        lavoro_catalogo = avvia_lavoro_listino(
+                            smistatore(), st.session_state['id_sessione'], chiave_catalogo, catalogo_illustrato,
+                            (schede, (sc1, sc2, sc3), (sc_atg1, sc_atg2, sc_atg3), nome_cliente, nome_referente), len(schede))
+                    except CodaPiena as e:
+                        lavoro_catalogo = None
+                        st.warning(f"⏳ {e}")
+                    st.session_state['lavoro_catalogo'] = lavoro_catalogo
+
+            if lavoro_catalogo is not None and lavoro_catalogo.chiave == chiave_catalogo:
+                if lavoro_catalogo.finito:
+                    try:
+                        cache_sessione['catalogo_pronto'] = (chiave_catalogo, lavoro_catalogo.risultato())
+                    except Exception as e:
+                        st.error(f"Errore nella preparazione del catalogo: {e}")
+                    st.session_state['lavoro_catalogo'] = None
+                else:
+                    mostra_avanzamento(lavoro_catalogo, "Preparo il catalogo", "articoli")
+            pronto_catalogo = cache_sessione.get('catalogo_pronto')
+            if pronto_catalogo is not None and pronto_catalogo[0] == chiave_catalogo:
+                nome_catalogo = nome_file_pdf(nome_cliente).replace(".pdf", "_catalogo.pdf")
+                st.download_button(f"⬇️ Scarica '{nome_catalogo}'", data=pronto_catalogo[1], file_name=nome_catalogo,
+                                   mime="application/pdf", key="scarica_catalogo")
+
+if 'avviso_archivio' in st.session_state:
+    st.success(st.session_state.pop('avviso_archivio'))
+
+# --- QUANTITÀ DELL'ARTICOLO SCELTO ---
+# Frammento: cambiare una quantità riesegue solo la griglia, non ricerca, foto e riepilogo.
+# Aggiungere al preventivo invece ridisegna tutta la pagina (il carrello è cambiato).
+def azzera_quantita(taglie, catalogo_selezionato):
+    # Callback: gira prima dei widget, quindi può ancora cambiarne il valore
+    for t in taglie:
+        st.session_state[f"qta_{t}_{catalogo_selezionato}"] = 0
+
+@st.fragment
+def inserimento_quantita(d, catalogo_selezionato, taglie_disponibili, prezzo_netto_finale, normativa_articolo, prezzo_manuale):
+    modalita = st.radio(
+        "Scegli la modalità di inserimento:", 
+        ["Specifica Taglie", "Solo Modello/Vetrina (Senza taglie)"], 
+        horizontal=True,
+        key="mod_inserimento"
+    )
+    
+    st.write("")
+    
+    if modalita == "Specifica Taglie":
+        st.write("**Quantità per Taglia:**")
+        
+        st.button("🔄 Azzera Campi", on_click=azzera_quantita, args=(taglie_disponibili, catalogo_selezionato))
+
+        quantita_taglie = {}
+        
+        for i in range(0, len(taglie_disponibili), 8):
+            chunk = taglie_disponibili[i:i+8]
+            cols = st.columns(8)
+            for j, t in enumerate(chunk):
+                with cols[j]:
+                    key = f"qta_{t}_{catalogo_selezionato}"
+                    if key not in st.session_state: st.session_state[key] = 0
+                    quantita_taglie[t] = st.number_input(str(t), min_value=0, step=1, key=key)
+
+        pezzi = sum(quantita_taglie.values())
+        if pezzi:
+            st.caption(f"{pezzi} pezzi - {pezzi * prezzo_netto_finale:.2f} €")
+
+        st.write("")
+        if st.button("🛒 Aggiungi al Preventivo", use_container_width=True, type="primary"):
+            aggiunti = 0
+            for t, q in quantita_taglie.items():
+                if q > 0:
+                    st.session_state['carrello'].aggiungi(
+                        d['ARTICOLO'], t, q, prezzo_netto_finale,
+                        immagine=str(d.get('IMMAGINE', '')).strip(),
+                        normativa=normativa_articolo,
+                        manuale=prezzo_manuale
+                    )
+                    aggiunti += 1
+            if aggiunti > 0: 
+                st.success("Aggiunto con successo!")
+                st.rerun()
+            else: 
+                st.warning("Inserisci almeno una quantità!")
+    
+    else:
+        st.info("💡 In questa modalità puoi inserire l'articolo senza specificare le taglie.")
+        qta_generica = st.number_input("Quantità generica totale:", min_value=0, step=1, value=None, key="qta_gen")
+        
+        if st.button("🛒 Aggiungi Modello", use_container_width=True, type="primary"):
+            st.session_state['carrello'].aggiungi(
+                d['ARTICOLO'], 
+                "-", 
+                qta_generica if qta_generica is not None else 0,
+                prezzo_netto_finale, 
+                immagine=str(d.get('IMMAGINE', '')).strip(),
+                normativa=normativa_articolo,
+                manuale=prezzo_manuale
+            )
+            st.success("Modello aggiunto al preventivo!")
+            st.rerun()
+
 if df_base is None and df_atg is None:
     st.warning("⚠️ Nessun file Excel trovato. Assicurati che i file 'Listino_agente.xlsx' e 'Listino_ATG.xlsx' siano nella cartella.")
 else:
     st.markdown("### 🟢 :green[Ricerca Articolo]")
-    ricerca = st.text_input("Inserisci nome modello:", placeholder="Cerca su tutto il catalogo (Base o ATG)...").upper()
+    ricerca = st.text_input("Inserisci nome modello:", placeholder="Cerca su tutto il catalogo (Base o ATG)...", key="ricerca").upper()
+    cerca_extra = st.checkbox("Cerca anche in Normativa e Rivestimento", key="cerca_extra")
 
     if ricerca:
-        risultati_trovati = []
-        
-        if df_base is not None:
-            r_base = df_base[df_base['ARTICOLO'].astype(str).str.upper().str.contains(ricerca, na=False)].copy()
-            if not r_base.empty:
-                r_base['CATALOGO_PROVENIENZA'] = "Listino Base"
-                risultati_trovati.append(r_base)
-                
-        if df_atg is not None:
-            r_atg = df_atg[df_atg['ARTICOLO'].astype(str).str.upper().str.contains(ricerca, na=False)].copy()
-            if not r_atg.empty:
-                r_atg['CATALOGO_PROVENIENZA'] = "Listino ATG"
-                risultati_trovati.append(r_atg)
+        with cronometro("ricerca", query=ricerca) as misura:
+            risultati_trovati = catalogo_attuale.cerca(ricerca, campi_extra=cerca_extra, limite=MAX_RISULTATI)
+            misura["risultati"] = len(risultati_trovati)
         
         if risultati_trovati:
-            risultato_completo = pd.concat(risultati_trovati, ignore_index=True)
-            scelta = st.selectbox("Seleziona l'articolo:", risultato_completo['ARTICOLO'].unique())
-            d = risultato_completo[risultato_completo['ARTICOLO'] == scelta].iloc[0]
+            # Primo risultato per ogni nome, nell'ordine di pertinenza
+            per_nome = {}
+            for r in risultati_trovati:
+                per_nome.setdefault(r.articolo, r)
+            if len(risultati_trovati) == MAX_RISULTATI:
+                st.caption(f"Mostro i primi {MAX_RISULTATI} risultati: scrivi qualche lettera in più per restringere.")
+            scelta = st.selectbox("Seleziona l'articolo:", list(per_nome))
+            trovato = per_nome[scelta]
             
-            catalogo_selezionato = d['CATALOGO_PROVENIENZA']
+            catalogo_selezionato = trovato.catalogo
+            d = (df_base if catalogo_selezionato == "Listino Base" else df_atg).iloc[trovato.riga]
             
             normativa_articolo = ""
             if catalogo_selezionato == "Listino Base":
@@ -236,11 +600,9 @@ else:
                 
                 # --- CALCOLO PREZZI E SCONTO TOTALE ---
                 prezzo_listino = float(d['LISTINO'])
-                s1, s2, s3 = sconto_applicato
                 
                 # Calcolo lo sconto composto reale
-                moltiplicatore = (1 - s1/100) * (1 - s2/100) * (1 - s3/100)
-                prezzo_netto_calcolato = prezzo_listino * moltiplicatore
+                prezzo_netto_calcolato = prezzo_netto(prezzo_listino, sconto_applicato)
                 
                 st.caption(f"Prezzo di Listino: {prezzo_listino:.2f} €")
                 
@@ -261,89 +623,39 @@ else:
                     )
                 
                 # Decidiamo quale prezzo usare alla fine
+                prezzo_netto_finale = prezzo_netto(prezzo_listino, sconto_applicato, prezzo_netto_manuale)
                 if prezzo_netto_manuale is not None and prezzo_netto_manuale > 0.0:
-                    prezzo_netto_finale = prezzo_netto_manuale
                     st.info(f"💡 Stai forzando il prezzo a: **{prezzo_netto_finale:.2f} €**")
-                else:
-                    prezzo_netto_finale = prezzo_netto_calcolato
                 
                 st.divider()
                 
-                modalita = st.radio(
-                    "Scegli la modalità di inserimento:", 
-                    ["Specifica Taglie", "Solo Modello/Vetrina (Senza taglie)"], 
-                    horizontal=True,
-                    key="mod_inserimento"
-                )
-                
-                st.write("")
-                
-                if modalita == "Specifica Taglie":
-                    st.write("**Quantità per Taglia:**")
-                    
-                    if st.button("🔄 Azzera Campi"):
-                        for t in taglie_disponibili:
-                            st.session_state[f"qta_{t}_{catalogo_selezionato}"] = 0
-                        st.rerun()
-
-                    quantita_taglie = {}
-                    
-                    for i in range(0, len(taglie_disponibili), 8):
-                        chunk = taglie_disponibili[i:i+8]
-                        cols = st.columns(8)
-                        for j, t in enumerate(chunk):
-                            with cols[j]:
-                                key = f"qta_{t}_{catalogo_selezionato}"
-                                if key not in st.session_state: st.session_state[key] = 0
-                                quantita_taglie[t] = st.number_input(str(t), min_value=0, step=1, key=key)
-
-                    st.write("")
-                    if st.button("🛒 Aggiungi al Preventivo", use_container_width=True, type="primary"):
-                        aggiunti = 0
-                        for t, q in quantita_taglie.items():
-                            if q > 0:
-                                st.session_state['carrello'].append({
-                                    "Articolo": d['ARTICOLO'], "Taglia": t, "Quantità": q,
-                                    "Netto U.": f"{prezzo_netto_finale:.2f} €", "Totale Riga": prezzo_netto_finale * q,
-                                    "Immagine": str(d.get('IMMAGINE', '')).strip(),
-                                    "Normativa": normativa_articolo
-                                })
-                                aggiunti += 1
-                        if aggiunti > 0: 
-                            st.success("Aggiunto con successo!")
-                            st.rerun()
-                        else: 
-                            st.warning("Inserisci almeno una quantità!")
-                
-                else:
-                    st.info("💡 In questa modalità puoi inserire l'articolo senza specificare le taglie.")
-                    qta_generica = st.number_input("Quantità generica totale:", min_value=0, step=1, value=None, key="qta_gen")
-                    
-                    if st.button("🛒 Aggiungi Modello", use_container_width=True, type="primary"):
-                        st.session_state['carrello'].append({
-                            "Articolo": d['ARTICOLO'], 
-                            "Taglia": "-", 
-                            "Quantità": qta_generica if qta_generica is not None else 0,
-                            "Netto U.": f"{prezzo_netto_finale:.2f} €", 
-                            "Totale Riga": prezzo_netto_finale * (qta_generica if qta_generica is not None else 0),
-                            "Immagine": str(d.get('IMMAGINE', '')).strip(),
-                            "Normativa": normativa_articolo
-                        })
-                        st.success("Modello aggiunto al preventivo!")
-                        st.rerun()
+                # Le quantità rieseguono solo questo pezzo: ricerca, prezzi e foto restano come sono
+                inserimento_quantita(d, catalogo_selezionato, taglie_disponibili, prezzo_netto_finale, normativa_articolo,
+                                     prezzo_netto_manuale)
                     
             with c2:
                 url = str(d.get('IMMAGINE', '')).strip()
                 if url.startswith('http'):
-                    try:
-                        # QUI LA MODIFICA PER MOSTRARE A SCHERMO LE IMMAGINI BLOCCATE (ES. LUMIAR)
-                        r = requests.get(url, headers=miei_headers, timeout=5)
-                        if r.status_code == 200:
-                            st.image(BytesIO(r.content), caption=d['ARTICOLO'], use_container_width=True)
-                        else:
-                            st.warning(f"Immagine non trovata. Il sito ha risposto con Errore: {r.status_code}")
-                    except Exception as e: 
-                        st.warning(f"Impossibile caricare l'immagine. Errore tecnico: {e}")
+                    # Foto dell'articolo scelto letta una volta: ai rerun successivi è già in sessione
+                    anteprima = cache_sessione.get('anteprima')
+                    if anteprima is None or anteprima[0] != url:
+                        from immagini import scarica_immagine
+
+                        try:
+                            # QUI LA MODIFICA PER MOSTRARE A SCHERMO LE IMMAGINI BLOCCATE (ES. LUMIAR)
+                            with cronometro("anteprima_foto", articolo=d['ARTICOLO']):
+                                contenuto, stato = scarica_immagine(url, timeout=5)
+                            anteprima = (url, contenuto, stato, None)
+                        except Exception as e:
+                            anteprima = (url, None, None, str(e))
+                        cache_sessione['anteprima'] = anteprima
+                    _, contenuto, stato, errore_foto = anteprima
+                    if contenuto is not None:
+                        st.image(BytesIO(contenuto), caption=d['ARTICOLO'], use_container_width=True)
+                    elif errore_foto is not None:
+                        st.warning(f"Impossibile caricare l'immagine. Errore tecnico: {errore_foto}")
+                    else:
+                        st.warning(f"Immagine non trovata. Il sito ha risposto con Errore: {stato}")
                 elif catalogo_selezionato == "Listino ATG":
                     st.markdown("### 🧤 **Prodotto ATG**")
                     st.write("*(Nessuna immagine nel listino per questo articolo)*")
@@ -358,250 +670,120 @@ else:
 if st.session_state['carrello']:
     st.divider()
     st.header("🛒 Riepilogo")
-    df_c = pd.DataFrame(st.session_state['carrello'])
+    carrello = st.session_state['carrello']
     
-    st.table(df_c[["Articolo", "Taglia", "Quantità", "Netto U.", "Totale Riga"]])
+    st.table(carrello.tabella())
+
+    # --- MODIFICA DELLE RIGHE ---
+    def modifica_riga(riga, chiave):
+        # Callback: la riga si cerca per identità, l'indice può essere cambiato da una rimozione
+        if riga in carrello.righe:
+            carrello.modifica_quantita(carrello.righe.index(riga), st.session_state[chiave])
+
+    def rimuovi_riga(riga):
+        if riga in carrello.righe:
+            carrello.rimuovi(carrello.righe.index(riga))
+
+    with st.expander("✏️ Modifica o Rimuovi Righe"):
+        indice_riga = st.selectbox(
+            "Riga:", range(len(carrello)), key="riga_scelta",
+            format_func=lambda i: f"{i + 1}. {carrello.righe[i].articolo} - Tg {carrello.righe[i].taglia} - {carrello.righe[i].quantita}pz")
+        if indice_riga is not None and indice_riga < len(carrello):
+            riga_scelta = carrello.righe[indice_riga]
+            chiave_quantita = f"quantita_riga_{id(riga_scelta)}"
+            col_r1, col_r2, col_r3 = st.columns([2, 1, 1])
+            col_r1.number_input("Quantità:", min_value=0, step=1, value=riga_scelta.quantita, key=chiave_quantita)
+            col_r2.button("💾 Aggiorna", on_click=modifica_riga, args=(riga_scelta, chiave_quantita), use_container_width=True)
+            col_r3.button("🗑️ Rimuovi", on_click=rimuovi_riga, args=(riga_scelta,), use_container_width=True)
     
-    totale_generale = df_c["Totale Riga"].sum()
+    totale_generale = carrello.totale
     st.markdown(f"### Totale Generale: **{totale_generale:.2f} €**")
+
+    # --- CONFRONTO TRA SERIE DI SCONTI SUL CARRELLO ---
+    with st.expander("🔀 Confronta Sconti sul Carrello"):
+        st.caption("Le righe con prezzo forzato a mano restano ferme; la prima serie fa da riferimento.")
+        import pandas as pd
+
+        scenari_iniziali = pd.DataFrame([
+            {"Scenario": "Attuali", "Base 1": sc1, "Base 2": sc2, "Base 3": sc3, "ATG 1": sc_atg1, "ATG 2": sc_atg2, "ATG 3": sc_atg3},
+            {"Scenario": "Base +5%", "Base 1": sc1, "Base 2": sc2, "Base 3": min(sc3 + 5.0, 100.0), "ATG 1": sc_atg1, "ATG 2": sc_atg2, "ATG 3": sc_atg3},
+            {"Scenario": "ATG +5%", "Base 1": sc1, "Base 2": sc2, "Base 3": sc3, "ATG 1": sc_atg1, "ATG 2": sc_atg2, "ATG 3": min(sc_atg3 + 5.0, 100.0)},
+        ])
+        scenari_modificati = st.data_editor(scenari_iniziali, num_rows="dynamic", hide_index=True, key="scenari_sconti")
+        scenari_modificati = scenari_modificati.dropna(subset=["Scenario"]).fillna(0.0)
+        scenari = {
+            str(r["Scenario"]): ((r["Base 1"], r["Base 2"], r["Base 3"]), (r["ATG 1"], r["ATG 2"], r["ATG 3"]))
+            for r in scenari_modificati.to_dict("records")
+        }
+        if scenari:
+            articoli_carrello, quantita_carrello, netti_carrello = carrello.colonne()
+            listino_carrello, base_carrello = catalogo_attuale.prezzi_listino(articoli_carrello)
+            manuali_carrello = netti_fermi(netti_carrello, listino_carrello, carrello.manuali())
+            st.dataframe(confronta_sconti(listino_carrello, base_carrello, quantita_carrello, manuali_carrello, scenari),
+                         hide_index=True)
     
-    c_p1, c_p2 = st.columns(2)
+    c_p1, c_p2, c_p3 = st.columns(3)
     with c_p1:
         if st.button("🗑️ Svuota Tutto", use_container_width=True):
-            st.session_state['carrello'] = []
+            carrello.svuota()
             st.rerun()
             
+    preventivo = {
+        "cliente": nome_cliente,
+        "referente": nome_referente,
+        "righe": carrello.righe_preventivo(),
+        "espositori": st.session_state['espositori_selezionati'],
+        "note": note_preventivo,
+        "pagamento": campo_pagamento,
+        "trasporto": campo_trasporto,
+        "validita": campo_validita,
+    }
+    chiave_pdf = impronta_preventivo(preventivo)
+    lavoro = st.session_state['lavoro_pdf']
+    
+    with c_p3:
+        if st.button("💾 Salva in Archivio", use_container_width=True):
+            id_salvato = archivio_preventivi().salva(
+                preventivo, (sc1, sc2, sc3), (sc_atg1, sc_atg2, sc_atg3),
+                pdf_bytes=cache_sessione.get('pdf_pronti', {}).get(chiave_pdf),
+                catalogo=catalogo_attuale
+            )
+            st.success(f"Preventivo salvato in archivio (n. {id_salvato})")
+    
     with c_p2:
         if st.button("📄 Prepara PDF per il Download", use_container_width=True, type="primary"):
-            raggruppo = {}
-            for r in st.session_state['carrello']:
-                art = r["Articolo"]
-                if art not in raggruppo:
-                    raggruppo[art] = {
-                        "T": [], 
-                        "Tot": 0, 
-                        "Img": r["Immagine"], 
-                        "Netto": r["Netto U."],
-                        "Normativa": r.get("Normativa", "")
-                    }
-                
-                if r["Quantità"] > 0:
-                    if r["Taglia"] == "-":
-                        raggruppo[art]["T"].append(f"Q.tà: {r['Quantità']}pz")
-                    else:
-                        raggruppo[art]["T"].append(f"Tg{r['Taglia']}: {r['Quantità']}pz")
-                
-                raggruppo[art]["Tot"] += r["Totale Riga"]
-
-            class PDF(FPDF):
-                def header(self):
-                    # Logo.png in alto a sinistra, rimpicciolito e spostato leggermente più in alto
-                    for f in ["logo.png", "logo.jpg", "logo.jpeg"]:
-                        if os.path.exists(f):
-                            # Larghezza (w) passata da 100 a 50 (dimezzato), posizione Y passata da 8 a 4 (più in alto)
-                            self.image(f, 5, 4, 70) 
-                            break
-                            
-                    # Spett.le
-                    self.set_font("helvetica", "", 12)
-                    self.set_xy(100, 15)
-                    self.cell(100, 6, "Spett.le", align="R", ln=1)
-                    
-                    # Nome Cliente
-                    self.set_font("helvetica", "B", 20) 
-                    self.set_x(100) 
-                    testo_nome = nome_cliente if nome_cliente else "Cliente"
-                    self.cell(100, 8, testo_nome, align="R", ln=1)
-                    
-                    # Nome Referente
-                    if nome_referente:
-                        self.set_font("helvetica", "", 15) 
-                        self.set_x(100)
-                        self.cell(100, 7, f"c.a. {nome_referente}", align="R", ln=1)
-                        
-                    # DATA ODIERNA
-                    mesi = ["Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno", "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
-                    oggi = datetime.now()
-                    data_formattata = f"{oggi.day} {mesi[oggi.month - 1]} {oggi.year}"
-                    
-                    self.set_font("helvetica", "I", 11)
-                    self.set_text_color(100, 100, 100)
-                    self.set_x(100)
-                    self.cell(100, 7, f"Data: {data_formattata}", align="R", ln=1)
-                    self.set_text_color(0, 0, 0)
-                    
-                    self.ln(15)
-
-            pdf = PDF()
-            pdf.add_page()
-            
-            # --- CICLO PRODOTTI ---
-            for art, dati in raggruppo.items():
-                y_inizio = pdf.get_y()
-                if y_inizio > 230:
-                    pdf.add_page()
-                    y_inizio = pdf.get_y()
-
-                pdf.set_xy(10, y_inizio)
-                pdf.set_font("helvetica", "B", 12)
-                pdf.cell(135, 7, f"Modello: {art}", ln=1)
-                
-                # STAMPA DELLA NORMATIVA
-                if dati.get("Normativa"):
-                    pdf.set_font("helvetica", "I", 9) 
-                    pdf.cell(135, 5, f"Normativa: {dati['Normativa']}", ln=1)
-                
-                pdf.set_font("helvetica", "", 10)
-                pdf.cell(135, 6, f"Prezzo Netto: {dati['Netto'].replace('€', 'Euro')}", ln=1)
-                
-                if dati["T"]:
-                    pdf.set_font("helvetica", "I", 9)
-                    pdf.multi_cell(135, 5, " | ".join(dati["T"]))
-                else:
-                    pdf.set_font("helvetica", "I", 9)
-                    pdf.cell(135, 5, "Proposta Modello (Nessuna quantità specificata)", ln=1)
-                
-                pdf.ln(2) 
-                
-                if dati['Tot'] > 0:
-                    pdf.set_x(10) 
-                    pdf.set_font("helvetica", "B", 10)
-                    pdf.cell(135, 6, f"Subtotale: {dati['Tot']:.2f} Euro", ln=1)
-                
-                y_fine_testo = pdf.get_y()
-
-                foto_inserita = False
-                y_fine_immagine = y_inizio + 10 
-                
-                if dati["Img"].startswith("http"):
-                    try:
-                        # QUI LA SECONDA MODIFICA PER GESTIRE I .PNG COME BARISTA E I BLOCCHI (LUMIAR)
-                        res = requests.get(dati["Img"], headers=miei_headers, timeout=5)
-                        if res.status_code == 200:
-                            # Controlliamo l'estensione dinamicamente
-                            estensione = ".png" if ".png" in dati["Img"].lower() else ".jpg"
-                            
-                            with tempfile.NamedTemporaryFile(delete=False, suffix=estensione) as tmp:
-                                tmp.write(res.content)
-                                pdf.image(tmp.name, x=155, y=y_inizio, w=35)
-                            os.remove(tmp.name)
-                            foto_inserita = True
-                            y_fine_immagine = y_inizio + 35 
-                    except: 
-                        pass
-                
-                if not foto_inserita:
-                    pdf.set_xy(155, y_inizio + 10)
-                    pdf.set_font("helvetica", "I", 9)
-                    pdf.set_text_color(150, 150, 150)
-                    pdf.cell(35, 10, "Foto non disponibile", align="C")
-                    pdf.set_text_color(0, 0, 0)
-                    y_fine_immagine = y_inizio + 20
-                
-                y_fine_blocco = max(y_fine_testo, y_fine_immagine)
-                pdf.set_y(y_fine_blocco + 5)
-                pdf.line(10, pdf.get_y(), 200, pdf.get_y())
-                pdf.ln(5)
-
-            # --- TOTALE GENERALE ---
-            pdf.ln(5)
-            if totale_generale > 0:
-                pdf.set_font("helvetica", "B", 14)
-                pdf.cell(0, 10, f"TOTALE GENERALE: {totale_generale:.2f} Euro", align="R")
-                pdf.ln(10)
-
-            # --- ESPOSITORI ---
-            if st.session_state['espositori_selezionati']:
-                pdf.ln(5)
-                nomi_espositori_pdf = {
-                    "ATG banco.jpg": "Espositore ATG girevole da Banco",
-                    "ATG terra.jpg": "Espositore ATG in Metallo da Terra",
-                    "Base banco.jpg": "Espositore BASE da Banco 1 Modello",
-                    "BASE terra.jpg": "Espositore BASE da terra 7 modelli"
-                }
-
-                for esp_file in st.session_state['espositori_selezionati']:
-                    if pdf.get_y() > 220: 
-                        pdf.add_page()
-                    
-                    current_y_esp = pdf.get_y()
-                    descrizione_espositore = nomi_espositori_pdf.get(esp_file, esp_file.replace('.jpg', '').upper())
-
-                    if os.path.exists(esp_file):
-                        pdf.image(esp_file, x=10, y=current_y_esp, w=35)
-                    else:
-                        pdf.set_xy(10, current_y_esp)
-                        pdf.set_font("helvetica", "I", 10)
-                        pdf.set_text_color(200,0,0)
-                        pdf.cell(35, 10, f"Foto Mancante", ln=1)
-                        pdf.set_text_color(0,0,0)
-
-                    pdf.set_xy(50, current_y_esp + 10) 
-                    pdf.set_font("helvetica", "B", 14)
-                    pdf.set_text_color(0, 100, 0) 
-                    testo_omaggio = f"Modello: {descrizione_espositore}\nEspositore in OMAGGIO con questo ordine!"
-                    pdf.multi_cell(0, 7, testo_omaggio)
-                    pdf.set_text_color(0, 0, 0) 
-                    pdf.set_y(current_y_esp + 45) 
-
-            # --- NOTE ---
-            if note_preventivo.strip():
-                pdf.ln(5)
-                pdf.set_font("helvetica", "B", 14) 
-                pdf.cell(0, 8, "Note:")
-                pdf.ln(8)
-                pdf.set_font("helvetica", "", 13) 
-                testo_note = note_preventivo.replace('€', 'Euro')
-                pdf.multi_cell(0, 6, testo_note)
-            
-            # --- PAGAMENTO, TRASPORTO, VALIDITA' E PREZZI ---
-            pdf.ln(6) 
-            h_c = 6
-            
-            if campo_pagamento.strip():
-                pdf.set_font("helvetica", "B", 10)
-                pdf.cell(pdf.get_string_width("Pagamento: ") + 2, h_c, "Pagamento:", ln=0)
-                pdf.set_font("helvetica", "", 10)
-                pdf.cell(pdf.get_string_width(campo_pagamento) + 6, h_c, campo_pagamento, ln=0)
-
-            if campo_trasporto.strip():
-                pdf.set_font("helvetica", "B", 10)
-                pdf.cell(pdf.get_string_width("Trasporto: ") + 2, h_c, "Trasporto:", ln=0)
-                pdf.set_font("helvetica", "", 10)
-                pdf.cell(pdf.get_string_width(campo_trasporto) + 6, h_c, campo_trasporto, ln=0)
-            
-            if campo_validita.strip():
-                pdf.set_font("helvetica", "B", 10)
-                pdf.cell(pdf.get_string_width("Validità: ") + 2, h_c, "Validità:", ln=0)
-                pdf.set_font("helvetica", "", 10)
-                pdf.cell(pdf.get_string_width(campo_validita) + 6, h_c, campo_validita, ln=0)
-                
-            pdf.set_font("helvetica", "B", 10)
-            pdf.cell(pdf.get_string_width("Prezzi: ") + 2, h_c, "Prezzi:", ln=0)
-            pdf.set_font("helvetica", "", 10)
-            pdf.cell(0, h_c, "netti iva esclusa", ln=1)
-
-            # --- FIRMA ---
-            pdf.ln(10)
-            pdf.set_font("helvetica", "I", 11)
-            pdf.cell(0, 6, "Michele Cavallo - Area Manager | Base Protection srl", align="R", ln=1)
-            pdf.cell(0, 6, "Tel. 389.0199088", align="R", ln=1)
-
-            pdf_out = pdf.output()
-            
-            if isinstance(pdf_out, str):
-                pdf_bytes = pdf_out.encode('latin-1')
+            # Stesso contenuto già pronto o in lavorazione: non riparto da capo
+            if chiave_pdf not in cache_sessione.get('pdf_pronti', {}) and (lavoro is None or lavoro.chiave != chiave_pdf):
+                # Il PDF del carrello di prima non serve più: se è ancora in coda lascia il posto
+                if lavoro is not None:
+                    lavoro.futuro.cancel()
+                try:
+                    lavoro = avvia_lavoro_pdf(smistatore(), st.session_state['id_sessione'],
+                                              chiave_pdf, preventivo, carrello.raggruppo())
+                except CodaPiena as e:
+                    lavoro = None
+                    st.warning(f"⏳ {e}")
+                st.session_state['lavoro_pdf'] = lavoro
+
+        # --- PDF IN COSTRUZIONE (in background, la pagina resta utilizzabile) ---
+        if lavoro is not None and lavoro.chiave == chiave_pdf and chiave_pdf not in cache_sessione.get('pdf_pronti', {}):
+            if lavoro.finito:
+                try:
+                    salva_pdf_pronto(chiave_pdf, lavoro.risultato())
+                except Exception as e:
+                    st.error(f"Errore nella creazione del PDF: {e}")
+                st.session_state['lavoro_pdf'] = None
             else:
-                pdf_bytes = bytes(pdf_out)
-            
-            data_oggi = datetime.now().strftime("%d.%m.%Y")
-            nome_sicuro = "".join(x for x in nome_cliente if x.isalnum() or x in " -_").strip()
-            nome_sicuro = nome_sicuro.replace(" ", "_") if nome_sicuro else "Cliente"
-            nome_file_dinamico = f"{nome_sicuro}_{data_oggi}.pdf"
-            
+                mostra_avanzamento(lavoro, "Preparo il PDF", "articoli")
+
+        # --- PDF PRONTO: stesso contenuto = stessi byte, nessun ricalcolo ---
+        pdf_bytes = cache_sessione.get('pdf_pronti', {}).get(chiave_pdf)
+        if pdf_bytes is not None:
+            nome_file_dinamico = nome_file_pdf(nome_cliente)
+        
             st.divider()
             st.success("✅ PDF pronto per essere scaricato!")
-            
+        
             st.download_button(
                 label=f"⬇️ Clicca qui per Salvare '{nome_file_dinamico}'",
                 data=pdf_bytes,
@@ -610,3 +792,69 @@ if st.session_state['carrello']:
                 use_container_width=True,
                 type="primary"
             )
+
+    # --- STESSA OFFERTA A PIÙ CLIENTI: UN PDF PER CLIENTE, TUTTI IN UNO ZIP ---
+    with st.expander("📦 Stessa Offerta a Più Clienti (ZIP)"):
+        st.caption("Gli articoli del carrello, un PDF per cliente con i suoi sconti. "
+                   "Sconti e condizioni lasciati vuoti valgono quelli della sidebar.")
+
+        file_clienti = st.file_uploader(
+            "Lista clienti (CSV o Excel con colonne CLIENTE, REFERENTE, SC1-SC3, SC_ATG1-SC_ATG3, NOTE):",
+            type=["csv", "xlsx", "xls"], key="file_clienti")
+        if file_clienti is not None:
+            try:
+                clienti = leggi_clienti(file_clienti)
+            except Exception as e:
+                st.error(f"File clienti illeggibile: {e}")
+                clienti = []
+        else:
+            import pandas as pd
+
+            st.caption("Oppure scrivili qui (si può incollare da Excel):")
+            tabella_clienti = st.data_editor(
+                pd.DataFrame({"CLIENTE": pd.Series(dtype=str), "REFERENTE": pd.Series(dtype=str),
+                              **{c: pd.Series(dtype=float) for c in ("SC1", "SC2", "SC3", "SC_ATG1", "SC_ATG2", "SC_ATG3")},
+                              "NOTE": pd.Series(dtype=str)}),
+                num_rows="dynamic", hide_index=True, key="tabella_clienti")
+            clienti = clienti_da_tabella(tabella_clienti)
+
+        sconti_sidebar = ((sc1, sc2, sc3), (sc_atg1, sc_atg2, sc_atg3))
+        chiave_zip = impronta_preventivo({"offerta": preventivo, "clienti": clienti, "sconti": sconti_sidebar})
+        lavoro_zip = st.session_state.get('lavoro_zip')
+        pronto_zip = st.session_state.get('zip_pronto')
+
+        if st.button(f"📦 Prepara lo ZIP ({len(clienti)} clienti)", disabled=not clienti, key="prepara_zip"):
+            gia_pronto = pronto_zip is not None and pronto_zip[0] == chiave_zip and os.path.exists(pronto_zip[1])
+            if not gia_pronto and (lavoro_zip is None or lavoro_zip.chiave != chiave_zip):
+                if lavoro_zip is not None:
+                    lavoro_zip.futuro.cancel()
+                pulisci_pacchetti()
+                articoli_zip, _, netti_zip = carrello.colonne()
+                listino_zip, base_zip = catalogo_attuale.prezzi_listino(articoli_zip)
+                manuali_zip = netti_fermi(netti_zip, listino_zip, carrello.manuali())
+                try:
+                    lavoro_zip = avvia_lavoro_pacchetto(
+                        smistatore(), st.session_state['id_sessione'], chiave_zip, preventivo, clienti,
+                        (listino_zip, base_zip, manuali_zip, *sconti_sidebar),
+                        os.path.join(CARTELLA_PACCHETTI, f"{chiave_zip}.zip"))
+                except CodaPiena as e:
+                    lavoro_zip = None
+                    st.warning(f"⏳ {e}")
+                st.session_state['lavoro_zip'] = lavoro_zip
+
+        if lavoro_zip is not None and lavoro_zip.chiave == chiave_zip:
+            if lavoro_zip.finito:
+                try:
+                    st.session_state['zip_pronto'] = (chiave_zip, lavoro_zip.risultato())
+                except Exception as e:
+                    st.error(f"Errore nella creazione dello ZIP: {e}")
+                st.session_state['lavoro_zip'] = None
+            else:
+                mostra_avanzamento(lavoro_zip, "Preparo le offerte", "clienti")
+
+        # Lo ZIP sta su disco e si legge solo al clic sul download, non a ogni rerun
+        pronto_zip = st.session_state.get('zip_pronto')
+        if pronto_zip is not None and pronto_zip[0] == chiave_zip and os.path.exists(pronto_zip[1]):
+            nome_zip = nome_file_pdf("Offerte").replace(".pdf", ".zip")
+            st.download_button(f"⬇️ Scarica '{nome_zip}'", data=Path(pronto_zip[1]).read_bytes, file_name=nome_zip,
+                               mime="application/zip", type="primary", key="scarica_zip")
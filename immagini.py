@@ -0,0 +1,451 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+from strumentazione import cronometro, nel_contesto
+
+# --- HEADERS PER INGANNARE I SITI DI HOSTING ---
+miei_headers = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
+    'Referer': 'https://postimg.cc/'
+}
+
+CARTELLA_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache_immagini")
+
+# Stati HTTP che memorizziamo come "foto assente" per non richiederli a ogni preventivo
+STATI_NEGATIVI = (403, 404, 410)
+
+
+# Sottocartelle che contano per `max_byte`: le foto e quello che se ne ricava (nome = impronta della foto)
+CARTELLE_FOTO = ("dati", "derivati", "miniature")
+
+
+def _leggi_file(percorso):
+    try:
+        with open(percorso, "rb") as f:
+            contenuto = f.read()
+    except OSError:
+        return None
+    # Aggiorno la data di modifica: è l'orologio usato per l'eliminazione LRU
+    try:
+        os.utime(percorso, None)
+    except OSError:
+        pass
+    return contenuto
+
+
+def _non_immagine(tipo):
+    # Pagina HTML di un hosting che blocca il link diretto: risponde 200 ma la foto non c'è
+    return bool(tipo) and tipo.split(";")[0].strip().lower().startswith("text/")
+
+
+class CacheImmagini:
+    """Cache su disco delle foto prodotto scaricate da URL.
+
+    Il contenuto è salvato per hash (due URL con la stessa foto occupano un solo file),
+    i metadati per URL. Oltre `max_byte` (foto, riduzioni per la stampa e miniature insieme)
+    vengono eliminati i file usati meno di recente.
+    Entro `ttl_fresco` secondi non si tocca la rete; dopo si rivalida con ETag/Last-Modified.
+    Le risposte 403/404/410, le pagine HTML al posto della foto e i siti segnati irraggiungibili
+    dal controllo notturno (controllo_immagini.py) vengono ricordati per `ttl_negativo` secondi.
+    """
+
+    def __init__(self, cartella=CARTELLA_CACHE, max_byte=200 * 1024 * 1024,
+                 ttl_fresco=7 * 24 * 3600, ttl_negativo=24 * 3600):
+        self.cartella = cartella
+        self.max_byte = max_byte
+        self.ttl_fresco = ttl_fresco
+        self.ttl_negativo = ttl_negativo
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cartella, "dati"), exist_ok=True)
+        os.makedirs(os.path.join(cartella, "meta"), exist_ok=True)
+
+    # --- PERCORSI ---
+    def _percorso_meta(self, url):
+        chiave = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cartella, "meta", f"{chiave}.json")
+
+    def _percorso_dati(self, impronta):
+        return os.path.join(self.cartella, "dati", impronta)
+
+    # --- METADATI ---
+    def _leggi_meta(self, url):
+        try:
+            with open(self._percorso_meta(url), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _scrivi_meta(self, url, meta):
+        # Scrittura atomica: più processi Streamlit possono condividere la stessa cartella
+        percorso = self._percorso_meta(url)
+        tmp = f"{percorso}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, percorso)
+
+    def _leggi_dati(self, impronta):
+        return _leggi_file(self._percorso_dati(impronta))
+
+    def _salva_dati(self, contenuto):
+        impronta = hashlib.sha256(contenuto).hexdigest()
+        percorso = self._percorso_dati(impronta)
+        if not os.path.exists(percorso):
+            tmp = f"{percorso}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(contenuto)
+            os.replace(tmp, percorso)
+            self._elimina_vecchi()
+        else:
+            os.utime(percorso, None)
+        return impronta
+
+    def _elimina_vecchi(self):
+        with self._lock:
+            voci = []
+            derivati = {}
+            for sottocartella in CARTELLE_FOTO:
+                cartella = os.path.join(self.cartella, sottocartella)
+                try:
+                    nomi = os.listdir(cartella)
+                except OSError:
+                    continue
+                for nome in nomi:
+                    if nome.endswith(".tmp"):
+                        continue
+                    percorso = os.path.join(cartella, nome)
+                    try:
+                        st_file = os.stat(percorso)
+                    except OSError:
+                        continue
+                    voci.append((st_file.st_mtime, st_file.st_size, percorso, nome if sottocartella == "dati" else None))
+                    if sottocartella != "dati":
+                        derivati.setdefault(nome.split("_", 1)[0], []).append((st_file.st_size, percorso))
+            totale = sum(v[1] for v in voci)
+            if totale <= self.max_byte:
+                return
+            tolti = set()
+            for _, dimensione, percorso, impronta in sorted(voci):
+                # Con la foto se ne vanno anche le sue riduzioni e miniature: non servirebbero più
+                for dimensione, percorso in [(dimensione, percorso)] + derivati.get(impronta, []):
+                    if percorso in tolti:
+                        continue
+                    try:
+                        os.remove(percorso)
+                    except OSError:
+                        continue
+                    tolti.add(percorso)
+                    totale -= dimensione
+                if totale <= self.max_byte:
+                    break
+
+    # --- API ---
+    def meta(self, url):
+        """Quello che la cache sa dell'URL (stato, tipo, byte, latenza...), None se mai visto."""
+        return self._leggi_meta(url)
+
+    def segna_irraggiungibile(self, url, errore):
+        """Ricorda un URL che non risponde: per `ttl_negativo` secondi non si riprova.
+
+        Una foto già in cache resta valida (un sito giù per qualche minuto non la deve nascondere):
+        in quel caso non si segna niente e si restituisce False.
+        """
+        meta = self._leggi_meta(url)
+        if meta is not None and meta.get("stato") == 200 and not meta.get("errore") \
+                and self._leggi_dati(meta["impronta"]) is not None:
+            return False
+        self._scrivi_meta(url, {"stato": None, "errore": errore, "salvato": time.time()})
+        return True
+
+    def ottieni(self, url, timeout=5, sessione=None, verifica=False):
+        """Restituisce (contenuto, stato_http). Il contenuto è None se la foto non è disponibile;
+        se il problema è già noto, al posto dello stato c'è la sua descrizione.
+
+        Gli errori di rete vengono propagati, così chi chiama può mostrarli all'utente.
+        Con `verifica` si interroga sempre il sito (condizionale se la foto è in cache),
+        anche per gli URL ricordati come assenti.
+        """
+        adesso = time.time()
+        meta = self._leggi_meta(url)
+
+        if meta is not None:
+            if meta.get("stato") != 200 or meta.get("errore"):
+                if not verifica and adesso - meta.get("salvato", 0) < self.ttl_negativo:
+                    return None, meta.get("errore") or meta.get("stato")
+                meta = None
+            else:
+                contenuto = self._leggi_dati(meta["impronta"])
+                if contenuto is not None and not verifica and adesso - meta.get("verificato", 0) < self.ttl_fresco:
+                    return contenuto, 200
+                if contenuto is None:
+                    meta = None
+
+        intestazioni = dict(miei_headers)
+        if meta is not None and meta.get("stato") == 200:
+            if meta.get("etag"):
+                intestazioni["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                intestazioni["If-Modified-Since"] = meta["last_modified"]
+
+        inizio = time.perf_counter()
+        with cronometro("immagine/http", host=urlsplit(url).netloc, url=url) as misura:
+            r = (sessione or requests).get(url, headers=intestazioni, timeout=timeout)
+            misura["stato"] = r.status_code
+            misura["byte"] = len(r.content)
+        latenza_ms = round((time.perf_counter() - inizio) * 1000)
+
+        if r.status_code == 304 and meta is not None:
+            meta["verificato"] = adesso
+            meta["latenza_ms"] = latenza_ms
+            self._scrivi_meta(url, meta)
+            return self._leggi_dati(meta["impronta"]), 200
+
+        tipo = r.headers.get("Content-Type")
+        if r.status_code == 200 and _non_immagine(tipo):
+            errore = f"non è un'immagine ({tipo})"
+            self._scrivi_meta(url, {"stato": 200, "errore": errore, "tipo": tipo,
+                                    "byte": len(r.content), "latenza_ms": latenza_ms, "salvato": adesso})
+            return None, errore
+
+        if r.status_code == 200:
+            impronta = self._salva_dati(r.content)
+            self._scrivi_meta(url, {
+                "stato": 200,
+                "impronta": impronta,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "tipo": tipo,
+                "byte": len(r.content),
+                "latenza_ms": latenza_ms,
+                "verificato": adesso,
+                "salvato": adesso,
+            })
+            return r.content, 200
+
+        if r.status_code in STATI_NEGATIVI:
+            self._scrivi_meta(url, {"stato": r.status_code, "latenza_ms": latenza_ms, "salvato": adesso})
+        return None, r.status_code
+
+    # --- MINIATURE ---
+    def miniatura(self, url, lato_px=None):
+        """Miniatura della foto presa solo dal disco, mai dalla rete: None se la foto non è in cache.
+
+        Si ricava dalla foto scaricata la prima volta che serve (o dal controllo notturno) e resta
+        accanto alla cache, con il nome dell'impronta: se la foto cambia, cambia anche lei.
+        """
+        lato_px = lato_px or LATO_MINIATURA
+        meta = self._leggi_meta(url)
+        if meta is None or meta.get("stato") != 200 or meta.get("errore"):
+            return None
+        percorso = os.path.join(self.cartella, "miniature", f"{meta['impronta']}_{lato_px}px.jpg")
+        ridotta = _leggi_file(percorso)
+        if ridotta is not None:
+            return ridotta
+        contenuto = self._leggi_dati(meta["impronta"])
+        if contenuto is None:
+            return None
+        try:
+            ridotta = _miniatura(contenuto, lato_px)
+        except Exception:
+            return None
+        try:
+            os.makedirs(os.path.dirname(percorso), exist_ok=True)
+            tmp = f"{percorso}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(ridotta)
+            os.replace(tmp, percorso)
+        except OSError:
+            pass
+        return ridotta
+
+
+# --- RIDUZIONE PER LA STAMPA ---
+DPI_STAMPA = 200
+# Lato massimo delle miniature della galleria: nitide nelle colonne della pagina e nel catalogo PDF
+LATO_MINIATURA = 240
+
+
+def _su_bianco(immagine):
+    # Trasparenze appiattite su bianco: la pagina del PDF è bianca e il JPEG pesa molto meno del PNG
+    if immagine.mode in ("RGBA", "LA", "P"):
+        immagine = immagine.convert("RGBA")
+        sfondo = Image.new("RGB", immagine.size, (255, 255, 255))
+        sfondo.paste(immagine, mask=immagine.getchannel("A"))
+        return sfondo
+    if immagine.mode != "RGB":
+        return immagine.convert("RGB")
+    return immagine
+
+
+def _riduci(contenuto, larghezza_mm, dpi, qualita):
+    immagine = Image.open(BytesIO(contenuto))
+    immagine.load()
+    larghezza_px = max(1, round(larghezza_mm / 25.4 * dpi))
+    if immagine.width > larghezza_px:
+        altezza_px = max(1, round(immagine.height * larghezza_px / immagine.width))
+        immagine = immagine.resize((larghezza_px, altezza_px), Image.LANCZOS)
+    immagine = _su_bianco(immagine)
+    uscita = BytesIO()
+    immagine.save(uscita, format="JPEG", quality=qualita, optimize=True)
+    return uscita.getvalue()
+
+
+def _miniatura(contenuto, lato_px, qualita=80):
+    immagine = Image.open(BytesIO(contenuto))
+    immagine.load()
+    immagine.thumbnail((lato_px, lato_px), Image.LANCZOS)
+    uscita = BytesIO()
+    _su_bianco(immagine).save(uscita, format="JPEG", quality=qualita, optimize=True)
+    return uscita.getvalue()
+
+
+def normalizza_immagine(contenuto, larghezza_mm=35, dpi=DPI_STAMPA, qualita=80, cartella=None):
+    """JPEG ridotto alla risoluzione di stampa, salvato su disco per riusarlo nei preventivi successivi.
+
+    Se l'immagine non si riesce a leggere restituisce il contenuto originale.
+    """
+    cartella = cartella or cache_predefinita().cartella
+    impronta = hashlib.sha256(contenuto).hexdigest()
+    percorso = os.path.join(cartella, "derivati", f"{impronta}_{larghezza_mm}mm_{dpi}dpi_q{qualita}.jpg")
+    ridotta = _leggi_file(percorso)
+    if ridotta is not None:
+        return ridotta
+    try:
+        ridotta = _riduci(contenuto, larghezza_mm, dpi, qualita)
+    except Exception:
+        return contenuto
+    # Se l'originale era già più leggero (piccolo e ben compresso) tengo quello
+    if len(ridotta) >= len(contenuto) and contenuto[:3] == b"\xff\xd8\xff":
+        ridotta = contenuto
+    try:
+        os.makedirs(os.path.dirname(percorso), exist_ok=True)
+        tmp = f"{percorso}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(ridotta)
+        os.replace(tmp, percorso)
+    except OSError:
+        pass
+    return ridotta
+
+
+_cache_predefinita = None
+
+
+def cache_predefinita():
+    global _cache_predefinita
+    if _cache_predefinita is None:
+        _cache_predefinita = CacheImmagini()
+    return _cache_predefinita
+
+
+def imposta_cache_predefinita(cache):
+    """Sostituisce la cache condivisa (benchmark e job offline usano una cartella propria)."""
+    global _cache_predefinita
+    _cache_predefinita = cache
+
+
+def scarica_immagine(url, timeout=5):
+    """Scorciatoia usata dall'app: foto da cache locale o, se serve, dalla rete."""
+    return cache_predefinita().ottieni(url, timeout=timeout)
+
+
+# --- PRECARICAMENTO IN PARALLELO ---
+def crea_sessione(connessioni=16):
+    """Sessione HTTP con pool di connessioni condiviso tra i thread del precaricamento."""
+    sessione = requests.Session()
+    adattatore = HTTPAdapter(pool_connections=connessioni, pool_maxsize=connessioni)
+    sessione.mount("http://", adattatore)
+    sessione.mount("https://", adattatore)
+    return sessione
+
+
+# Thread di download condivisi da tutte le sessioni del processo: con molti utenti insieme
+# le richieste in volo restano al massimo MAX_DOWNLOAD invece di 8 per ogni PDF in corso
+MAX_DOWNLOAD = 16
+_esecutore_download = None
+_pid_esecutore = None
+_lock_esecutore = threading.Lock()
+
+
+def esecutore_download():
+    global _esecutore_download, _pid_esecutore
+    with _lock_esecutore:
+        # Dopo un fork (processi del batch) i thread del padre non esistono: serve un pool nuovo
+        if _esecutore_download is None or _pid_esecutore != os.getpid():
+            _esecutore_download = ThreadPoolExecutor(max_workers=MAX_DOWNLOAD, thread_name_prefix="foto")
+            _pid_esecutore = os.getpid()
+        return _esecutore_download
+
+
+def precarica_immagini(urls, cache=None, max_thread=8, max_per_host=2, timeout=5, scadenza=15, esecutore=None):
+    """Scarica in parallelo tutte le foto distinte e restituisce {url: contenuto o None}.
+
+    Al massimo `max_thread` richieste contemporanee per chiamata e `max_per_host` per sito.
+    Se un sito va in timeout o rifiuta la connessione, le altre foto dello stesso sito
+    vengono saltate subito. Dopo `scadenza` secondi si restituisce quello che è arrivato,
+    il resto vale None. I download girano su `esecutore`, di norma quello condiviso del processo.
+    """
+    cache = cache or cache_predefinita()
+    distinti = [u for u in dict.fromkeys(urls) if u and u.startswith("http")]
+    risultati = {u: None for u in distinti}
+    if not distinti:
+        return risultati
+
+    limite = time.monotonic() + scadenza
+    code = {}
+    for u in distinti:
+        code.setdefault(urlsplit(u).netloc, deque()).append(u)
+    attivi = {host: 0 for host in code}
+    host_irraggiungibili = set()
+    lock = threading.Lock()
+    sessione = crea_sessione(max(max_thread, max_per_host))
+
+    def prossima():
+        # Foto di un sito che non ha già max_per_host richieste in corso: nessun thread resta fermo ad aspettare
+        with lock:
+            for host, coda in code.items():
+                if coda and host not in host_irraggiungibili and attivi[host] < max_per_host:
+                    attivi[host] += 1
+                    return host, coda.popleft()
+            return None, None
+
+    def scarica():
+        while True:
+            host, url = prossima()
+            if url is None:
+                return
+            try:
+                rimanente = limite - time.monotonic()
+                if rimanente <= 0:
+                    return
+                contenuto, _ = cache.ottieni(url, timeout=min(timeout, rimanente), sessione=sessione)
+                risultati[url] = contenuto
+            except (requests.Timeout, requests.ConnectionError):
+                with lock:
+                    host_irraggiungibili.add(host)
+            except Exception:
+                pass
+            finally:
+                with lock:
+                    attivi[host] -= 1
+
+    esecutore = esecutore or esecutore_download()
+    futuri = [esecutore.submit(nel_contesto(scarica)) for _ in range(min(max_thread, len(distinti)))]
+    try:
+        wait(futuri, timeout=max(0, limite - time.monotonic()))
+    finally:
+        for futuro in futuri:
+            futuro.cancel()
+        sessione.close()
+    return dict(risultati)
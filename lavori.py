@@ -0,0 +1,284 @@
+import copy
+import multiprocessing
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+
+from strumentazione import nel_contesto, registra
+
+
+class CodaPiena(Exception):
+    """Troppi lavori in attesa: meglio dirlo subito all'utente che lasciarlo aspettare."""
+
+
+@contextmanager
+def _senza_main():
+    """Con spawn i processi figli rieseguono il modulo __main__: sotto Streamlit è lo script
+    della pagina. Mentre partono gli mostro un __main__ vuoto."""
+    vero = sys.modules["__main__"]
+    sys.modules["__main__"] = types.ModuleType("__main__")
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = vero
+
+
+def _niente():
+    return None
+
+
+class Smistatore:
+    """Pool condiviso da tutte le sessioni per i lavori pesanti (PDF, listini).
+
+    Ogni sessione ha la sua coda e i thread pescano a turno da una sessione e dall'altra:
+    chi manda molti lavori non fa aspettare chi ne manda uno. Oltre `max_in_coda` lavori
+    in attesa, o `max_per_sessione` per la stessa sessione, `invia` rifiuta con CodaPiena.
+    Con `processi` > 0 i lavori marcati `in_processo` girano in processi separati:
+    l'impaginazione usa tutti i core invece di contendersi il GIL con le pagine.
+    """
+
+    def __init__(self, max_thread=4, processi=0, max_in_coda=32, max_per_sessione=2):
+        self.max_thread = max_thread
+        self.processi = processi
+        self.max_in_coda = max_in_coda
+        self.max_per_sessione = max_per_sessione
+        self._code = OrderedDict()
+        self._per_sessione = {}
+        self._in_coda = 0
+        self._in_corso = 0
+        self._cond = threading.Condition()
+        self._pool_processi = None
+        if processi:
+            # spawn: il processo di Streamlit ha già molti thread, fork non è sicuro.
+            # I processi partono tutti adesso, non alla prima richiesta di un utente.
+            self._pool_processi = ProcessPoolExecutor(processi, mp_context=multiprocessing.get_context("spawn"))
+            with _senza_main():
+                avvii = [self._pool_processi.submit(_niente) for _ in range(processi)]
+            for avvio in avvii:
+                avvio.result()
+        for i in range(max_thread):
+            threading.Thread(target=self._lavora, name=f"smistatore-{i}", daemon=True).start()
+
+    def invia(self, sessione, funzione, *args, in_processo=False, al_via=None):
+        """Mette in coda `funzione(*args)` per la sessione e restituisce un Future.
+
+        Con `in_processo` (e processi attivi) funzione e argomenti devono essere serializzabili.
+        `al_via` viene chiamata nel thread di lavoro quando il lavoro parte.
+        """
+        if not (in_processo and self._pool_processi is not None):
+            # In thread: le misure finiscono nel registro della sessione che ha inviato il lavoro
+            funzione, in_processo = nel_contesto(funzione), False
+        with self._cond:
+            if self._in_coda >= self.max_in_coda:
+                raise CodaPiena("Il server sta preparando molti documenti: riprova tra qualche secondo.")
+            if self._per_sessione.get(sessione, 0) >= self.max_per_sessione:
+                raise CodaPiena("Hai già dei documenti in preparazione: attendi che finiscano.")
+            futuro = Future()
+            self._code.setdefault(sessione, deque()).append(
+                (futuro, funzione, args, in_processo, al_via, time.perf_counter()))
+            self._per_sessione[sessione] = self._per_sessione.get(sessione, 0) + 1
+            self._in_coda += 1
+            self._cond.notify()
+        return futuro
+
+    def _prossimo(self):
+        # A turno: prendo il primo lavoro della prima sessione e la rimetto in fondo al giro
+        sessione, coda = next(iter(self._code.items()))
+        lavoro = coda.popleft()
+        if coda:
+            self._code.move_to_end(sessione)
+        else:
+            del self._code[sessione]
+        self._in_coda -= 1
+        return sessione, lavoro
+
+    def _lavora(self):
+        while True:
+            with self._cond:
+                while not self._code:
+                    self._cond.wait()
+                sessione, (futuro, funzione, args, in_processo, al_via, inviato) = self._prossimo()
+                self._in_corso += 1
+            try:
+                if futuro.set_running_or_notify_cancel():
+                    registra("coda/attesa", time.perf_counter() - inviato, processo=in_processo)
+                    try:
+                        if al_via is not None:
+                            al_via()
+                        if in_processo:
+                            risultato = self._pool_processi.submit(funzione, *args).result()
+                        else:
+                            risultato = funzione(*args)
+                    except BaseException as e:
+                        futuro.set_exception(e)
+                    else:
+                        futuro.set_result(risultato)
+            finally:
+                with self._cond:
+                    self._in_corso -= 1
+                    self._per_sessione[sessione] -= 1
+                    if not self._per_sessione[sessione]:
+                        del self._per_sessione[sessione]
+
+    @property
+    def esecutore_processi(self):
+        """Il pool dei processi (None se non ce ne sono), per i lavori che si dividono in pezzi."""
+        return self._pool_processi
+
+    def stato(self):
+        with self._cond:
+            return {"in_coda": self._in_coda, "in_corso": self._in_corso, "sessioni": len(self._per_sessione),
+                    "thread": self.max_thread, "processi": self.processi}
+
+
+def genera_pdf_in_processo(preventivo, raggruppo=None):
+    """Punto d'ingresso per i processi di lavoro: niente callback, solo i byte del PDF."""
+    from preventivo_pdf import genera_pdf
+
+    return genera_pdf(preventivo, raggruppo=raggruppo)
+
+
+class Lavoro:
+    """Lavoro pesante in background, legato alla sessione che l'ha avviato.
+
+    Il thread non tocca mai Streamlit: aggiorna solo i contatori, che la pagina legge
+    a ogni aggiornamento per disegnare la barra di avanzamento.
+    """
+
+    def __init__(self, chiave, totale=0):
+        self.chiave = chiave
+        self.fatti = 0
+        self.totale = totale
+        self.messaggio = "In coda..."
+        self.avviato = time.time()
+        self.futuro = None
+        self._lock = threading.Lock()
+
+    def _avanzamento(self, fatti, totale, messaggio):
+        with self._lock:
+            self.fatti, self.totale, self.messaggio = fatti, totale, messaggio
+
+    @property
+    def in_coda(self):
+        return self.futuro is not None and not self.futuro.running() and not self.futuro.done()
+
+    @property
+    def finito(self):
+        return self.futuro is not None and self.futuro.done()
+
+    @property
+    def percentuale(self):
+        with self._lock:
+            return self.fatti / self.totale if self.totale else 0.0
+
+    def risultato(self):
+        """Il risultato del lavoro; rilancia l'eventuale errore avvenuto nel thread."""
+        return self.futuro.result()
+
+
+class LavoroPdf(Lavoro):
+    """Generazione del PDF di un preventivo in un thread separato."""
+
+    def __init__(self, chiave, preventivo, raggruppo=None):
+        # Copia: il carrello della sessione può cambiare mentre il PDF è in costruzione
+        preventivo = copy.deepcopy(preventivo)
+        super().__init__(chiave, len({r["Articolo"] for r in preventivo["righe"]}))
+        self.preventivo = preventivo
+        self.raggruppo = copy.deepcopy(raggruppo)
+        # Pool di processi per i blocchi articolo dei preventivi lunghi (vedi avvia_lavoro_pdf)
+        self.esecutore = None
+
+    def _esegui(self):
+        from preventivo_pdf import genera_pdf
+
+        return genera_pdf(self.preventivo, avanzamento=self._avanzamento, raggruppo=self.raggruppo,
+                          esecutore=self.esecutore)
+
+
+def avvia_lavoro_pdf(smistatore, sessione, chiave, preventivo, raggruppo=None):
+    """Mette in coda il PDF della sessione; solleva CodaPiena se il server è troppo carico."""
+    # fpdf si carica qui, nel thread della pagina: sotto Streamlit la cartella dello script
+    # può essere nel percorso di import solo durante il rerun, non nei thread di lavoro
+    import preventivo_pdf
+
+    lavoro = LavoroPdf(chiave, preventivo, raggruppo)
+    if smistatore.processi > 1 and lavoro.totale >= preventivo_pdf.SOGLIA_PARALLELO:
+        # Preventivo molto lungo: impagino in un thread e i blocchi articolo si preparano
+        # a pezzi in tutti i processi, invece che tutti in uno solo
+        lavoro.esecutore = smistatore.esecutore_processi
+        lavoro.futuro = smistatore.invia(sessione, lavoro._esegui)
+    elif smistatore.processi:
+        # In un altro processo la barra non può avanzare articolo per articolo
+        al_via = lambda: lavoro._avanzamento(0, lavoro.totale, "Impagino...")
+        lavoro.futuro = smistatore.invia(sessione, genera_pdf_in_processo, lavoro.preventivo, lavoro.raggruppo,
+                                         in_processo=True, al_via=al_via)
+    else:
+        lavoro.futuro = smistatore.invia(sessione, lavoro._esegui)
+    return lavoro
+
+
+class LavoroPacchetto(LavoroPdf):
+    """La stessa offerta per una lista di clienti, impaginata in uno ZIP su disco.
+
+    `prezzi` = (listino, base, manuali, sconti_base, sconti_atg) come li vuole preventivi_batch.crea_pacchetto.
+    """
+
+    def __init__(self, chiave, preventivo, clienti, prezzi, percorso):
+        super().__init__(chiave, preventivo)
+        self.clienti = copy.deepcopy(clienti)
+        self.prezzi = copy.deepcopy(prezzi)
+        self.percorso = percorso
+        self.totale = len(self.clienti)
+
+    def _esegui(self):
+        from preventivi_batch import crea_pacchetto
+
+        return crea_pacchetto(self.percorso, self.preventivo, self.clienti, *self.prezzi, avanzamento=self._avanzamento)
+
+
+def avvia_lavoro_pacchetto(smistatore, sessione, chiave, preventivo, clienti, prezzi, percorso):
+    """Mette in coda lo ZIP delle offerte; solleva CodaPiena se il server è troppo carico."""
+    import preventivi_batch
+
+    lavoro = LavoroPacchetto(chiave, preventivo, clienti, prezzi, percorso)
+    if smistatore.processi:
+        al_via = lambda: lavoro._avanzamento(0, lavoro.totale, "Impagino...")
+        lavoro.futuro = smistatore.invia(sessione, preventivi_batch.crea_pacchetto, lavoro.percorso, lavoro.preventivo,
+                                         lavoro.clienti, *lavoro.prezzi, in_processo=True, al_via=al_via)
+    else:
+        lavoro.futuro = smistatore.invia(sessione, lavoro._esegui)
+    return lavoro
+
+
+class LavoroListino(Lavoro):
+    """Listino del cliente (listino_cliente.esporta_listino o catalogo_illustrato) preparato in background.
+
+    `argomenti` sono quelli della funzione, che accetta anche `avanzamento`; `totale` sono le righe.
+    """
+
+    def __init__(self, chiave, funzione, argomenti, totale):
+        super().__init__(chiave, totale)
+        self.funzione = funzione
+        self.argomenti = argomenti
+
+    def _esegui(self):
+        return self.funzione(*self.argomenti, avanzamento=self._avanzamento)
+
+
+def avvia_lavoro_listino(smistatore, sessione, chiave, funzione, argomenti, totale):
+    """Mette in coda listino o catalogo del cliente; solleva CodaPiena se il server è troppo carico.
+
+    Se il risultato è un PDF, chi chiama deve aver già importato preventivo_pdf nel thread della
+    pagina (vedi avvia_lavoro_pdf): qui non si fa, così un listino Excel non carica fpdf.
+    """
+    lavoro = LavoroListino(chiave, funzione, argomenti, totale)
+    if smistatore.processi:
+        al_via = lambda: lavoro._avanzamento(0, lavoro.totale, "Impagino...")
+        lavoro.futuro = smistatore.invia(sessione, funzione, *argomenti, in_processo=True, al_via=al_via)
+    else:
+        lavoro.futuro = smistatore.invia(sessione, lavoro._esegui)
+    return lavoro
@@ -0,0 +1,49 @@
+import os
+import time
+
+# Parte leggera della "stessa offerta a più clienti": la pagina la usa a ogni rerun per leggere
+# la lista clienti. Gli ZIP li prepara preventivi_batch, che si carica (con fpdf) solo al via.
+
+CARTELLA = os.path.dirname(os.path.abspath(__file__))
+CARTELLA_PACCHETTI = os.path.join(CARTELLA, ".pacchetti")
+
+
+def _ha_cliente(valore):
+    if valore is None or (isinstance(valore, float) and valore != valore):
+        return False
+    return str(valore).strip().lower() not in ("nan", "none", "")
+
+
+def leggi_clienti(sorgente):
+    """Clienti da CSV o Excel (percorso o file caricato), una riga per cliente.
+
+    Colonne: CLIENTE, REFERENTE, SC1-SC3, SC_ATG1-SC_ATG3, NOTE, PAGAMENTO, TRASPORTO, VALIDITA.
+    Le righe senza CLIENTE vengono saltate.
+    """
+    import pandas as pd
+
+    nome = str(getattr(sorgente, "name", sorgente)).lower()
+    if nome.endswith((".xlsx", ".xls")):
+        return clienti_da_tabella(pd.read_excel(sorgente))
+    return clienti_da_tabella(pd.read_csv(sorgente, sep=None, engine="python"))
+
+
+def clienti_da_tabella(df):
+    """Stesse regole di leggi_clienti per una tabella già in memoria (es. scritta a mano nell'app)."""
+    df = df.copy()
+    df.columns = [str(c).strip().upper() for c in df.columns]
+    return [r for r in df.to_dict("records") if _ha_cliente(r.get("CLIENTE"))]
+
+
+def pulisci_pacchetti(ore=24):
+    """Toglie gli ZIP più vecchi di `ore`: ormai sono stati scaricati o dimenticati."""
+    if not os.path.isdir(CARTELLA_PACCHETTI):
+        return
+    limite = time.time() - ore * 3600
+    for nome in os.listdir(CARTELLA_PACCHETTI):
+        percorso = os.path.join(CARTELLA_PACCHETTI, nome)
+        try:
+            if os.path.getmtime(percorso) < limite:
+                os.remove(percorso)
+        except OSError:
+            pass
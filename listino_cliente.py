@@ -0,0 +1,234 @@
+from io import BytesIO
+
+import pandas as pd
+
+from prezzi import listino_scontato, moltiplicatore_sconto
+
+FORMATI = {
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV": ("csv", "text/csv"),
+    "PDF": ("pdf", "application/pdf"),
+}
+
+# Colonne del PDF: (intestazione, colonna della tabella, larghezza mm, allineamento)
+COLONNE_PDF = [
+    ("Articolo", "Articolo", 58, "L"),
+    ("Taglie", "Taglie", 28, "L"),
+    ("Normativa / Rivestimento", "Dettagli", 52, "L"),
+    ("Listino", "Prezzo Listino", 26, "R"),
+    ("Netto", "Netto", 26, "R"),
+]
+
+
+# Ultima quota utile della pagina in mm: sotto c'è il piè di pagina "Pagina n di N" (PDF.footer, a 285)
+FONDO_PAGINA = 280
+
+# Schede del catalogo illustrato: 3 per riga, misure in mm
+SCHEDA_LARGHEZZA = 63
+SCHEDA_ALTEZZA = 64
+FOTO_ALTEZZA = 36
+
+
+def _testo_sconti(sconti):
+    return "+".join(f"{s:g}" for s in sconti if s) or "0"
+
+
+def listino_per_cliente(catalogo, sconti_base, sconti_atg, manuali=None):
+    """Tutto il catalogo con i netti del cliente: una riga per articolo, Base prima di ATG."""
+    parti = []
+    if catalogo.df_base is not None:
+        df = listino_scontato(catalogo.df_base, sconti_base, manuali)
+        parti.append(pd.DataFrame({
+            "Listino": "Base",
+            "Articolo": df['ARTICOLO'],
+            "Taglie": df.get('RANGE TAGLIE', ""),
+            "Dettagli": df.get('NORMATIVA', ""),
+            "Prezzo Listino": df['LISTINO'].round(2),
+            "Sconto": _testo_sconti(sconti_base),
+            "Netto": df['NETTO'].round(2),
+        }))
+    if catalogo.df_atg is not None:
+        df = listino_scontato(catalogo.df_atg, sconti_atg, manuali)
+        parti.append(pd.DataFrame({
+            "Listino": "ATG",
+            "Articolo": df['ARTICOLO'],
+            "Taglie": df.get('RANGE_TAGLIE', ""),
+            "Dettagli": df.get('RIVESTIMENTO', ""),
+            "Prezzo Listino": df['LISTINO'].round(2),
+            "Sconto": _testo_sconti(sconti_atg),
+            "Netto": df['NETTO'].round(2),
+        }))
+    if not parti:
+        return pd.DataFrame(columns=["Listino", "Articolo", "Taglie", "Dettagli", "Prezzo Listino", "Sconto", "Netto"])
+    tabella = pd.concat(parti, ignore_index=True)
+    if manuali:
+        # Gli articoli a prezzo forzato non hanno uno sconto "di serie"
+        forzati = tabella['Articolo'].isin([a for a, p in manuali.items() if p and p > 0])
+        tabella.loc[forzati, "Sconto"] = "manuale"
+    return tabella.fillna({"Taglie": "", "Dettagli": ""})
+
+
+# --- ESPORTAZIONE ---
+def esporta_listino(tabella, formato, cliente="", referente="", avanzamento=None):
+    """Byte del file nel formato scelto (una delle chiavi di FORMATI).
+
+    `avanzamento(fatti, totale, messaggio)` riceve le righe impaginate; Excel e CSV escono in un colpo solo.
+    """
+    if formato == "Excel":
+        uscita = BytesIO()
+        tabella.to_excel(uscita, index=False, sheet_name="Listino")
+        return uscita.getvalue()
+    if formato == "CSV":
+        # Punto e virgola e virgola decimale: si apre così com'è nell'Excel italiano
+        return tabella.to_csv(index=False, sep=";", decimal=",").encode("utf-8-sig")
+    if formato == "PDF":
+        return _listino_pdf(tabella, cliente, referente, avanzamento)
+    raise ValueError(f"Formato non previsto: {formato}")
+
+
+def _adatta(pdf, testo, larghezza):
+    """Il testo accorciato finché non entra nella colonna."""
+    testo = str(testo).replace('€', 'Euro')
+    if pdf.get_string_width(testo) <= larghezza - 2:
+        return testo
+    while testo and pdf.get_string_width(testo + "...") > larghezza - 2:
+        testo = testo[:-1]
+    return testo + "..."
+
+
+def _intestazione_tabella(pdf):
+    pdf.set_font("helvetica", "B", 9)
+    pdf.set_fill_color(230, 230, 230)
+    for titolo, _, larghezza, allineamento in COLONNE_PDF:
+        pdf.cell(larghezza, 7, titolo, border=1, align=allineamento, fill=True)
+    pdf.ln(7)
+    pdf.set_font("helvetica", "", 8)
+
+
+def _listino_pdf(tabella, cliente, referente, avanzamento=None):
+    # fpdf si carica solo quando serve davvero un PDF
+    from preventivo_pdf import PDF, motore_predefinito
+
+    avanzamento = avanzamento or (lambda fatti, totale, messaggio: None)
+    fatti = 0
+
+    pdf = PDF(cliente, referente, motore_predefinito().logo)
+    pdf.set_auto_page_break(False)
+    pdf.add_page()
+
+    pdf.set_font("helvetica", "B", 14)
+    pdf.cell(0, 8, "Listino prezzi netti riservato", new_x="LMARGIN", new_y="NEXT")
+    pdf.set_font("helvetica", "I", 9)
+    pdf.cell(0, 6, "Prezzi in Euro, netti iva esclusa.", new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(2)
+
+    for nome_listino, righe in tabella.groupby("Listino", sort=False):
+        if pdf.get_y() > FONDO_PAGINA - 21:
+            pdf.add_page()
+        pdf.set_font("helvetica", "B", 11)
+        pdf.cell(0, 8, f"Listino {nome_listino} - sconto {righe['Sconto'].mode().iat[0]}", new_x="LMARGIN", new_y="NEXT")
+        _intestazione_tabella(pdf)
+        for riga in righe.to_dict("records"):
+            if pdf.get_y() > FONDO_PAGINA - 6:
+                pdf.add_page()
+                _intestazione_tabella(pdf)
+            for _, colonna, larghezza, allineamento in COLONNE_PDF:
+                valore = riga[colonna]
+                if isinstance(valore, float):
+                    testo = "" if pd.isna(valore) else f"{valore:.2f}"
+                else:
+                    testo = _adatta(pdf, valore, larghezza)
+                pdf.cell(larghezza, 6, testo, border="B", align=allineamento)
+            pdf.ln(6)
+            fatti += 1
+            if fatti % 50 == 0:
+                avanzamento(fatti, len(tabella), f"Listino {nome_listino}")
+        pdf.ln(4)
+
+    return bytes(pdf.output())
+
+
+# --- CATALOGO ILLUSTRATO ---
+def catalogo_illustrato(schede, sconti_base, sconti_atg, cliente="", referente="", avanzamento=None):
+    """PDF di tutte le schede (Catalogo.schede) con miniatura, listino e netto del cliente.
+
+    Le foto sono solo quelle già in cache locale: nessuna richiesta in rete, chi manca ha il riquadro vuoto.
+    `avanzamento(fatti, totale, messaggio)` riceve le schede impaginate, una riga alla volta.
+    """
+    from immagini import cache_predefinita
+    from preventivo_pdf import PDF, motore_predefinito
+
+    avanzamento = avanzamento or (lambda fatti, totale, messaggio: None)
+    cache = cache_predefinita()
+    fatti = 0
+    pdf = PDF(cliente, referente, motore_predefinito().logo)
+    pdf.set_auto_page_break(False)
+    pdf.add_page()
+
+    pdf.set_font("helvetica", "B", 14)
+    pdf.cell(0, 8, "Catalogo prodotti", new_x="LMARGIN", new_y="NEXT")
+    pdf.set_font("helvetica", "I", 9)
+    pdf.cell(0, 6, "Prezzi in Euro, netti iva esclusa.", new_x="LMARGIN", new_y="NEXT")
+
+    for nome_listino, righe in schede.groupby("Listino", sort=False):
+        sconti = sconti_base if nome_listino == "Base" else sconti_atg
+        moltiplicatore = moltiplicatore_sconto(*sconti)
+        if pdf.get_y() > FONDO_PAGINA - SCHEDA_ALTEZZA - 10:
+            pdf.add_page()
+        pdf.ln(3)
+        pdf.set_font("helvetica", "B", 11)
+        pdf.cell(0, 8, f"Listino {nome_listino} - sconto {_testo_sconti(sconti)}", new_x="LMARGIN", new_y="NEXT")
+
+        y_riga = pdf.get_y()
+        for i, scheda in enumerate(righe.to_dict("records")):
+            colonna = i % 3
+            if colonna == 0:
+                if i:
+                    pdf.set_y(y_riga + SCHEDA_ALTEZZA)
+                    fatti += 3
+                    avanzamento(fatti, len(schede), f"Listino {nome_listino}")
+                if pdf.get_y() > FONDO_PAGINA - SCHEDA_ALTEZZA + 3:
+                    pdf.add_page()
+                y_riga = pdf.get_y()
+            x = pdf.l_margin + colonna * SCHEDA_LARGHEZZA
+            _scheda(pdf, cache, scheda, x, y_riga, moltiplicatore)
+        pdf.set_y(y_riga + SCHEDA_ALTEZZA)
+        fatti += (len(righe) - 1) % 3 + 1
+
+    return bytes(pdf.output())
+
+
+def _scheda(pdf, cache, scheda, x, y, moltiplicatore):
+    larghezza = SCHEDA_LARGHEZZA - 3
+    foto = cache.miniatura(scheda["Immagine"]) if scheda["Immagine"].startswith("http") else None
+    pdf.set_draw_color(220, 220, 220)
+    pdf.rect(x, y, larghezza, SCHEDA_ALTEZZA - 3)
+    pdf.set_draw_color(0, 0, 0)
+    foto_inserita = False
+    if foto is not None:
+        try:
+            pdf.image(BytesIO(foto), x=x + 2, y=y + 2, w=larghezza - 4, h=FOTO_ALTEZZA, keep_aspect_ratio=True)
+            foto_inserita = True
+        except Exception:
+            pass
+    if not foto_inserita:
+        pdf.set_xy(x, y + FOTO_ALTEZZA / 2)
+        pdf.set_font("helvetica", "I", 8)
+        pdf.set_text_color(150, 150, 150)
+        pdf.cell(larghezza, 6, "Foto non disponibile", align="C")
+        pdf.set_text_color(0, 0, 0)
+
+    pdf.set_xy(x + 1, y + FOTO_ALTEZZA + 4)
+    pdf.set_font("helvetica", "B", 9)
+    pdf.cell(larghezza - 2, 5, _adatta(pdf, scheda["Articolo"], larghezza - 2), new_x="LEFT", new_y="NEXT")
+    pdf.set_font("helvetica", "", 7.5)
+    for testo in (scheda["Dettagli"], scheda["Taglie"]):
+        if testo.strip():
+            pdf.cell(larghezza - 2, 4, _adatta(pdf, testo, larghezza - 2), new_x="LEFT", new_y="NEXT")
+    listino = scheda["Prezzo Listino"]
+    if not pd.isna(listino):
+        pdf.set_xy(x + 1, y + SCHEDA_ALTEZZA - 10)
+        pdf.set_font("helvetica", "", 8)
+        pdf.cell((larghezza - 2) / 2, 5, f"Listino {listino:.2f}")
+        pdf.set_font("helvetica", "B", 9)
+        pdf.cell((larghezza - 2) / 2, 5, f"Netto {listino * moltiplicatore:.2f}", align="R")
@@ -0,0 +1,266 @@
+"""Generazione in blocco dei preventivi PDF, senza interfaccia.
+
+Uso:
+    python preventivi_batch.py ordini.csv --uscita preventivi/ [--processi 4]
+
+Il file (CSV o Excel) ha una riga per taglia ordinata. Colonne riconosciute:
+    PREVENTIVO   identificativo del preventivo (se manca si usa CLIENTE)
+    CLIENTE, REFERENTE
+    ARTICOLO, TAGLIA (vuota = solo modello), QUANTITA
+    PREZZO_NETTO (facoltativo, forza il prezzo come nel campo manuale dell'app)
+    SC1, SC2, SC3, SC_ATG1, SC_ATG2, SC_ATG3 (se mancano valgono quelli di default)
+    ESPOSITORI (file jpg separati da ";"), PAGAMENTO, TRASPORTO, VALIDITA, NOTE
+Le colonne del preventivo (cliente, sconti, condizioni...) si leggono dalla prima riga del gruppo.
+
+Dall'app si usa anche per mandare la stessa offerta a una lista di clienti (lista_clienti,
+crea_pacchetto): un PDF per cliente, con i suoi sconti, tutti dentro un unico ZIP.
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from catalogo import carica_listino
+from immagini import precarica_immagini
+from prezzi import SCONTI_DEFAULT_ATG, SCONTI_DEFAULT_BASE, moltiplicatore_sconto, prezzo_netto
+from preventivo_pdf import genera_pdf, motore_predefinito, nome_file_pdf
+
+CARTELLA = os.path.dirname(os.path.abspath(__file__))
+
+CONDIZIONI_DEFAULT = {"PAGAMENTO": "Ri.Ba. 60 giorni", "TRASPORTO": "P.to Franco", "VALIDITA": "30.06.2026"}
+
+# Catalogo del processo: caricato una volta per worker dallo snapshot Parquet
+_articoli = None
+
+
+def _carica_articoli():
+    global _articoli
+    if _articoli is None:
+        _articoli = {}
+        for nome_file, tipo, catalogo in (('Listino_agente.xlsx', "base", "Listino Base"), ('Listino_ATG.xlsx', "atg", "Listino ATG")):
+            path = os.path.join(CARTELLA, nome_file)
+            if not os.path.exists(path):
+                continue
+            for _, riga in carica_listino(path, tipo).iterrows():
+                # Come nella ricerca dell'app, a parità di nome vince il listino Base
+                _articoli.setdefault(str(riga['ARTICOLO']).strip().upper(), (catalogo, riga))
+    return _articoli
+
+
+def _testo(valore, default=""):
+    if valore is None or (isinstance(valore, float) and pd.isna(valore)):
+        return default
+    testo = str(valore).strip()
+    return default if testo.lower() in ("nan", "none", "") else testo
+
+
+def _numero(valore, default):
+    try:
+        numero = float(valore)
+    except (TypeError, ValueError):
+        return default
+    return default if pd.isna(numero) else numero
+
+
+def leggi_ordini(path):
+    """Legge il file ordini e restituisce {id_preventivo: [righe come dizionari]}."""
+    if path.lower().endswith((".xlsx", ".xls")):
+        df = pd.read_excel(path)
+    else:
+        df = pd.read_csv(path, sep=None, engine="python")
+    df.columns = [str(c).strip().upper() for c in df.columns]
+    gruppi = {}
+    for riga in df.to_dict("records"):
+        chiave = _testo(riga.get("PREVENTIVO")) or _testo(riga.get("CLIENTE"), "Cliente")
+        gruppi.setdefault(chiave, []).append(riga)
+    return gruppi
+
+
+def componi_preventivo(righe_ordine):
+    """Trasforma le righe dell'ordine nel dizionario preventivo usato da genera_pdf."""
+    articoli = _carica_articoli()
+    testa = righe_ordine[0]
+    sconti_base = tuple(_numero(testa.get(f"SC{i}"), SCONTI_DEFAULT_BASE[i - 1]) for i in (1, 2, 3))
+    sconti_atg = tuple(_numero(testa.get(f"SC_ATG{i}"), SCONTI_DEFAULT_ATG[i - 1]) for i in (1, 2, 3))
+
+    righe = []
+    for r in righe_ordine:
+        nome = _testo(r.get("ARTICOLO")).upper()
+        if nome not in articoli:
+            raise ValueError(f"Articolo non trovato nei listini: {r.get('ARTICOLO')}")
+        catalogo, d = articoli[nome]
+        sconti = sconti_base if catalogo == "Listino Base" else sconti_atg
+        netto = prezzo_netto(d['LISTINO'], sconti, _numero(r.get("PREZZO_NETTO"), None))
+        quantita = int(_numero(r.get("QUANTITA"), 0))
+        taglia = _testo(r.get("TAGLIA"), "-")
+        if taglia.endswith(".0"):
+            taglia = taglia[:-2]
+        righe.append({
+            "Articolo": d['ARTICOLO'], "Taglia": taglia, "Quantità": quantita,
+            "Netto U.": netto, "Totale Riga": netto * quantita,
+            "Immagine": str(d.get('IMMAGINE', '')).strip(),
+            "Normativa": _testo(d.get('NORMATIVA')) if catalogo == "Listino Base" else ""
+        })
+
+    espositori = [e.strip() for e in _testo(testa.get("ESPOSITORI")).split(";") if e.strip()]
+    return {
+        "cliente": _testo(testa.get("CLIENTE")),
+        "referente": _testo(testa.get("REFERENTE")),
+        "righe": righe,
+        "espositori": espositori,
+        "note": _testo(testa.get("NOTE")),
+        "pagamento": _testo(testa.get("PAGAMENTO"), CONDIZIONI_DEFAULT["PAGAMENTO"]),
+        "trasporto": _testo(testa.get("TRASPORTO"), CONDIZIONI_DEFAULT["TRASPORTO"]),
+        "validita": _testo(testa.get("VALIDITA"), CONDIZIONI_DEFAULT["VALIDITA"]),
+    }
+
+
+def _elabora(chiave, righe_ordine, cartella_uscita):
+    """Eseguito nel processo worker: un preventivo, un PDF. Restituisce una riga di report."""
+    inizio = time.perf_counter()
+    try:
+        preventivo = componi_preventivo(righe_ordine)
+        # Un nome fisso per preventivo: con la colonna PREVENTIVO entra anche il numero, così più
+        # ordini dello stesso cliente nello stesso giorno non finiscono sullo stesso file, e
+        # rilanciare il batch riscrive gli stessi PDF invece di affiancarne altri
+        numero = chiave if _testo(righe_ordine[0].get("PREVENTIVO")) else ""
+        percorso = os.path.join(cartella_uscita, nome_file_pdf(preventivo["cliente"] or chiave, suffisso=numero))
+        # Scritto a parte e rinominato alla fine: un errore a metà non lascia un PDF troncato
+        tmp = f"{percorso}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                genera_pdf(preventivo, destinazione=f)
+            os.replace(tmp, percorso)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return {"preventivo": chiave, "esito": "ok", "file": percorso,
+                "secondi": round(time.perf_counter() - inizio, 3), "errore": ""}
+    except Exception as e:
+        return {"preventivo": chiave, "esito": "errore", "file": "",
+                "secondi": round(time.perf_counter() - inizio, 3), "errore": str(e)}
+
+
+# --- STESSA OFFERTA A PIÙ CLIENTI (ZIP) ---
+def offerte_per_clienti(preventivo, clienti, listino, base, manuali, sconti_base, sconti_atg):
+    """Un preventivo per cliente, uno alla volta: stesse righe di `preventivo` con gli sconti del cliente.
+
+    `listino`, `base` e `manuali` sono per riga (Catalogo.prezzi_listino, prezzi.netti_fermi):
+    le righe a prezzo forzato a mano o fuori catalogo restano ferme, le altre prendono gli sconti del cliente. Gli sconti che il cliente non ha valgono quelli passati.
+    """
+    listino = np.asarray(listino, dtype=float)
+    manuali = np.asarray(manuali, dtype=float)
+    for cliente in clienti:
+        sc_base = tuple(_numero(cliente.get(f"SC{i}"), sconti_base[i - 1]) for i in (1, 2, 3))
+        sc_atg = tuple(_numero(cliente.get(f"SC_ATG{i}"), sconti_atg[i - 1]) for i in (1, 2, 3))
+        moltiplicatori = np.where(base, moltiplicatore_sconto(*sc_base), moltiplicatore_sconto(*sc_atg))
+        netti = np.where(np.isnan(manuali), listino * moltiplicatori, manuali)
+        righe = [dict(r, **{"Netto U.": float(netto), "Totale Riga": float(netto) * r["Quantità"]})
+                 for r, netto in zip(preventivo["righe"], netti)]
+        yield dict(
+            preventivo,
+            cliente=_testo(cliente.get("CLIENTE")),
+            referente=_testo(cliente.get("REFERENTE")),
+            righe=righe,
+            note=_testo(cliente.get("NOTE"), preventivo.get("note", "")),
+            pagamento=_testo(cliente.get("PAGAMENTO"), preventivo.get("pagamento", "")),
+            trasporto=_testo(cliente.get("TRASPORTO"), preventivo.get("trasporto", "")),
+            validita=_testo(cliente.get("VALIDITA"), preventivo.get("validita", "")),
+        )
+
+
+def scrivi_zip(destinazione, preventivi, totale=0, avanzamento=None):
+    """Impagina i preventivi uno dopo l'altro direttamente dentro lo ZIP `destinazione`.
+
+    Ogni PDF finisce nello ZIP appena pronto, quindi la memoria non cresce con il numero di
+    clienti. Foto, logo e blocchi articolo si preparano al primo cliente e valgono per tutti.
+    Restituisce il riepilogo (cliente, file, totale), scritto anche nello ZIP come riepilogo.csv.
+    """
+    motore = motore_predefinito()
+    avanzamento = avanzamento or (lambda fatti, totale, messaggio: None)
+    immagini_pronte = None
+    riepilogo, nomi = [], set()
+    with zipfile.ZipFile(destinazione, "w", compression=zipfile.ZIP_DEFLATED) as pacchetto:
+        for i, preventivo in enumerate(preventivi, start=1):
+            if immagini_pronte is None:
+                avanzamento(0, totale, "Scarico le foto...")
+                immagini_pronte = precarica_immagini(r["Immagine"] for r in preventivo["righe"])
+            nome_file = nome_file_pdf(preventivo["cliente"])
+            # Due clienti con lo stesso nome: il secondo non sovrascrive il primo
+            radice, doppione = nome_file[:-4], 2
+            while nome_file in nomi:
+                nome_file, doppione = f"{radice}_{doppione}.pdf", doppione + 1
+            nomi.add(nome_file)
+            # Il PDF è già compresso: nello ZIP va così com'è
+            voce = zipfile.ZipInfo(nome_file, date_time=datetime.now().timetuple()[:6])
+            voce.compress_type = zipfile.ZIP_STORED
+            with pacchetto.open(voce, "w") as f:
+                motore.genera(preventivo, immagini_pronte=immagini_pronte, destinazione=f)
+            riepilogo.append({"cliente": preventivo["cliente"], "file": nome_file,
+                              "totale": round(sum(r["Totale Riga"] for r in preventivo["righe"]), 2)})
+            avanzamento(i, totale, preventivo["cliente"])
+        pacchetto.writestr("riepilogo.csv", pd.DataFrame(riepilogo).to_csv(index=False, sep=";", decimal=","))
+    return riepilogo
+
+
+def crea_pacchetto(percorso, preventivo, clienti, listino, base, manuali, sconti_base, sconti_atg, avanzamento=None):
+    """Lo ZIP delle offerte su disco in `percorso` (scritto a parte e rinominato alla fine)."""
+    os.makedirs(os.path.dirname(percorso), exist_ok=True)
+    tmp = f"{percorso}.{os.getpid()}.tmp"
+    offerte = offerte_per_clienti(preventivo, clienti, listino, base, manuali, sconti_base, sconti_atg)
+    with open(tmp, "wb") as f:
+        scrivi_zip(f, offerte, totale=len(clienti), avanzamento=avanzamento)
+    os.replace(tmp, percorso)
+    return percorso
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera in blocco i preventivi PDF da un file ordini CSV/Excel.")
+    parser.add_argument("ordini", help="file CSV o Excel con le righe d'ordine")
+    parser.add_argument("--uscita", default="preventivi", help="cartella dei PDF generati")
+    parser.add_argument("--processi", type=int, default=os.cpu_count(), help="numero di processi in parallelo")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.uscita, exist_ok=True)
+    gruppi = leggi_ordini(args.ordini)
+    inizio = time.perf_counter()
+
+    # Le foto si scaricano una volta sola qui: i worker poi le trovano nella cache su disco
+    urls = set()
+    for righe_ordine in gruppi.values():
+        try:
+            urls.update(r["Immagine"] for r in componi_preventivo(righe_ordine)["righe"])
+        except ValueError:
+            pass
+    precarica_immagini(urls, scadenza=60)
+
+    report = []
+    with ProcessPoolExecutor(max_workers=args.processi) as esecutore:
+        futuri = [esecutore.submit(_elabora, chiave, righe, args.uscita) for chiave, righe in gruppi.items()]
+        for futuro in as_completed(futuri):
+            esito = futuro.result()
+            report.append(esito)
+            stato = "OK " if esito["esito"] == "ok" else "ERR"
+            print(f"[{stato}] {esito['preventivo']}: {esito['secondi']:.2f}s {esito['file'] or esito['errore']}")
+
+    percorso_report = os.path.join(args.uscita, "report.csv")
+    with open(percorso_report, "w", newline="", encoding="utf-8") as f:
+        scrittore = csv.DictWriter(f, fieldnames=["preventivo", "esito", "file", "secondi", "errore"])
+        scrittore.writeheader()
+        scrittore.writerows(sorted(report, key=lambda r: r["preventivo"]))
+
+    errori = sum(1 for r in report if r["esito"] != "ok")
+    print(f"{len(report) - errori} preventivi generati, {errori} errori in {time.perf_counter() - inizio:.1f}s. Report: {percorso_report}")
+    return 1 if errori else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
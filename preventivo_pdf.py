@@ -0,0 +1,428 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from io import BytesIO
+
+from fpdf import FPDF
+
+# Anche da qui, per chi li importava da questo modulo
+from formato_preventivo import NOMI_ESPOSITORI, impronta_preventivo, nome_file_pdf, raggruppa_righe
+from immagini import cache_predefinita, normalizza_immagine, precarica_immagini
+from risorse import leggi_risorsa
+from strumentazione import cronometro
+
+__all__ = [
+    "BLOCCHI_PER_PAGINA", "MESI", "PAGINE_PER_PEZZO", "SOGLIA_PARALLELO",
+    "PDF", "MotorePreventivi", "motore_predefinito", "genera_pdf", "prepara_blocchi",
+    # Riesportati da formato_preventivo
+    "NOMI_ESPOSITORI", "impronta_preventivo", "nome_file_pdf", "raggruppa_righe",
+]
+
+CARTELLA = os.path.dirname(os.path.abspath(__file__))
+
+# Blocchi articolo che stanno in una pagina: i pezzi mandati ai processi sono di qualche pagina
+BLOCCHI_PER_PAGINA = 5
+PAGINE_PER_PEZZO = 4
+# Sotto questa soglia di articoli da preparare non conviene spedirli ad altri processi
+SOGLIA_PARALLELO = 40
+
+MESI = ["Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno", "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
+
+
+class PDF(FPDF):
+    def __init__(self, cliente="", referente="", logo=None):
+        super().__init__()
+        self.cliente = cliente
+        self.referente = referente
+        # Byte del logo già letti dal motore: niente accesso al disco a ogni pagina
+        self.logo = logo
+
+    def header(self):
+        # Logo.png in alto a sinistra, rimpicciolito e spostato leggermente più in alto
+        if self.logo is not None:
+            # Larghezza (w) passata da 100 a 50 (dimezzato), posizione Y passata da 8 a 4 (più in alto)
+            self.image(BytesIO(self.logo), 5, 4, 70) 
+
+        # Spett.le
+        self.set_font("helvetica", "", 12)
+        self.set_xy(100, 15)
+        self.cell(100, 6, "Spett.le", align="R", ln=1)
+
+        # Nome Cliente
+        self.set_font("helvetica", "B", 20) 
+        self.set_x(100) 
+        testo_nome = self.cliente if self.cliente else "Cliente"
+        self.cell(100, 8, testo_nome, align="R", ln=1)
+
+        # Nome Referente
+        if self.referente:
+            self.set_font("helvetica", "", 15) 
+            self.set_x(100)
+            self.cell(100, 7, f"c.a. {self.referente}", align="R", ln=1)
+
+        # DATA ODIERNA
+        oggi = datetime.now()
+        data_formattata = f"{oggi.day} {MESI[oggi.month - 1]} {oggi.year}"
+
+        self.set_font("helvetica", "I", 11)
+        self.set_text_color(100, 100, 100)
+        self.set_x(100)
+        self.cell(100, 7, f"Data: {data_formattata}", align="R", ln=1)
+        self.set_text_color(0, 0, 0)
+
+        self.ln(15)
+
+    def footer(self):
+        self.set_y(-12)
+        self.set_font("helvetica", "I", 8)
+        self.set_text_color(150, 150, 150)
+        self.cell(0, 6, f"Pagina {self.page_no()} di {{nb}}", align="C")
+        self.set_text_color(0, 0, 0)
+
+
+class MotorePreventivi:
+    """Impaginatore dei preventivi, indipendente da Streamlit.
+
+    Legge una volta sola logo e foto degli espositori e li riusa per tutti i documenti:
+    conviene tenerne un'istanza per processo (vedi `motore_predefinito`).
+    Tiene anche i blocchi articolo già preparati (testi e foto ridotta), così rigenerando
+    un preventivo appena ritoccato, o lo stesso con altri sconti, si rifanno solo gli articoli cambiati.
+    Per i preventivi molto lunghi i blocchi nuovi si possono preparare in più processi (`esecutore`):
+    l'impaginazione resta una sola, quindi intestazioni, numeri di pagina e chiusura sono quelli di sempre.
+    """
+
+    def __init__(self, cartella=CARTELLA, max_blocchi=2000):
+        self.cartella = cartella
+        self._risorse = {}
+        self._blocchi = OrderedDict()
+        self.max_blocchi = max_blocchi
+        self._lock = threading.Lock()
+        self.logo = None
+        for f in ["logo.png", "logo.jpg", "logo.jpeg"]:
+            self.logo = self.risorsa(f, larghezza_mm=70)
+            if self.logo is not None:
+                break
+
+    def risorsa(self, nome_file, larghezza_mm=35):
+        """Byte di un file statico (logo, espositori) già ridotto per la stampa, letto dal disco solo la prima volta."""
+        with self._lock:
+            chiave = (nome_file, larghezza_mm)
+            if chiave not in self._risorse:
+                if self.cartella == CARTELLA:
+                    # File del progetto: lettura condivisa con il resto dell'app
+                    contenuto = leggi_risorsa(nome_file)
+                else:
+                    percorso = os.path.join(self.cartella, nome_file)
+                    contenuto = None
+                    if os.path.exists(percorso):
+                        with open(percorso, "rb") as f:
+                            contenuto = f.read()
+                self._risorse[chiave] = None if contenuto is None else normalizza_immagine(contenuto, larghezza_mm=larghezza_mm)
+            return self._risorse[chiave]
+
+    def genera(self, preventivo, immagini_pronte=None, destinazione=None, avanzamento=None, raggruppo=None,
+               esecutore=None):
+        """Impagina il preventivo.
+
+        `immagini_pronte` ({url: byte}) evita di riscaricare le foto; se manca vengono precaricate qui.
+        Con `destinazione` (percorso o file aperto in binario) il PDF viene scritto lì,
+        altrimenti vengono restituiti i byte.
+        `avanzamento(fatti, totale, messaggio)` viene chiamata dopo ogni articolo impaginato.
+        `raggruppo` già pronto (es. da Carrello.raggruppo) evita di ricalcolarlo dalle righe.
+        Con `esecutore` (un ProcessPoolExecutor) e almeno SOGLIA_PARALLELO articoli nuovi, i blocchi
+        si preparano a pezzi di qualche pagina negli altri processi.
+        """
+        if raggruppo is None:
+            raggruppo = raggruppa_righe(preventivo["righe"])
+        totale_generale = sum(r["Totale Riga"] for r in preventivo["righe"])
+        avanzamento = avanzamento or (lambda fatti, totale, messaggio: None)
+
+        blocchi = {art: self._blocco_in_cache(art, dati) for art, dati in raggruppo.items()}
+        da_preparare = [art for art, blocco in blocchi.items() if blocco is None]
+
+        if immagini_pronte is None:
+            # Servono solo le foto degli articoli nuovi o cambiati, scaricate in parallelo
+            immagini_pronte = {}
+            if da_preparare:
+                avanzamento(0, len(raggruppo), "Scarico le foto...")
+                with cronometro("pdf/precarica_foto", foto=len(da_preparare)):
+                    immagini_pronte = precarica_immagini(raggruppo[art]["Img"] for art in da_preparare)
+
+        if esecutore is not None and len(da_preparare) >= SOGLIA_PARALLELO:
+            with cronometro("pdf/blocchi_paralleli", articoli=len(da_preparare)):
+                for art, blocco in self._prepara_in_parallelo(esecutore, raggruppo, da_preparare, immagini_pronte, avanzamento):
+                    blocchi[art] = blocco
+
+        pdf = PDF(preventivo.get("cliente", ""), preventivo.get("referente", ""), self.logo)
+        pdf.add_page()
+
+        # --- CICLO PRODOTTI ---
+        for i, (art, dati) in enumerate(raggruppo.items(), start=1):
+            blocco = blocchi[art]
+            with cronometro("pdf/articolo", articolo=art, riusato=blocco is not None):
+                if blocco is None:
+                    blocco = self._prepara_blocco(pdf, art, dati, immagini_pronte.get(dati["Img"]))
+                self._blocco_articolo(pdf, blocco, dati)
+            avanzamento(i, len(raggruppo), art)
+
+        self._totale(pdf, totale_generale)
+        self._espositori(pdf, preventivo.get("espositori") or [])
+        self._note(pdf, preventivo.get("note", ""))
+        self._condizioni(pdf, preventivo.get("pagamento", ""), preventivo.get("trasporto", ""), preventivo.get("validita", ""))
+        self._firma(pdf)
+
+        with cronometro("pdf/output", pagine=pdf.pages_count):
+            if destinazione is not None:
+                pdf.output(destinazione)
+                return None
+            pdf_out = pdf.output()
+        
+        if isinstance(pdf_out, str):
+            return pdf_out.encode('latin-1')
+        return bytes(pdf_out)
+
+    # --- BLOCCHI ARTICOLO ---
+    @staticmethod
+    def _chiave_blocco(art, dati, impronta):
+        # Prezzi esclusi: si scrivono al volo, così lo stesso blocco serve con qualunque sconto.
+        # Dentro c'è l'impronta della foto in cache: quando la cache la rivalida e il sito l'ha
+        # cambiata (anteprima, controllo notturno, scadenza), il blocco con la foto vecchia non vale più
+        return (art, tuple(dati["T"]), dati["Img"], impronta, dati.get("Normativa", ""))
+
+    def _blocco_in_cache(self, art, dati):
+        # Un solo accesso ai metadati della foto per articolo e preventivo
+        meta = cache_predefinita().meta(dati["Img"]) if dati["Img"] else None
+        chiave = self._chiave_blocco(art, dati, meta.get("impronta") if meta else None)
+        with self._lock:
+            blocco = self._blocchi.get(chiave)
+            if blocco is not None:
+                self._blocchi.move_to_end(chiave)
+            return blocco
+
+    def _prepara_in_parallelo(self, esecutore, raggruppo, articoli, immagini_pronte, avanzamento):
+        # Pezzi nell'ordine del preventivo; a ogni processo vanno solo le foto del suo pezzo
+        passo = BLOCCHI_PER_PAGINA * PAGINE_PER_PEZZO
+        futuri = []
+        for inizio in range(0, len(articoli), passo):
+            voci = [(art, raggruppo[art], immagini_pronte.get(raggruppo[art]["Img"]))
+                    for art in articoli[inizio:inizio + passo]]
+            futuri.append((voci, esecutore.submit(prepara_blocchi, voci)))
+        pronti = 0
+        for voci, futuro in futuri:
+            for (art, dati, contenuto), blocco in zip(voci, futuro.result()):
+                self._memorizza_blocco(art, dati, contenuto, blocco)
+                yield art, blocco
+            pronti += len(voci)
+            avanzamento(0, len(raggruppo), f"Preparo gli articoli: {pronti}/{len(articoli)}")
+
+    def _prepara_blocco(self, pdf, art, dati, contenuto):
+        blocco = self._componi_blocco(pdf, art, dati, contenuto)
+        self._memorizza_blocco(art, dati, contenuto, blocco)
+        return blocco
+
+    def _componi_blocco(self, pdf, art, dati, contenuto):
+        """La parte costosa dell'articolo: testi già composti e spezzati in righe, foto già ridotta."""
+        foto = None
+        if contenuto is not None:
+            try:
+                # Foto ridotta a 35 mm di stampa, poi passata a fpdf direttamente dalla memoria
+                foto = normalizza_immagine(contenuto, larghezza_mm=35)
+            except Exception:
+                foto = None
+        blocco = {
+            "modello": f"Modello: {art}",
+            "normativa": f"Normativa: {dati['Normativa']}" if dati.get("Normativa") else None,
+            "taglie": self._righe_taglie(pdf, dati["T"]),
+            "foto": foto,
+        }
+        return blocco
+
+    def _memorizza_blocco(self, art, dati, contenuto, blocco):
+        # Se la foto non è arrivata non memorizzo: al prossimo giro si riprova a scaricarla
+        if contenuto is not None or not dati["Img"]:
+            # La cache salva le foto con lo sha256 del contenuto: l'impronta si ricava dai byte
+            # già in memoria, senza rileggere i metadati
+            impronta = hashlib.sha256(contenuto).hexdigest() if contenuto is not None else None
+            with self._lock:
+                self._blocchi[self._chiave_blocco(art, dati, impronta)] = blocco
+                while len(self._blocchi) > self.max_blocchi:
+                    self._blocchi.popitem(last=False)
+
+    @staticmethod
+    def _righe_taglie(pdf, taglie):
+        # Andare a capo è la parte più cara del blocco: lo faccio una volta e tengo le righe
+        if not taglie:
+            return None
+        pdf.set_font("helvetica", "I", 9)
+        return pdf.multi_cell(135, 5, " | ".join(taglie), dry_run=True, output="LINES")
+
+    def _blocco_articolo(self, pdf, blocco, dati):
+        y_inizio = pdf.get_y()
+        if y_inizio > 230:
+            pdf.add_page()
+            y_inizio = pdf.get_y()
+
+        pdf.set_xy(10, y_inizio)
+        pdf.set_font("helvetica", "B", 12)
+        pdf.cell(135, 7, blocco["modello"], ln=1)
+
+        # STAMPA DELLA NORMATIVA
+        if blocco["normativa"]:
+            pdf.set_font("helvetica", "I", 9) 
+            pdf.cell(135, 5, blocco["normativa"], ln=1)
+
+        pdf.set_font("helvetica", "", 10)
+        pdf.cell(135, 6, f"Prezzo Netto: {dati['Netto']:.2f} Euro", ln=1)
+
+        if blocco["taglie"]:
+            pdf.set_font("helvetica", "I", 9)
+            for riga in blocco["taglie"]:
+                pdf.cell(135, 5, riga, new_x="LMARGIN", new_y="NEXT")
+        else:
+            pdf.set_font("helvetica", "I", 9)
+            pdf.cell(135, 5, "Proposta Modello (Nessuna quantità specificata)", ln=1)
+
+        pdf.ln(2) 
+
+        if dati['Tot'] > 0:
+            pdf.set_x(10) 
+            pdf.set_font("helvetica", "B", 10)
+            pdf.cell(135, 6, f"Subtotale: {dati['Tot']:.2f} Euro", ln=1)
+
+        y_fine_testo = pdf.get_y()
+
+        foto_inserita = False
+        y_fine_immagine = y_inizio + 10 
+
+        if blocco["foto"] is not None:
+            try:
+                pdf.image(BytesIO(blocco["foto"]), x=155, y=y_inizio, w=35)
+                foto_inserita = True
+                y_fine_immagine = y_inizio + 35 
+            except: 
+                # Foto illeggibile per fpdf: inutile riprovarla ai giri successivi
+                blocco["foto"] = None
+
+        if not foto_inserita:
+            pdf.set_xy(155, y_inizio + 10)
+            pdf.set_font("helvetica", "I", 9)
+            pdf.set_text_color(150, 150, 150)
+            pdf.cell(35, 10, "Foto non disponibile", align="C")
+            pdf.set_text_color(0, 0, 0)
+            y_fine_immagine = y_inizio + 20
+
+        y_fine_blocco = max(y_fine_testo, y_fine_immagine)
+        pdf.set_y(y_fine_blocco + 5)
+        pdf.line(10, pdf.get_y(), 200, pdf.get_y())
+        pdf.ln(5)
+
+    def _totale(self, pdf, totale_generale):
+        # --- TOTALE GENERALE ---
+        pdf.ln(5)
+        if totale_generale > 0:
+            pdf.set_font("helvetica", "B", 14)
+            pdf.cell(0, 10, f"TOTALE GENERALE: {totale_generale:.2f} Euro", align="R")
+            pdf.ln(10)
+
+    def _espositori(self, pdf, espositori):
+        # --- ESPOSITORI ---
+        if espositori:
+            pdf.ln(5)
+            for esp_file in espositori:
+                if pdf.get_y() > 220: 
+                    pdf.add_page()
+
+                current_y_esp = pdf.get_y()
+                descrizione_espositore = NOMI_ESPOSITORI.get(esp_file, esp_file.replace('.jpg', '').upper())
+
+                foto_esp = self.risorsa(esp_file)
+                if foto_esp is not None:
+                    pdf.image(BytesIO(foto_esp), x=10, y=current_y_esp, w=35)
+                else:
+                    pdf.set_xy(10, current_y_esp)
+                    pdf.set_font("helvetica", "I", 10)
+                    pdf.set_text_color(200,0,0)
+                    pdf.cell(35, 10, "Foto Mancante", ln=1)
+                    pdf.set_text_color(0,0,0)
+
+                pdf.set_xy(50, current_y_esp + 10) 
+                pdf.set_font("helvetica", "B", 14)
+                pdf.set_text_color(0, 100, 0) 
+                testo_omaggio = f"Modello: {descrizione_espositore}\nEspositore in OMAGGIO con questo ordine!"
+                pdf.multi_cell(0, 7, testo_omaggio)
+                pdf.set_text_color(0, 0, 0) 
+                pdf.set_y(current_y_esp + 45)
+
+    def _note(self, pdf, note):
+        # --- NOTE ---
+        if note.strip():
+            pdf.ln(5)
+            pdf.set_font("helvetica", "B", 14) 
+            pdf.cell(0, 8, "Note:")
+            pdf.ln(8)
+            pdf.set_font("helvetica", "", 13) 
+            testo_note = note.replace('€', 'Euro')
+            pdf.multi_cell(0, 6, testo_note)
+
+    def _condizioni(self, pdf, pagamento, trasporto, validita):
+        # --- PAGAMENTO, TRASPORTO, VALIDITA' E PREZZI ---
+        pdf.ln(6) 
+        h_c = 6
+
+        if pagamento.strip():
+            pdf.set_font("helvetica", "B", 10)
+            pdf.cell(pdf.get_string_width("Pagamento: ") + 2, h_c, "Pagamento:", ln=0)
+            pdf.set_font("helvetica", "", 10)
+            pdf.cell(pdf.get_string_width(pagamento) + 6, h_c, pagamento, ln=0)
+
+        if trasporto.strip():
+            pdf.set_font("helvetica", "B", 10)
+            pdf.cell(pdf.get_string_width("Trasporto: ") + 2, h_c, "Trasporto:", ln=0)
+            pdf.set_font("helvetica", "", 10)
+            pdf.cell(pdf.get_string_width(trasporto) + 6, h_c, trasporto, ln=0)
+
+        if validita.strip():
+            pdf.set_font("helvetica", "B", 10)
+            pdf.cell(pdf.get_string_width("Validità: ") + 2, h_c, "Validità:", ln=0)
+            pdf.set_font("helvetica", "", 10)
+            pdf.cell(pdf.get_string_width(validita) + 6, h_c, validita, ln=0)
+
+        pdf.set_font("helvetica", "B", 10)
+        pdf.cell(pdf.get_string_width("Prezzi: ") + 2, h_c, "Prezzi:", ln=0)
+        pdf.set_font("helvetica", "", 10)
+        pdf.cell(0, h_c, "netti iva esclusa", ln=1)
+
+    def _firma(self, pdf):
+        # --- FIRMA ---
+        pdf.ln(10)
+        pdf.set_font("helvetica", "I", 11)
+        pdf.cell(0, 6, "Michele Cavallo - Area Manager | Base Protection srl", align="R", ln=1)
+        pdf.cell(0, 6, "Tel. 389.0199088", align="R", ln=1)
+
+
+_motore_predefinito = None
+
+
+def motore_predefinito():
+    global _motore_predefinito
+    if _motore_predefinito is None:
+        _motore_predefinito = MotorePreventivi()
+    return _motore_predefinito
+
+
+def genera_pdf(preventivo, immagini_pronte=None, destinazione=None, avanzamento=None, raggruppo=None, esecutore=None):
+    """Scorciatoia: impagina con il motore condiviso del processo."""
+    return motore_predefinito().genera(preventivo, immagini_pronte, destinazione, avanzamento, raggruppo, esecutore)
+
+
+def prepara_blocchi(voci):
+    """Punto d'ingresso per i processi di lavoro: i blocchi di (articolo, dati, foto), nello stesso ordine.
+
+    Una pagina vuota basta per misurare i testi; i blocchi tornano al processo che impagina.
+    """
+    motore = motore_predefinito()
+    pdf = FPDF()
+    pdf.add_page()
+    return [motore._componi_blocco(pdf, art, dati, contenuto) for art, dati, contenuto in voci]
@@ -0,0 +1,79 @@
+# --- CALCOLO PREZZI ---
+SCONTI_DEFAULT_BASE = (40.0, 10.0, 0.0)
+SCONTI_DEFAULT_ATG = (40.0, 10.0, 0.0)
+
+
+def moltiplicatore_sconto(s1, s2, s3):
+    """Sconto composto reale: 40 + 10 significa 0.6 * 0.9, non 50%."""
+    return (1 - s1/100) * (1 - s2/100) * (1 - s3/100)
+
+
+def prezzo_netto(prezzo_listino, sconti, prezzo_manuale=None):
+    """Prezzo netto unitario; un prezzo manuale > 0 vince sempre sul calcolato."""
+    if prezzo_manuale is not None and prezzo_manuale > 0.0:
+        return float(prezzo_manuale)
+    return float(prezzo_listino) * moltiplicatore_sconto(*sconti)
+
+
+# --- CALCOLO SU TUTTO IL LISTINO ---
+# numpy e pandas importati nelle funzioni: il prezzo di un articolo non deve caricarli
+def listino_scontato(df, sconti, manuali=None):
+    """Copia del listino con la colonna NETTO calcolata su tutte le righe in un colpo solo.
+
+    `manuali` ({articolo: prezzo}) forza il netto di singoli articoli, come il prezzo manuale dell'app.
+    """
+    import numpy as np
+    import pandas as pd
+
+    netto = df['LISTINO'].to_numpy(dtype=float) * moltiplicatore_sconto(*sconti)
+    if manuali:
+        forzati = pd.to_numeric(df['ARTICOLO'].map(manuali), errors="coerce").to_numpy(dtype=float)
+        netto = np.where(forzati > 0, forzati, netto)
+    risultato = df.copy()
+    risultato['NETTO'] = netto
+    return risultato
+
+
+def netti_fermi(netti, listino, manuali):
+    """Per ogni riga il netto che non segue gli sconti, NaN se va ricalcolato.
+
+    Fermi sono i netti forzati a mano (`manuali`, NaN dove non c'è) e quelli delle righe senza
+    prezzo di listino (articolo non più a catalogo), che tengono il netto del carrello.
+    """
+    import numpy as np
+
+    netti = np.asarray(netti, dtype=float)
+    manuali = np.asarray(manuali, dtype=float)
+    fuori_catalogo = np.isnan(np.asarray(listino, dtype=float))
+    return np.where(~np.isnan(manuali), manuali, np.where(fuori_catalogo, netti, np.nan))
+
+
+def confronta_sconti(listino, base, quantita, manuali, scenari):
+    """Totale del carrello con più serie di sconti, tutte calcolate insieme.
+
+    `scenari` è {nome: (sconti_base, sconti_atg)}; le righe con netto manuale restano ferme.
+    Restituisce un DataFrame con una riga per scenario, il primo fa da riferimento per le differenze.
+    """
+    import numpy as np
+    import pandas as pd
+
+    nomi = list(scenari)
+    listino = np.nan_to_num(np.asarray(listino, dtype=float))
+    quantita = np.asarray(quantita, dtype=float)
+    manuali = np.asarray(manuali, dtype=float)
+    moltiplicatori_base = np.array([moltiplicatore_sconto(*scenari[n][0]) for n in nomi])
+    moltiplicatori_atg = np.array([moltiplicatore_sconto(*scenari[n][1]) for n in nomi])
+
+    # Matrice righe x scenari
+    moltiplicatori = np.where(np.asarray(base)[:, None], moltiplicatori_base[None, :], moltiplicatori_atg[None, :])
+    netti = np.where(~np.isnan(manuali)[:, None], manuali[:, None], listino[:, None] * moltiplicatori)
+    totali = quantita @ netti
+    # Righe fuori catalogo: al posto del listino conto il loro netto
+    lordo = quantita @ np.where(listino > 0, listino, np.nan_to_num(manuali))
+
+    return pd.DataFrame({
+        "Scenario": nomi,
+        "Totale €": totali.round(2),
+        "Differenza €": (totali - totali[0]).round(2) if nomi else [],
+        "Sconto medio %": (100 * (1 - totali / lordo)).round(1) if lordo else np.zeros(len(nomi)),
+    })
@@ -0,0 +1,114 @@
+import difflib
+from collections import defaultdict, namedtuple
+
+# Punteggi: più basso = più in alto nella lista
+ESATTO, PREFISSO, INIZIO_PAROLA, CONTIENE, SIMILE, CAMPO_EXTRA = range(6)
+
+Risultato = namedtuple("Risultato", ["articolo", "catalogo", "riga", "punteggio"])
+
+CAMPI_EXTRA = ("NORMATIVA", "RIVESTIMENTO")
+
+
+def _ngrammi(testo, n_max=3):
+    """Tutti gli n-grammi da 1 a n_max caratteri del testo."""
+    visti = set()
+    for n in range(1, n_max + 1):
+        for i in range(len(testo) - n + 1):
+            visti.add(testo[i:i + n])
+    return visti
+
+
+def _pulito(valore):
+    testo = str(valore).strip()
+    return "" if testo.lower() in ("nan", "none", "nat", "null") else testo.upper()
+
+
+class IndiceRicerca:
+    """Indice di ricerca su tutti i listini, costruito una volta per caricamento del catalogo.
+
+    Codici già in maiuscolo e indice di n-grammi (1-3 caratteri): una ricerca tocca solo le voci
+    che contengono davvero il testo cercato, senza scorrere i DataFrame a ogni tasto.
+    """
+
+    def __init__(self, cataloghi):
+        # cataloghi: lista di (nome_catalogo, DataFrame) nell'ordine di priorità
+        self.voci = []
+        self.testi = []
+        self.testi_extra = []
+        self._ngrammi = defaultdict(set)
+        self._ngrammi_extra = defaultdict(set)
+
+        for nome_catalogo, df in cataloghi:
+            if df is None:
+                continue
+            colonne_extra = [c for c in CAMPI_EXTRA if c in df.columns]
+            articoli = df['ARTICOLO'].tolist()
+            extra = [df[c].tolist() for c in colonne_extra]
+            for riga, articolo in enumerate(articoli):
+                pos = len(self.voci)
+                testo = _pulito(articolo)
+                testo_extra = " ".join(t for t in (_pulito(e[riga]) for e in extra) if t)
+                self.voci.append((str(articolo), nome_catalogo, riga))
+                self.testi.append(testo)
+                self.testi_extra.append(testo_extra)
+                for g in _ngrammi(testo):
+                    self._ngrammi[g].add(pos)
+                for g in _ngrammi(testo_extra):
+                    self._ngrammi_extra[g].add(pos)
+
+    @staticmethod
+    def _candidati(indice, query):
+        # Per testi lunghi bastano i trigrammi: chi li contiene tutti è un candidato
+        pezzi = [query] if len(query) <= 3 else [query[i:i + 3] for i in range(len(query) - 2)]
+        insiemi = sorted((indice.get(p, set()) for p in pezzi), key=len)
+        if not insiemi or not insiemi[0]:
+            return set()
+        return set.intersection(*insiemi) if len(insiemi) > 1 else set(insiemi[0])
+
+    def _punteggio(self, testo, query):
+        if testo == query:
+            return ESATTO
+        if testo.startswith(query):
+            return PREFISSO
+        if f" {query}" in testo or f"-{query}" in testo:
+            return INIZIO_PAROLA
+        return CONTIENE
+
+    def _simili(self, query, esclusi, quanti):
+        # Ricerca "a orecchio": voci che condividono più trigrammi, poi confronto parola per parola
+        conteggi = defaultdict(int)
+        for i in range(len(query) - 2):
+            for pos in self._ngrammi.get(query[i:i + 3], ()):
+                if pos not in esclusi:
+                    conteggi[pos] += 1
+        migliori = sorted(conteggi, key=conteggi.get, reverse=True)[:50]
+        trovati = []
+        for pos in migliori:
+            parole = self.testi[pos].replace("-", " ").split()
+            somiglianza = max((difflib.SequenceMatcher(None, query, p).ratio() for p in parole), default=0)
+            if somiglianza >= 0.75:
+                trovati.append((-somiglianza, pos))
+        return [pos for _, pos in sorted(trovati)[:quanti]]
+
+    def cerca(self, query, campi_extra=False, limite=50, simili=True):
+        """Restituisce al massimo `limite` Risultato ordinati per pertinenza."""
+        query = query.strip().upper()
+        if not query:
+            return []
+
+        trovati = {}
+        for pos in self._candidati(self._ngrammi, query):
+            if query in self.testi[pos]:
+                trovati[pos] = self._punteggio(self.testi[pos], query)
+
+        if campi_extra:
+            for pos in self._candidati(self._ngrammi_extra, query):
+                if pos not in trovati and query in self.testi_extra[pos]:
+                    trovati[pos] = CAMPO_EXTRA
+
+        if simili and len(query) >= 4 and len(trovati) < limite:
+            for pos in self._simili(query, trovati, limite - len(trovati)):
+                trovati[pos] = SIMILE
+
+        ordinati = sorted(trovati, key=lambda pos: (trovati[pos], len(self.testi[pos]), pos))[:limite]
+        return [Risultato(*self.voci[pos], trovati[pos]) for pos in ordinati]
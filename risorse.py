@@ -0,0 +1,94 @@
+import base64
+import os
+import threading
+from io import BytesIO
+
+CARTELLA = os.path.dirname(os.path.abspath(__file__))
+# Versioni rimpicciolite già pronte: un processo nuovo non riapre il file originale con Pillow
+CARTELLA_RIDOTTE = os.path.join(CARTELLA, ".cache_risorse")
+
+# File statici (logo, Michelone, espositori) letti una volta per processo e condivisi da tutte le sessioni
+_cache = {}
+_lock = threading.Lock()
+
+
+def _ridimensiona(contenuto, larghezza_px):
+    from PIL import Image
+
+    immagine = Image.open(BytesIO(contenuto))
+    if immagine.width <= larghezza_px:
+        return contenuto
+    altezza_px = max(1, round(immagine.height * larghezza_px / immagine.width))
+    immagine = immagine.resize((larghezza_px, altezza_px), Image.LANCZOS)
+    uscita = BytesIO()
+    if immagine.mode in ("RGBA", "LA", "P"):
+        immagine.save(uscita, format="PNG", optimize=True)
+    else:
+        immagine.convert("RGB").save(uscita, format="JPEG", quality=85, optimize=True)
+    return uscita.getvalue()
+
+
+def _percorso_ridotta(percorso, larghezza_px):
+    # Nel nome anche data e dimensione dell'originale: se il file cambia, la copia vecchia non vale più
+    info = os.stat(percorso)
+    return os.path.join(CARTELLA_RIDOTTE, f"{os.path.basename(percorso)}.{larghezza_px}px.{int(info.st_mtime)}.{info.st_size}")
+
+
+def _leggi_ridotta(percorso, larghezza_px):
+    try:
+        with open(_percorso_ridotta(percorso, larghezza_px), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _salva_ridotta(percorso, larghezza_px, contenuto):
+    try:
+        os.makedirs(CARTELLA_RIDOTTE, exist_ok=True)
+        destinazione = _percorso_ridotta(percorso, larghezza_px)
+        tmp = f"{destinazione}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(contenuto)
+        os.replace(tmp, destinazione)
+    except OSError:
+        pass
+
+
+def leggi_risorsa(nome_file, larghezza_px=None):
+    """Byte del file (eventualmente rimpicciolito a `larghezza_px`), None se manca."""
+    chiave = (nome_file, larghezza_px)
+    with _lock:
+        if chiave in _cache:
+            return _cache[chiave]
+    percorso = os.path.join(CARTELLA, nome_file)
+    contenuto = None
+    if os.path.exists(percorso):
+        contenuto = _leggi_ridotta(percorso, larghezza_px) if larghezza_px else None
+        if contenuto is None:
+            with open(percorso, "rb") as f:
+                contenuto = f.read()
+            if larghezza_px:
+                try:
+                    contenuto = _ridimensiona(contenuto, larghezza_px)
+                    _salva_ridotta(percorso, larghezza_px, contenuto)
+                except Exception:
+                    pass
+    with _lock:
+        _cache[chiave] = contenuto
+    return contenuto
+
+
+def data_uri(nome_file, larghezza_px=None):
+    """Immagine pronta per un tag <img src=...>, calcolata una sola volta per processo."""
+    chiave = ("data_uri", nome_file, larghezza_px)
+    with _lock:
+        if chiave in _cache:
+            return _cache[chiave]
+    contenuto = leggi_risorsa(nome_file, larghezza_px)
+    uri = None
+    if contenuto is not None:
+        tipo = "image/png" if contenuto[:4] == b"\x89PNG" else "image/jpeg"
+        uri = f"data:{tipo};base64,{base64.b64encode(contenuto).decode()}"
+    with _lock:
+        _cache[chiave] = uri
+    return uri
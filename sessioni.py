@@ -0,0 +1,107 @@
+import sys
+import threading
+import time
+import weakref
+
+
+def dimensione(valore):
+    """Byte occupati da PDF, ZIP e listini pronti dentro la cache di una sessione (testi e numeri a parte)."""
+    if isinstance(valore, (bytes, bytearray)):
+        return len(valore)
+    if isinstance(valore, dict):
+        return sum(dimensione(v) for v in valore.values())
+    if isinstance(valore, (list, tuple)):
+        return sum(dimensione(v) for v in valore)
+    return sys.getsizeof(valore)
+
+
+class CacheSessione(dict):
+    """Risultati di una sessione che si possono sempre ricostruire: PDF pronti, listino, anteprima foto.
+
+    Il registro la svuota quando la sessione resta ferma troppo o il processo supera il suo budget.
+    """
+
+    def byte(self):
+        return dimensione(self)
+
+
+class RegistroSessioni:
+    """Sessioni del processo e ultimo rerun di ognuna, per tenere limitata la memoria del server.
+
+    Una sessione ferma da più di `ttl` secondi (scheda dimenticata aperta) perde cache e copie di
+    comodo del carrello; se tutte insieme superano `max_byte`, si svuotano prima le meno recenti.
+    Carrello e campi restano: al ritorno dell'agente si ricostruisce solo quello che serve.
+    Il registro tiene riferimenti deboli: le sessioni chiuse da Streamlit spariscono da sole.
+    """
+
+    def __init__(self, ttl=30 * 60, max_byte=256 * 1024 * 1024, intervallo=60):
+        self.ttl = ttl
+        self.max_byte = max_byte
+        self.intervallo = intervallo
+        self._sessioni = {}
+        self._lock = threading.Lock()
+        self._ultima_pulizia = 0.0
+
+    def tocca(self, id_sessione, cache, carrello):
+        """Da chiamare a ogni rerun: la sessione è viva e queste sono le sue strutture."""
+        adesso = time.time()
+        with self._lock:
+            self._sessioni[id_sessione] = (adesso, weakref.ref(cache), weakref.ref(carrello))
+            da_pulire = adesso - self._ultima_pulizia >= self.intervallo
+        if da_pulire:
+            self.pulisci(adesso)
+
+    def _vive(self):
+        # (id, ultimo rerun, cache, carrello) delle sessioni ancora in memoria, dalla meno recente
+        vive = []
+        with self._lock:
+            for id_sessione, (ultimo, rif_cache, rif_carrello) in list(self._sessioni.items()):
+                cache, carrello = rif_cache(), rif_carrello()
+                if cache is None and carrello is None:
+                    del self._sessioni[id_sessione]
+                    continue
+                vive.append((id_sessione, ultimo, cache, carrello))
+        return sorted(vive, key=lambda v: v[1])
+
+    def pulisci(self, adesso=None):
+        """Svuota le sessioni scadute e, oltre il budget, le meno recenti. Restituisce quante ne ha svuotate."""
+        adesso = adesso or time.time()
+        self._ultima_pulizia = adesso
+        vive = self._vive()
+        occupati = sum(self._byte(cache, carrello) for _, _, cache, carrello in vive)
+        svuotate = 0
+        for id_sessione, ultimo, cache, carrello in vive:
+            scaduta = adesso - ultimo > self.ttl
+            if not scaduta and occupati <= self.max_byte:
+                continue
+            prima = self._byte(cache, carrello)
+            if cache is not None:
+                cache.clear()
+            if carrello is not None:
+                carrello.libera()
+            liberati = prima - self._byte(cache, carrello)
+            occupati -= liberati
+            if liberati:
+                svuotate += 1
+        return svuotate
+
+    @staticmethod
+    def _byte(cache, carrello):
+        return (cache.byte() if cache is not None else 0) + (carrello.byte() if carrello is not None else 0)
+
+    def stato(self):
+        """Una riga per sessione viva: quanto occupa e quanto per riga di carrello."""
+        adesso = time.time()
+        righe = []
+        for id_sessione, ultimo, cache, carrello in reversed(self._vive()):
+            n_righe = len(carrello) if carrello is not None else 0
+            byte_carrello = carrello.byte() if carrello is not None else 0
+            righe.append({
+                "sessione": id_sessione[:8],
+                "ferma da s": round(adesso - ultimo),
+                "righe": n_righe,
+                "KB carrello": round(byte_carrello / 1024, 1),
+                "byte per riga": round(byte_carrello / n_righe) if n_righe else 0,
+                "KB cache": round((cache.byte() if cache is not None else 0) / 1024, 1),
+            })
+        return righe
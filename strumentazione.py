@@ -0,0 +1,157 @@
+import contextvars
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# PREVENTIVI_METRICHE sposta le misure altrove (es. il benchmark, per non mescolarle a quelle dell'app)
+CARTELLA_METRICHE = os.environ.get("PREVENTIVI_METRICHE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".metriche")
+FILE_METRICHE = os.path.join(CARTELLA_METRICHE, "metriche.jsonl")
+MAX_BYTE_LOG = 10 * 1024 * 1024
+# Le misure vanno su disco a blocchi da un thread a parte: ogni INTERVALLO_LOG secondi,
+# o prima se ne sono arrivate BLOCCO_LOG. Chi misura (download, articoli del PDF) non aspetta il disco
+INTERVALLO_LOG = 1.0
+BLOCCO_LOG = 200
+
+# Registro della sessione Streamlit che sta lavorando in questo thread/contesto (None = nessuna)
+_sessione = contextvars.ContextVar("metriche_sessione", default=None)
+
+_lock = threading.Lock()
+_per_fase = {}
+_per_host = {}
+_da_scrivere = []
+_lock_file = threading.Lock()
+_sveglia = threading.Event()
+_scrittore = None
+_pid_scrittore = None
+
+
+def nuovo_registro(max_voci=500):
+    """Registro delle misure di una sessione: le ultime `max_voci` misure."""
+    return deque(maxlen=max_voci)
+
+
+def collega_sessione(registro):
+    """Da chiamare a inizio rerun: le misure successive finiscono anche nel registro della sessione."""
+    _sessione.set(registro)
+
+
+def _accumula(tabella, chiave, secondi):
+    voce = tabella.setdefault(chiave, {"conteggio": 0, "totale": 0.0, "massimo": 0.0})
+    voce["conteggio"] += 1
+    voce["totale"] += secondi
+    voce["massimo"] = max(voce["massimo"], secondi)
+
+
+def _scrivi_log(voci):
+    try:
+        os.makedirs(CARTELLA_METRICHE, exist_ok=True)
+        if os.path.exists(FILE_METRICHE) and os.path.getsize(FILE_METRICHE) > MAX_BYTE_LOG:
+            os.replace(FILE_METRICHE, f"{FILE_METRICHE}.1")
+        with open(FILE_METRICHE, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(v, ensure_ascii=False, default=str) + "\n" for v in voci))
+    except OSError:
+        # Le metriche non devono mai far fallire un preventivo
+        pass
+
+
+def svuota_log():
+    """Scrive subito su disco le misure in attesa (di solito lo fa il thread di scrittura)."""
+    global _da_scrivere
+    with _lock:
+        voci, _da_scrivere = _da_scrivere, []
+    if voci:
+        with _lock_file:
+            _scrivi_log(voci)
+
+
+def _scrivi_in_background():
+    while True:
+        _sveglia.wait(INTERVALLO_LOG)
+        _sveglia.clear()
+        svuota_log()
+
+
+def _avvia_scrittore():
+    # Alla prima misura del processo (anche nei processi di lavoro). Finalize gira all'uscita
+    # sia del processo principale sia dei figli di multiprocessing, dove atexit non viene chiamato.
+    # Dopo un fork il figlio eredita la coda del padre ma non il suo thread né i Finalize:
+    # si riparte da zero (le misure ereditate le scrive il padre)
+    global _scrittore, _pid_scrittore, _da_scrivere, _lock_file, _sveglia
+    _da_scrivere = []
+    _lock_file = threading.Lock()
+    _sveglia = threading.Event()
+    _pid_scrittore = os.getpid()
+    _scrittore = threading.Thread(target=_scrivi_in_background, name="scrivi-metriche", daemon=True)
+    _scrittore.start()
+    multiprocessing.util.Finalize(None, svuota_log, exitpriority=10)
+
+
+def registra(fase, secondi, **dettagli):
+    voce = {"ts": round(time.time(), 3), "fase": fase, "secondi": round(secondi, 6), "pid": os.getpid()}
+    voce.update(dettagli)
+    with _lock:
+        if _pid_scrittore != voce["pid"]:
+            _avvia_scrittore()
+        _accumula(_per_fase, fase, secondi)
+        if dettagli.get("host"):
+            _accumula(_per_host, dettagli["host"], secondi)
+        _da_scrivere.append(voce)
+        if len(_da_scrivere) >= BLOCCO_LOG:
+            _sveglia.set()
+    registro = _sessione.get()
+    if registro is not None:
+        registro.append(voce)
+
+
+@contextmanager
+def cronometro(fase, **dettagli):
+    """Misura il blocco `with`. Il dizionario restituito si può arricchire (es. stato HTTP)."""
+    inizio = time.perf_counter()
+    try:
+        yield dettagli
+    except Exception as e:
+        dettagli.setdefault("errore", type(e).__name__)
+        raise
+    finally:
+        registra(fase, time.perf_counter() - inizio, **dettagli)
+
+
+def nel_contesto(funzione):
+    """Per i thread di lavoro: la funzione restituita gira con la sessione collegata qui.
+
+    Ogni chiamata a nel_contesto fa una copia nuova: una copia si usa in un solo thread alla volta.
+    """
+    contesto = contextvars.copy_context()
+    return lambda *args, **kwargs: contesto.run(funzione, *args, **kwargs)
+
+
+# --- RIEPILOGHI ---
+def _ordina(tabella):
+    righe = [{"chiave": k, **v, "media": v["totale"] / v["conteggio"]} for k, v in tabella.items()]
+    return sorted(righe, key=lambda r: r["totale"], reverse=True)
+
+
+def riepilogo_fasi(voci=None):
+    """Fasi ordinate per tempo totale: del registro indicato o, se manca, di tutto il processo."""
+    if voci is None:
+        with _lock:
+            return _ordina({k: dict(v) for k, v in _per_fase.items()})
+    tabella = {}
+    for v in list(voci):
+        _accumula(tabella, v["fase"], v["secondi"])
+    return _ordina(tabella)
+
+
+def riepilogo_host(voci=None):
+    if voci is None:
+        with _lock:
+            return _ordina({k: dict(v) for k, v in _per_host.items()})
+    tabella = {}
+    for v in list(voci):
+        if v.get("host"):
+            _accumula(tabella, v["host"], v["secondi"])
+    return _ordina(tabella)